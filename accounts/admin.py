@@ -1,6 +1,13 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
-from .models import User, PasswordResetCode
+from .models import Unit, User, PasswordResetCode
+
+
+@admin.register(Unit)
+class UnitAdmin(admin.ModelAdmin):
+    list_display = ('code', 'name', 'parent', 'is_active')
+    list_filter = ('is_active', 'parent')
+    search_fields = ('code', 'name')
 
 
 @admin.register(User)
@@ -1,6 +1,18 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_delete, post_migrate, post_save, pre_save
 
 
 class AccountsConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "accounts"
+
+    def ready(self):
+        from .models import Unit
+        from .unit_tree import unit_saved, unit_saving
+        from .units import seed_units, unit_changed
+
+        post_migrate.connect(seed_units, sender=self)
+        pre_save.connect(unit_saving, sender=Unit)
+        post_save.connect(unit_saved, sender=Unit)
+        post_save.connect(unit_changed, sender=Unit)
+        post_delete.connect(unit_changed, sender=Unit)
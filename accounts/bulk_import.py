@@ -0,0 +1,170 @@
+"""
+Bulk user provisioning from CSV.
+
+Rows are validated together: uniqueness of username, email and unit is
+checked with one query per column for the whole file, passwords are hashed
+on a process pool (``accounts/hashing.py``) and the accounts are inserted
+with one ``bulk_create`` in a single transaction. Invalid rows are left out
+and reported; ``dry_run`` validates without creating anything.
+
+Expected columns: ``username, email, password, first_name, last_name,
+department, role``. ``department`` may be a unit code or its display name;
+``role`` defaults to ``unit_head``.
+"""
+import csv
+import io
+import time
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_email
+from django.db import IntegrityError
+from django.db.models.functions import Lower
+
+from caobp_system.write_gate import serialized_atomic
+
+from .hashing import hash_passwords
+from .models import User
+from .units import all_units
+
+REQUIRED_COLUMNS = ('username', 'email', 'password')
+OPTIONAL_COLUMNS = ('first_name', 'last_name', 'department', 'role')
+
+
+class BulkImportError(Exception):
+    """Raised when the file itself cannot be read"""
+
+
+def read_csv(data):
+    """Rows of a CSV file given as text or bytes, as dicts"""
+    if isinstance(data, bytes):
+        data = data.decode('utf-8-sig')
+    reader = csv.DictReader(io.StringIO(data))
+    columns = [c.strip().lower() for c in reader.fieldnames or []]
+    missing = [c for c in REQUIRED_COLUMNS if c not in columns]
+    if missing:
+        raise BulkImportError(f'Missing column(s): {", ".join(missing)}')
+    reader.fieldnames = columns
+    return [{k: (v or '').strip() for k, v in row.items() if k} for row in reader]
+
+
+def _units_by_key():
+    units = {}
+    for unit in all_units():
+        units[unit.code.lower()] = unit
+        units.setdefault(unit.name.lower(), unit)
+    return units
+
+
+def validate_rows(rows):
+    """
+    Check every row; returns ``(valid, report)``.
+
+    ``valid`` holds ``(row_number, values)`` for the rows that can be
+    created, ``report`` one entry per row with its errors.
+    """
+    units = _units_by_key()
+    roles = dict(User.ROLE_CHOICES)
+    usernames = {r.get('username') for r in rows if r.get('username')}
+    emails = {r.get('email', '').lower() for r in rows if r.get('email')}
+    taken_usernames = set(User.objects.filter(username__in=usernames).values_list('username', flat=True))
+    taken_emails = set(User.objects.annotate(email_lower=Lower('email'))
+                       .filter(email_lower__in=emails).values_list('email_lower', flat=True))
+    taken_units = set(User.objects.filter(department__isnull=False).values_list('department_id', flat=True))
+
+    valid, report = [], []
+    seen_usernames, seen_emails, seen_units = set(), set(), set()
+    for number, row in enumerate(rows, start=2):  # row 1 is the header
+        errors = []
+        for column in REQUIRED_COLUMNS:
+            if not row.get(column):
+                errors.append(f'{column} is required')
+
+        username = row.get('username', '')
+        email = row.get('email', '').lower()
+        if username and (username in taken_usernames or username in seen_usernames):
+            errors.append(f'Username {username} already exists')
+        if email:
+            try:
+                validate_email(email)
+            except ValidationError:
+                errors.append(f'{email} is not a valid email address')
+            if email in taken_emails or email in seen_emails:
+                errors.append(f'Email {email} already exists')
+
+        role = row.get('role') or 'unit_head'
+        if role not in roles:
+            errors.append(f'Unknown role {role}')
+
+        department = None
+        if row.get('department'):
+            unit = units.get(row['department'].lower())
+            if unit is None:
+                errors.append(f'Unknown unit {row["department"]}')
+            elif unit.id in taken_units or unit.id in seen_units:
+                errors.append(f"There's already an existing user in this Unit ({unit.name})")
+            else:
+                department = unit.id
+
+        report.append({'row': number, 'username': username, 'errors': errors,
+                       'status': 'error' if errors else 'ok'})
+        if errors:
+            continue
+        seen_usernames.add(username)
+        seen_emails.add(email)
+        if department:
+            seen_units.add(department)
+        valid.append((number, {
+            'username': username,
+            'email': row['email'],
+            'password': row['password'],
+            'first_name': row.get('first_name', ''),
+            'last_name': row.get('last_name', ''),
+            'department_id': department,
+            'role': role,
+        }))
+    return valid, report
+
+
+def import_users(rows, dry_run=False, workers=None):
+    """
+    Validate and create users from ``rows`` (see ``read_csv``).
+
+    Returns a dict with ``created``, ``failed``, per-row ``rows`` and
+    ``hash_seconds``/``total_seconds`` timings.
+    """
+    started = time.monotonic()
+    valid, report = validate_rows(rows)
+    by_row = {entry['row']: entry for entry in report}
+
+    hash_seconds = 0.0
+    created = 0
+    if valid and not dry_run:
+        hashing = time.monotonic()
+        workers = workers or getattr(settings, 'BULK_IMPORT_WORKERS', None)
+        hashes = hash_passwords([values['password'] for _, values in valid], workers=workers)
+        hash_seconds = time.monotonic() - hashing
+
+        users = []
+        for (_, values), password in zip(valid, hashes):
+            users.append(User(**{**values, 'password': password}))
+        try:
+            with serialized_atomic():
+                User.objects.bulk_create(users)
+        except IntegrityError:
+            # Validation ran before hashing, outside the transaction
+            raise BulkImportError('Another user with the same username, email or unit was created '
+                                  'during the import; nothing was imported, please try again')
+        created = len(users)
+        for number, _ in valid:
+            by_row[number]['status'] = 'created'
+
+    return {
+        'created': created,
+        'valid': len(valid),
+        'failed': len(report) - len(valid),
+        'dry_run': dry_run,
+        'rows': report,
+        'hash_seconds': round(hash_seconds, 3),
+        'total_seconds': round(time.monotonic() - started, 3),
+    }
@@ -0,0 +1,30 @@
+"""
+Password hashing on a process pool.
+
+PBKDF2 is deliberately slow and holds the GIL, so hashing many passwords on
+threads is no faster than one after another. This module hashes them in
+worker processes instead. It must not import any models: with the ``spawn``
+start method each worker imports it fresh, and only needs Django settings
+(for ``PASSWORD_HASHERS``), not the app registry.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from django.contrib.auth.hashers import make_password
+
+# Below this many passwords, starting worker processes costs more than it saves
+MIN_PARALLEL = 4
+
+
+def _hash(password):
+    return make_password(password)
+
+
+def hash_passwords(passwords, workers=None):
+    """Hash ``passwords`` in parallel; returns the hashes in the same order"""
+    passwords = list(passwords)
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(passwords) < MIN_PARALLEL:
+        return [_hash(password) for password in passwords]
+    with ProcessPoolExecutor(max_workers=min(workers, len(passwords))) as pool:
+        return list(pool.map(_hash, passwords))
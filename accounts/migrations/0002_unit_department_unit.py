@@ -0,0 +1,76 @@
+"""
+Units become rows of ``accounts.Unit`` and ``User.department`` a key to one.
+
+Existing databases store unit codes in ``user.department``. The codes are
+copied into a temporary ``department_unit`` key before the text column is
+dropped; codes that are not in ``DEFAULT_UNITS`` get a unit of their own
+(named after the code) so no assignment is lost.
+"""
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def codes_to_units(apps, schema_editor):
+    from accounts.units import units_for_codes
+
+    User = apps.get_model('accounts', 'User')
+    using = schema_editor.connection.alias
+    users = User.objects.using(using).exclude(department__isnull=True).exclude(department='')
+    assigned = list(users.values_list('id', 'department'))
+    ids = units_for_codes(apps, using, [code for _, code in assigned])
+    for user_id, code in assigned:
+        User.objects.using(using).filter(id=user_id).update(department_unit_id=ids[code])
+
+
+def units_to_codes(apps, schema_editor):
+    User = apps.get_model('accounts', 'User')
+    Unit = apps.get_model('accounts', 'Unit')
+    using = schema_editor.connection.alias
+    codes = dict(Unit.objects.using(using).values_list('id', 'code'))
+    users = User.objects.using(using).exclude(department_unit__isnull=True)
+    for user_id, unit_id in users.values_list('id', 'department_unit_id'):
+        User.objects.using(using).filter(id=user_id).update(department=codes[unit_id])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Unit',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('code', models.CharField(max_length=50, unique=True)),
+                ('name', models.CharField(max_length=200)),
+                ('is_active', models.BooleanField(default=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('parent', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='children', to='accounts.unit')),
+            ],
+            options={
+                'ordering': ['id'],
+            },
+        ),
+        migrations.CreateModel(
+            name='UnitClosure',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('depth', models.PositiveIntegerField()),
+                ('ancestor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='descendant_links', to='accounts.unit')),
+                ('descendant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ancestor_links', to='accounts.unit')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['descendant', 'depth'], name='accounts_un_descend_e127de_idx')],
+                'constraints': [models.UniqueConstraint(fields=('ancestor', 'descendant'), name='unique_unit_closure')],
+            },
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='department_unit',
+            field=models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='accounts.unit'),
+        ),
+        migrations.RunPython(codes_to_units, units_to_codes),
+    ]
@@ -0,0 +1,31 @@
+"""
+Drop the unit code column in favour of the key filled in by
+``0002_unit_department_unit``; a separate migration so PostgreSQL commits
+the copied keys before the table is altered again.
+"""
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0002_unit_department_unit'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='user',
+            name='department',
+        ),
+        migrations.RenameField(
+            model_name='user',
+            old_name='department_unit',
+            new_name='department',
+        ),
+        migrations.AlterField(
+            model_name='user',
+            name='department',
+            field=models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='head', to='accounts.unit'),
+        ),
+    ]
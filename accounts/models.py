@@ -5,62 +5,55 @@ import random
 import string
 
 
-class User(AbstractUser):
-    UNIT_CHOICES = [
-        ('CAS', 'College of Arts and Sciences'),
-        ('COLLEGE_IND_TECH', 'College of Industrial Technology'),
-        ('COE', 'College of Education'),
-        ('COA', 'College of Agriculture'),
-        ('PRODUCTION_COMMERCIALIZATION', 'Production & Commercialization'),
-        ('PRODUCTION_BAO', 'Production & Business Affairs Office'),
-        ('PPSDO', 'Physical Plant & Site Development Office'),
-        ('VETERINARY_SERVICES', 'Veterinary Services'),
-        ('GUIDANCE', 'Guidance'),
-        ('RECORDS_ARCHIVES', 'Records and Archives'),
-        ('ALUMNI_AFFAIRS', 'Alumni Affairs'),
-        ('BOARD_SECRETARY', 'Board Secretary'),
-        ('MEDICAL_SERVICES', 'Medical Services Unit'),
-        ('SUPERVISING_ADMIN', 'Supervising Administrative Office'),
-        ('REGISTRAR', 'Registrar'),
-        ('CAWAYAN_CAMPUS', 'Cawayan Campus'),
-        ('BUDGET_UNIT', 'Budget Unit'),
-        ('ACCOUNTING_UNIT', 'Accounting Unit'),
-        ('CASH_UNIT', 'Cash Unit'),
-        ('SUPPLY_UNIT', 'Supply Unit'),
-        ('RECORDS_UNIT', 'Records Unit'),
-        ('HRMO_OFFICE', 'HRMO Office'),
-        ('PROCUREMENT_UNIT', 'Procurement Unit/BAC'),
-        ('SECURITY_UNIT', 'Security Unit'),
-        ('MOTORPOOL_UNIT', 'Motorpool Unit'),
-        ('LIBRARY_SERVICES', 'Library Services'),
-        ('NSTP_ROTC', 'NSTP/ROTC'),
-        ('INTERNATIONAL_RELATIONS', 'International Relations Office'),
-        ('SPORTS_CULTURAL', 'Sports and Cultural Development'),
-        ('LEGAL_SERVICES', 'Legal Services Office'),
-        ('PERSONNEL_SCHOLARSHIP', 'Personnel Scholarship Office'),
-        ('QUALITY_ASSURANCE', 'Quality Assurance Office'),
-        ('OFFICE_VPAA', 'Office of the VPAA'),
-        ('OFFICE_VPAF', 'Office of the VPAF'),
-        ('OFFICE_VPREICWKM', 'Office of the VPREICWKM'),
-        ('OFFICE_BSB', 'Office of the Board Secretary/BOT'),
-        ('PLANNING', 'Planning'),
-        ('QUALITY_ASSURANCE', 'Quality Assurance'),
-        ('ISO', 'ISO'),
-        ('MIS', 'MIS'),
-        ('SCUAA', 'SCUAA'),
-        ('CSC', 'CSC'),
-        ('CRCYC', 'CRCYC'),
-        ('GAD', 'GAD'),
-        ('PIO', 'PIO'),
-    ]
+class Unit(models.Model):
+    """An organizational unit; see ``accounts/units.py`` for the cached registry"""
+    code = models.CharField(max_length=50, unique=True)
+    name = models.CharField(max_length=200)
+    parent = models.ForeignKey('self', on_delete=models.PROTECT, blank=True, null=True, related_name='children')
+    is_active = models.BooleanField(default=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
     
+    class Meta:
+        ordering = ['id']
+    
+    def __str__(self):
+        return self.name
+    
+    def clean(self):
+        from .unit_tree import check_parent
+        check_parent(self, self.parent_id)
+
+
+class UnitClosure(models.Model):
+    """
+    One row per (ancestor, descendant) pair in the unit tree, including each
+    unit paired with itself at depth 0; maintained by ``accounts/unit_tree.py``
+    """
+    ancestor = models.ForeignKey(Unit, on_delete=models.CASCADE, related_name='descendant_links')
+    descendant = models.ForeignKey(Unit, on_delete=models.CASCADE, related_name='ancestor_links')
+    depth = models.PositiveIntegerField()
+    
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['ancestor', 'descendant'], name='unique_unit_closure'),
+        ]
+        indexes = [
+            models.Index(fields=['descendant', 'depth']),
+        ]
+    
+    def __str__(self):
+        return f"{self.ancestor_id} -> {self.descendant_id} ({self.depth})"
+
+
+class User(AbstractUser):
     ROLE_CHOICES = [
         ('admin', 'Administrator'),
         ('unit_head', 'Unit Head'),
     ]
     
     email = models.EmailField(unique=True)
-    department = models.CharField(max_length=50, choices=UNIT_CHOICES, blank=True, null=True, unique=True)
+    department = models.OneToOneField(Unit, on_delete=models.PROTECT, blank=True, null=True, related_name='head')
     role = models.CharField(max_length=20, choices=ROLE_CHOICES, default='unit_head')
     is_active = models.BooleanField(default=True)
     created_at = models.DateTimeField(auto_now_add=True)
@@ -68,6 +61,10 @@ class User(AbstractUser):
     
     def __str__(self):
         return f"{self.get_full_name()} ({self.username})"
+    
+    def get_department_display(self):
+        from .units import unit_name
+        return unit_name(self.department_id)
 
 
 class PasswordResetCode(models.Model):
@@ -1,3 +1,71 @@
 from django.test import TestCase
 
-# Create your tests here.
+from .bulk_import import BulkImportError, import_users, read_csv
+from .models import Unit, User
+
+HEADER = 'username,email,password,first_name,last_name,department,role\n'
+
+
+class BulkImportTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.cas = Unit.objects.get(code='CAS')
+        User.objects.create_user('cas_head', 'CAS.Head@example.org', 'pw', department=cls.cas)
+
+    def run_import(self, lines, dry_run=False):
+        return import_users(read_csv(HEADER + '\n'.join(lines)), dry_run=dry_run, workers=1)
+
+    def errors(self, result):
+        return {entry['row']: entry['errors'] for entry in result['rows'] if entry['errors']}
+
+    def test_valid_rows_are_created(self):
+        result = self.run_import([
+            'ana,ana@example.org,Secret-123,Ana,Cruz,COE,',
+            'ben,ben@example.org,Secret-123,Ben,Reyes,,admin',
+        ])
+        self.assertEqual((result['created'], result['failed']), (2, 0))
+        ana = User.objects.get(username='ana')
+        self.assertEqual((ana.department.code, ana.role), ('COE', 'unit_head'))
+        self.assertTrue(ana.check_password('Secret-123'))
+        self.assertEqual(User.objects.get(username='ben').role, 'admin')
+
+    def test_duplicate_usernames_and_emails_are_rejected(self):
+        result = self.run_import([
+            'cas_head,new@example.org,pw,,,,',
+            'ana,cas.head@EXAMPLE.org,pw,,,,',
+            'ben,ben@example.org,pw,,,,',
+            'ben,other@example.org,pw,,,,',
+            'carl,BEN@example.org,pw,,,,',
+        ])
+        self.assertEqual(self.errors(result), {
+            2: ['Username cas_head already exists'],
+            3: ['Email cas.head@example.org already exists'],
+            5: ['Username ben already exists'],
+            6: ['Email ben@example.org already exists'],
+        })
+        self.assertEqual((result['created'], result['failed']), (1, 4))
+
+    def test_taken_unit_and_bad_role_are_rejected(self):
+        result = self.run_import([
+            'ana,ana@example.org,pw,,,CAS,',
+            'ben,ben@example.org,pw,,,College of Education,',
+            'carl,carl@example.org,pw,,,coe,',
+            'dina,dina@example.org,pw,,,Nowhere,',
+            'ed,ed@example.org,pw,,,,superuser',
+        ])
+        errors = self.errors(result)
+        self.assertEqual(sorted(errors), [2, 4, 5, 6])
+        self.assertIn('existing user in this Unit', errors[2][0])
+        self.assertIn('existing user in this Unit', errors[4][0])
+        self.assertEqual(errors[5], ['Unknown unit Nowhere'])
+        self.assertEqual(errors[6], ['Unknown role superuser'])
+        self.assertEqual(User.objects.get(username='ben').department.code, 'COE')
+
+    def test_dry_run_creates_nothing(self):
+        result = self.run_import(['ana,ana@example.org,pw,,,,'], dry_run=True)
+        self.assertEqual((result['created'], result['valid']), (0, 1))
+        self.assertFalse(User.objects.filter(username='ana').exists())
+
+    def test_missing_columns(self):
+        with self.assertRaises(BulkImportError):
+            read_csv('username,password\nana,pw\n')
@@ -0,0 +1,94 @@
+"""
+Unit hierarchy stored as a closure table.
+
+``Unit.parent`` is the source of truth; ``UnitClosure`` holds one row for
+every (ancestor, descendant) pair, each unit paired with itself at depth 0.
+Any subtree is then a single indexed lookup (``ancestor_id = X``), so rollups
+join straight from the closure rows to the data instead of walking the tree.
+
+Saving a unit keeps its closure rows in step with its parent (see
+``AccountsConfig.ready``); moving a unit moves its whole subtree.
+``bulk_create``/``update`` skip signals, so code that writes units that way
+calls ``rebuild_closure()`` afterwards.
+"""
+from django.core.exceptions import ValidationError
+from django.db import transaction
+
+
+def _models(apps=None):
+    if apps is None:
+        from .models import Unit, UnitClosure
+        return Unit, UnitClosure
+    return apps.get_model('accounts', 'Unit'), apps.get_model('accounts', 'UnitClosure')
+
+
+def check_parent(unit, parent_id):
+    """Raise ``ValidationError`` if ``parent_id`` is ``unit`` or below it"""
+    from .models import UnitClosure
+
+    if parent_id is None or unit.pk is None:
+        return
+    if parent_id == unit.pk or UnitClosure.objects.filter(ancestor_id=unit.pk, descendant_id=parent_id).exists():
+        raise ValidationError({'parent': 'A unit cannot be placed under itself or one of its own sub-units'})
+
+
+def _link(UnitClosure, unit_id, parent_id):
+    rows = [UnitClosure(ancestor_id=unit_id, descendant_id=unit_id, depth=0)]
+    if parent_id:
+        for ancestor_id, depth in UnitClosure.objects.filter(descendant_id=parent_id).values_list('ancestor_id', 'depth'):
+            rows.append(UnitClosure(ancestor_id=ancestor_id, descendant_id=unit_id, depth=depth + 1))
+    UnitClosure.objects.bulk_create(rows)
+
+
+def _move(UnitClosure, unit_id, parent_id):
+    subtree = list(UnitClosure.objects.filter(ancestor_id=unit_id).values_list('descendant_id', 'depth'))
+    subtree_ids = [descendant_id for descendant_id, _ in subtree]
+    # Cut the subtree loose from its old ancestors ...
+    UnitClosure.objects.filter(descendant_id__in=subtree_ids).exclude(ancestor_id__in=subtree_ids).delete()
+    if parent_id:
+        # ... and hang it under every ancestor of the new parent
+        ancestors = list(UnitClosure.objects.filter(descendant_id=parent_id).values_list('ancestor_id', 'depth'))
+        UnitClosure.objects.bulk_create([
+            UnitClosure(ancestor_id=ancestor_id, descendant_id=descendant_id, depth=above + below + 1)
+            for ancestor_id, above in ancestors
+            for descendant_id, below in subtree
+        ])
+
+
+def sync_unit(unit):
+    """Bring the closure rows of ``unit`` in line with ``unit.parent_id``"""
+    _, UnitClosure = _models()
+    with transaction.atomic():
+        if not UnitClosure.objects.filter(ancestor_id=unit.pk, descendant_id=unit.pk).exists():
+            _link(UnitClosure, unit.pk, unit.parent_id)
+            return
+        current = UnitClosure.objects.filter(descendant_id=unit.pk, depth=1).values_list('ancestor_id', flat=True).first()
+        if current != unit.parent_id:
+            _move(UnitClosure, unit.pk, unit.parent_id)
+
+
+def rebuild_closure(apps=None, using='default'):
+    """Recreate every closure row from the parent pointers"""
+    Unit, UnitClosure = _models(apps)
+    parents = dict(Unit.objects.using(using).values_list('id', 'parent_id'))
+    rows = []
+    for unit_id in parents:
+        ancestor_id, depth, seen = unit_id, 0, set()
+        while ancestor_id is not None and ancestor_id not in seen:
+            seen.add(ancestor_id)
+            rows.append(UnitClosure(ancestor_id=ancestor_id, descendant_id=unit_id, depth=depth))
+            ancestor_id, depth = parents.get(ancestor_id), depth + 1
+    with transaction.atomic(using=using):
+        UnitClosure.objects.using(using).all().delete()
+        UnitClosure.objects.using(using).bulk_create(rows)
+    return len(rows)
+
+
+def unit_saving(sender, instance, raw=False, **kwargs):
+    if not raw:
+        check_parent(instance, instance.parent_id)
+
+
+def unit_saved(sender, instance, raw=False, **kwargs):
+    if not raw:
+        sync_unit(instance)
@@ -0,0 +1,199 @@
+"""
+Registry of organizational units.
+
+Units are rows of ``accounts.Unit``; users and OPB requests point at them by
+integer key. Every process keeps all units in memory (there are a few dozen)
+so code and name lookups never hit the database. Saving or deleting a unit
+clears this process's copy at once; other processes reload theirs after at
+most ``CACHE_TTL`` seconds.
+
+``DEFAULT_UNITS`` is seeded after every ``migrate``, new ones placed under
+their ``DEFAULT_PARENTS`` entry; units already present are left alone, so
+names and parents edited in the admin survive.
+"""
+import threading
+import time
+
+CACHE_TTL = 60  # seconds
+
+DEFAULT_UNITS = (
+    ('CAS', 'College of Arts and Sciences'),
+    ('COLLEGE_IND_TECH', 'College of Industrial Technology'),
+    ('COE', 'College of Education'),
+    ('COA', 'College of Agriculture'),
+    ('PRODUCTION_COMMERCIALIZATION', 'Production & Commercialization'),
+    ('PRODUCTION_BAO', 'Production & Business Affairs Office'),
+    ('PPSDO', 'Physical Plant & Site Development Office'),
+    ('VETERINARY_SERVICES', 'Veterinary Services'),
+    ('GUIDANCE', 'Guidance'),
+    ('RECORDS_ARCHIVES', 'Records and Archives'),
+    ('ALUMNI_AFFAIRS', 'Alumni Affairs'),
+    ('BOARD_SECRETARY', 'Board Secretary'),
+    ('MEDICAL_SERVICES', 'Medical Services Unit'),
+    ('SUPERVISING_ADMIN', 'Supervising Administrative Office'),
+    ('REGISTRAR', 'Registrar'),
+    ('CAWAYAN_CAMPUS', 'Cawayan Campus'),
+    ('BUDGET_UNIT', 'Budget Unit'),
+    ('ACCOUNTING_UNIT', 'Accounting Unit'),
+    ('CASH_UNIT', 'Cash Unit'),
+    ('SUPPLY_UNIT', 'Supply Unit'),
+    ('RECORDS_UNIT', 'Records Unit'),
+    ('HRMO_OFFICE', 'HRMO Office'),
+    ('PROCUREMENT_UNIT', 'Procurement Unit/BAC'),
+    ('SECURITY_UNIT', 'Security Unit'),
+    ('MOTORPOOL_UNIT', 'Motorpool Unit'),
+    ('LIBRARY_SERVICES', 'Library Services'),
+    ('NSTP_ROTC', 'NSTP/ROTC'),
+    ('INTERNATIONAL_RELATIONS', 'International Relations Office'),
+    ('SPORTS_CULTURAL', 'Sports and Cultural Development'),
+    ('LEGAL_SERVICES', 'Legal Services Office'),
+    ('PERSONNEL_SCHOLARSHIP', 'Personnel Scholarship Office'),
+    ('QUALITY_ASSURANCE', 'Quality Assurance Office'),
+    ('OFFICE_VPAA', 'Office of the VPAA'),
+    ('OFFICE_VPAF', 'Office of the VPAF'),
+    ('OFFICE_VPREICWKM', 'Office of the VPREICWKM'),
+    ('OFFICE_BSB', 'Office of the Board Secretary/BOT'),
+    ('PLANNING', 'Planning'),
+    ('ISO', 'ISO'),
+    ('MIS', 'MIS'),
+    ('SCUAA', 'SCUAA'),
+    ('CSC', 'CSC'),
+    ('CRCYC', 'CRCYC'),
+    ('GAD', 'GAD'),
+    ('PIO', 'PIO'),
+)
+
+# Where newly seeded units go in the hierarchy (see accounts/unit_tree.py)
+DEFAULT_PARENTS = {
+    'CAS': 'OFFICE_VPAA',
+    'COLLEGE_IND_TECH': 'OFFICE_VPAA',
+    'COE': 'OFFICE_VPAA',
+    'COA': 'OFFICE_VPAA',
+    'REGISTRAR': 'OFFICE_VPAA',
+    'LIBRARY_SERVICES': 'OFFICE_VPAA',
+    'GUIDANCE': 'OFFICE_VPAA',
+    'NSTP_ROTC': 'OFFICE_VPAA',
+    'SUPERVISING_ADMIN': 'OFFICE_VPAF',
+    'BUDGET_UNIT': 'OFFICE_VPAF',
+    'ACCOUNTING_UNIT': 'OFFICE_VPAF',
+    'CASH_UNIT': 'OFFICE_VPAF',
+    'SUPPLY_UNIT': 'OFFICE_VPAF',
+    'RECORDS_UNIT': 'OFFICE_VPAF',
+    'HRMO_OFFICE': 'OFFICE_VPAF',
+    'PROCUREMENT_UNIT': 'OFFICE_VPAF',
+    'SECURITY_UNIT': 'OFFICE_VPAF',
+    'MOTORPOOL_UNIT': 'OFFICE_VPAF',
+    'PPSDO': 'OFFICE_VPAF',
+}
+
+
+class _Registry:
+    def __init__(self, units):
+        self.units = units
+        self.by_id = {unit.id: unit for unit in units}
+        self.by_code = {unit.code: unit for unit in units}
+        self.loaded_at = time.monotonic()
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def _current():
+    global _registry
+    registry = _registry
+    if registry is None or time.monotonic() - registry.loaded_at > CACHE_TTL:
+        from .models import Unit
+        with _registry_lock:
+            registry = _registry = _Registry(list(Unit.objects.order_by('id')))
+    return registry
+
+
+def invalidate():
+    """Drop this process's cached units"""
+    global _registry
+    _registry = None
+
+
+def all_units(include_inactive=False):
+    return [unit for unit in _current().units if include_inactive or unit.is_active]
+
+
+def get_unit(key):
+    """The unit with id or code ``key``, or ``None``"""
+    registry = _current()
+    if isinstance(key, int):
+        return registry.by_id.get(key)
+    return registry.by_code.get(key)
+
+
+def unit_id(code):
+    """Id of the unit with ``code``, or ``None``"""
+    unit = _current().by_code.get(code)
+    return unit.id if unit else None
+
+
+def unit_code(unit_id):
+    unit = _current().by_id.get(unit_id)
+    return unit.code if unit else None
+
+
+def unit_name(unit_id, default='No Unit Assigned'):
+    unit = _current().by_id.get(unit_id)
+    return unit.name if unit else default
+
+
+def unit_choices(include_inactive=False):
+    """``(code, name)`` pairs for unit select boxes"""
+    return [(unit.code, unit.name) for unit in all_units(include_inactive)]
+
+
+def seed_units(using='default', apps=None, **kwargs):
+    """Create any ``DEFAULT_UNITS`` that are missing (post_migrate handler)"""
+    from .unit_tree import rebuild_closure
+
+    if apps is None:
+        from .models import Unit
+    else:
+        try:
+            Unit = apps.get_model('accounts', 'Unit')
+            apps.get_model('accounts', 'UnitClosure')
+        except LookupError:
+            # Migrated back to before units existed
+            return
+
+    units = Unit.objects.using(using)
+    existing = set(units.values_list('code', flat=True))
+    missing = [Unit(code=code, name=name) for code, name in DEFAULT_UNITS if code not in existing]
+    if missing:
+        units.bulk_create(missing, ignore_conflicts=True)
+        ids = dict(units.values_list('code', 'id'))
+        for code in (u.code for u in missing):
+            parent = DEFAULT_PARENTS.get(code)
+            if parent in ids:
+                units.filter(code=code).update(parent_id=ids[parent])
+    # bulk_create and update skip the signals that maintain the closure table
+    rebuild_closure(apps, using=using)
+    invalidate()
+
+
+def units_for_codes(apps, using, codes):
+    """
+    Map each of ``codes`` to a unit id for the migrations that turned code
+    columns into unit keys; unknown codes get a unit named after the code
+    """
+    from .unit_tree import rebuild_closure
+
+    Unit = apps.get_model('accounts', 'Unit')
+    seed_units(using=using, apps=apps)
+    ids = dict(Unit.objects.using(using).values_list('code', 'id'))
+    missing = sorted(set(codes) - set(ids))
+    if missing:
+        Unit.objects.using(using).bulk_create([Unit(code=code, name=code) for code in missing])
+        ids = dict(Unit.objects.using(using).values_list('code', 'id'))
+        rebuild_closure(apps, using=using)
+    return ids
+
+
+def unit_changed(sender, **kwargs):
+    invalidate()
@@ -0,0 +1,241 @@
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+import uuid
+from multiprocessing import Process, Queue
+
+import django
+from django.db import OperationalError, connections, transaction
+from django.db.utils import ConnectionHandler
+
+from caobp_system.database import database_config
+from caobp_system.locks import FileLock
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+ALIAS = 'benchmark'
+
+# ----------------------------------------
+# SQLite concurrency benchmark
+#
+# Simulates N unit heads submitting OPB requests while M admins load the
+# reports page, with SQLite's defaults, with the connection settings
+# database_config() ships (pragmas through init_command, BEGIN IMMEDIATE
+# through transaction_mode), and with those plus the write gate's file lock,
+# and prints reader/writer throughput. Every connection is opened by
+# Django's sqlite3 backend, so the OPTIONS take effect exactly as they do in
+# the application.
+#
+#   python benchmark_db.py --heads 20 --admins 4 --seconds 10
+# ----------------------------------------
+
+SCHEMA = """
+CREATE TABLE budget_opbrequest (
+    id TEXT PRIMARY KEY,
+    department TEXT NOT NULL,
+    fiscal_year TEXT NOT NULL,
+    status TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE TABLE budget_opbitem (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    request_id TEXT NOT NULL REFERENCES budget_opbrequest(id),
+    kra_no TEXT,
+    activities TEXT,
+    budget_amount NUMERIC NOT NULL
+);
+CREATE INDEX budget_opbitem_request_id ON budget_opbitem(request_id);
+CREATE INDEX budget_opbrequest_department ON budget_opbrequest(department);
+"""
+
+REPORT_QUERY = """
+SELECT r.department, r.status, COUNT(DISTINCT r.id), SUM(i.budget_amount)
+FROM budget_opbrequest r
+LEFT JOIN budget_opbitem i ON i.request_id = r.id
+GROUP BY r.department, r.status
+"""
+
+DEPARTMENTS = [f'UNIT_{n:02d}' for n in range(45)]
+
+
+def setup_django():
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'caobp_system.settings')
+    django.setup()
+
+
+def scenario_config(db_path, tuned):
+    """``DATABASES['default']`` as settings.py builds it, pointed at ``db_path``"""
+    from django.conf import settings
+
+    environ = dict(os.environ, DB_ENGINE='sqlite', DB_NAME=db_path, SQLITE_TUNING='1' if tuned else '0')
+    return database_config(BASE_DIR, settings.SQLITE_PRAGMAS, environ=environ)
+
+
+def connect(config):
+    """Open ``config`` through Django's sqlite3 backend under ``ALIAS``"""
+    setup_django()
+    if ALIAS in connections.settings:
+        connections[ALIAS].close()
+        del connections[ALIAS]
+    # Fills in the defaults for the remaining keys, as for settings.DATABASES
+    connections.settings[ALIAS] = ConnectionHandler({'default': config}).settings['default']
+    connection = connections[ALIAS]
+    connection.ensure_connection()
+    return connection
+
+
+def prepare_database(config, seed_requests):
+    connection = connect(config)
+    with connection.cursor() as cursor:
+        for statement in SCHEMA.split(';'):
+            if statement.strip():
+                cursor.execute(statement)
+    with transaction.atomic(using=ALIAS):
+        for _ in range(seed_requests):
+            insert_request(connection, random.choice(DEPARTMENTS))
+    with connection.cursor() as cursor:
+        cursor.execute('PRAGMA journal_mode')
+        journal_mode = cursor.fetchone()[0]
+    connection.close()
+    return journal_mode
+
+
+def insert_request(connection, department, items=5):
+    request_id = uuid.uuid4().hex
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'INSERT INTO budget_opbrequest VALUES (%s, %s, %s, %s, %s)',
+            (request_id, department, '2026', 'pending', time.time()),
+        )
+        cursor.executemany(
+            'INSERT INTO budget_opbitem (request_id, kra_no, activities, budget_amount) VALUES (%s, %s, %s, %s)',
+            [(request_id, f'KRA {n}', 'Benchmark activity ' * 8, random.randint(1000, 500000))
+             for n in range(items)],
+        )
+
+
+def head_worker(config, department, think, lock_path, deadline, results):
+    """A unit head submitting OPB requests as fast as the database allows"""
+    connection = connect(config)
+    latencies, errors = [], 0
+    while time.time() < deadline:
+        started = time.perf_counter()
+        try:
+            if lock_path:
+                with FileLock(lock_path):
+                    with transaction.atomic(using=ALIAS):
+                        insert_request(connection, department)
+            else:
+                with transaction.atomic(using=ALIAS):
+                    insert_request(connection, department)
+            latencies.append(time.perf_counter() - started)
+        except OperationalError:
+            errors += 1
+        # Pause between submissions so both scenarios see a similar write mix
+        time.sleep(random.uniform(0, 2 * think))
+    connection.close()
+    results.put(('write', latencies, errors))
+
+
+def admin_worker(config, deadline, results):
+    """An admin reloading the reports page"""
+    connection = connect(config)
+    latencies, errors = [], 0
+    while time.time() < deadline:
+        started = time.perf_counter()
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(REPORT_QUERY)
+                cursor.fetchall()
+            latencies.append(time.perf_counter() - started)
+        except OperationalError:
+            errors += 1
+    connection.close()
+    results.put(('read', latencies, errors))
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def run_scenario(label, tuned, args, gated=False):
+    with tempfile.TemporaryDirectory() as tmp:
+        config = scenario_config(os.path.join(tmp, 'bench.sqlite3'), tuned)
+        lock_path = os.path.join(tmp, 'bench.write.lock') if gated else None
+        journal_mode = prepare_database(config, args.seed)
+
+        results = Queue()
+        deadline = time.time() + args.seconds
+        workers = [
+            Process(target=head_worker, args=(config, DEPARTMENTS[n % len(DEPARTMENTS)], args.think, lock_path, deadline, results))
+            for n in range(args.heads)
+        ]
+        workers += [
+            Process(target=admin_worker, args=(config, deadline, results))
+            for _ in range(args.admins)
+        ]
+        for worker in workers:
+            worker.start()
+        collected = [results.get() for _ in workers]
+        for worker in workers:
+            worker.join()
+
+    summary = {}
+    for kind in ('write', 'read'):
+        latencies = [lat for k, lats, _ in collected if k == kind for lat in lats]
+        errors = sum(err for k, _, err in collected if k == kind)
+        summary[kind] = {
+            'ops': len(latencies),
+            'per_sec': len(latencies) / args.seconds,
+            'errors': errors,
+            'p50_ms': statistics.median(latencies) * 1000 if latencies else 0.0,
+            'p99_ms': percentile(latencies, 99) * 1000,
+        }
+
+    print(f"\n📊 {label}")
+    options = config['OPTIONS']
+    print(f"   init_command: {options.get('init_command') or '(SQLite defaults)'}")
+    print(f"   transaction_mode: {options.get('transaction_mode') or 'DEFERRED'}, journal_mode: {journal_mode}")
+    for kind, name in (('write', 'Head submissions'), ('read', 'Admin reports')):
+        row = summary[kind]
+        print(
+            f"   {name:<17} {row['per_sec']:>9.1f}/s  "
+            f"p50 {row['p50_ms']:>8.2f} ms  p99 {row['p99_ms']:>8.2f} ms  "
+            f"locked errors {row['errors']}"
+        )
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark SQLite reader/writer concurrency before and after tuning.')
+    parser.add_argument('--heads', type=int, default=20, help='Simulated unit heads submitting requests')
+    parser.add_argument('--admins', type=int, default=4, help='Simulated admins loading reports')
+    parser.add_argument('--seconds', type=float, default=10, help='Duration of each scenario')
+    parser.add_argument('--think', type=float, default=0.05, help='Average pause between a head\'s submissions, in seconds')
+    parser.add_argument('--seed', type=int, default=500, help='OPB requests created before the run')
+    args = parser.parse_args()
+
+    setup_django()
+    print(f"\n🚀 {args.heads} heads submitting while {args.admins} admins load reports ({args.seconds:g}s per scenario)")
+    before = run_scenario('Before: SQLITE_TUNING=0 (rollback journal, default pragmas)', False, args)
+    after = run_scenario('After: shipped database_config() options', True, args)
+    gated = run_scenario('After: shipped options + write gate lock', True, args, gated=True)
+
+    print("\n✅ Change against the baseline")
+    for label, summary in (('tuned', after), ('tuned + gate', gated)):
+        for kind, name in (('write', 'Head submissions'), ('read', 'Admin reports')):
+            base = before[kind]
+            print(
+                f"   {label:<13} {name:<17} throughput x{summary[kind]['per_sec'] / (base['per_sec'] or 1):.2f}  "
+                f"p99 {base['p99_ms']:.2f} -> {summary[kind]['p99_ms']:.2f} ms"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,92 @@
 from django.contrib import admin
-from .models import OPBRequest, OPBItem
+from .ceilings import recompute_committed
+from .models import (
+    ArchivedNotification, ArchivedOPBItem, ArchivedOPBRequest, BudgetCeiling, BudgetCubeCell, FiscalYearClose,
+    OPBRequest, OPBItem, OPBRequestVersion, ResponsibleUnit, StatusTransition, TurnaroundStat,
+)
 
 admin.site.register(OPBRequest)
 admin.site.register(OPBItem)
 
+
+@admin.register(BudgetCeiling)
+class BudgetCeilingAdmin(admin.ModelAdmin):
+    list_display = ('unit', 'fiscal_year', 'source_of_fund', 'ceiling', 'committed', 'remaining')
+    list_filter = ('fiscal_year',)
+    search_fields = ('unit__name', 'unit__code', 'source_of_fund')
+    readonly_fields = ('committed', 'updated_at')
+    
+    def save_model(self, request, obj, form, change):
+        obj.source_of_fund = (obj.source_of_fund or '').strip()
+        super().save_model(request, obj, form, change)
+        # Start from what the unit has already requested
+        recompute_committed([obj])
+
+
+class ArchiveAdmin(admin.ModelAdmin):
+    """Archived rows can be browsed but not changed"""
+    
+    def has_add_permission(self, request):
+        return False
+    
+    def has_change_permission(self, request, obj=None):
+        return False
+    
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(StatusTransition)
+class StatusTransitionAdmin(ArchiveAdmin):
+    list_display = ('request_id', 'department', 'from_status', 'status', 'at', 'by')
+    list_filter = ('status', 'fiscal_year')
+
+
+@admin.register(OPBRequestVersion)
+class OPBRequestVersionAdmin(ArchiveAdmin):
+    list_display = ('request_id', 'number', 'checkpoint', 'at', 'by')
+
+
+@admin.register(TurnaroundStat)
+class TurnaroundStatAdmin(ArchiveAdmin):
+    # Maintained by each decision; rebuilt with manage.py rebuild_turnaround
+    list_display = ('department', 'month', 'outcome', 'decisions', 'within_sla')
+    list_filter = ('outcome', 'month')
+
+
+@admin.register(BudgetCubeCell)
+class BudgetCubeCellAdmin(ArchiveAdmin):
+    # Maintained by each write; rebuilt with manage.py rebuild_cube
+    list_display = ('department', 'fiscal_year', 'month', 'status', 'kra_no', 'source_of_fund', 'items', 'amount')
+    list_filter = ('fiscal_year', 'status')
+
+
+@admin.register(ResponsibleUnit)
+class ResponsibleUnitAdmin(ArchiveAdmin):
+    # Parsed from the items' responsible_units; rebuilt with manage.py index_responsible_units
+    list_display = ('unit', 'item')
+    list_filter = ('unit',)
+
+
+@admin.register(FiscalYearClose)
+class FiscalYearCloseAdmin(ArchiveAdmin):
+    # Years are closed with manage.py close_fiscal_year
+    list_display = ('fiscal_year', 'closed_at', 'closed_by', 'requests', 'items', 'notifications')
+
+
+@admin.register(ArchivedOPBRequest)
+class ArchivedOPBRequestAdmin(ArchiveAdmin):
+    list_display = ('unit', 'department', 'fiscal_year', 'status', 'created_at', 'archived_at')
+    list_filter = ('fiscal_year', 'status')
+
+
+@admin.register(ArchivedOPBItem)
+class ArchivedOPBItemAdmin(ArchiveAdmin):
+    list_display = ('kra_no', 'request', 'budget_amount', 'source_of_fund')
+
+
+@admin.register(ArchivedNotification)
+class ArchivedNotificationAdmin(ArchiveAdmin):
+    list_display = ('title', 'user', 'notification_type', 'created_at')
+
 # Register your models here.
@@ -0,0 +1,177 @@
+"""
+Closing fiscal years into the archive.
+
+``manage.py close_fiscal_year 2025`` records the year as closed (so no more
+requests can be submitted for it) and then moves its OPB requests, their
+items and the notifications about them into the ``Archived*`` tables.
+Notifications that concern no request stay where they are. Rows move in batches of ``batch_size``, each batch
+copied and deleted in one short write transaction, so a close can be
+interrupted and simply run again.
+
+The hot tables then only hold the open years that day-to-day pages work
+with. Archived rows are read-only (their ``save()`` and ``delete()``
+raise) and keep the same field names as the originals, so the reports and
+their exports run unchanged over ``report_requests(fiscal_year)``.
+
+Indexes that hang off the hot items are not archived: the responsibility
+index (``ResponsibleUnit``) and the similarity signatures and buckets are
+deleted with the items, so a closed year no longer shows up in a unit's
+responsibilities or in duplicate searches. The status history, the
+versions and the cube are keyed by request id or year and keep it.
+"""
+from contextlib import nullcontext
+
+from django.db import connection
+from django.db.models import Q
+from django.utils import timezone
+
+from caobp_system.write_gate import get_write_gate, serialized_atomic, write_gate_enabled
+
+from .head_stats import invalidate_unit
+from .models import (
+    ArchivedNotification, ArchivedOPBItem, ArchivedOPBRequest, FiscalYearClose, Notification, OPBItem,
+    OPBRequest, current_fiscal_year,
+)
+
+# Choice in the reports' fiscal year filter for every closed year at once
+ALL_ARCHIVED = 'archive'
+
+
+class ArchiveError(Exception):
+    """Raised when a fiscal year cannot be closed"""
+
+
+def closed_fiscal_years():
+    return list(FiscalYearClose.objects.values_list('fiscal_year', flat=True))
+
+
+def is_closed(fiscal_year):
+    return FiscalYearClose.objects.filter(fiscal_year=fiscal_year).exists()
+
+
+def check_open(fiscal_year):
+    """Raise ``ArchiveError`` if requests can no longer be filed for ``fiscal_year``"""
+    if is_closed(fiscal_year):
+        raise ArchiveError(f'Fiscal year {fiscal_year} is closed')
+
+
+def open_fiscal_years():
+    """Fiscal years that still have requests in the hot tables, newest first"""
+    years = set(OPBRequest.objects.order_by().values_list('fiscal_year', flat=True).distinct())
+    years.add(current_fiscal_year())
+    return sorted(years, reverse=True)
+
+
+def report_requests(fiscal_year=''):
+    """
+    OPB requests to report on: the archive for a closed year (or
+    ``ALL_ARCHIVED``), otherwise the open years, narrowed to
+    ``fiscal_year`` when given.
+    """
+    if fiscal_year == ALL_ARCHIVED:
+        return ArchivedOPBRequest.objects.select_related('department_head').all()
+    if fiscal_year and is_closed(fiscal_year):
+        return ArchivedOPBRequest.objects.select_related('department_head').filter(fiscal_year=fiscal_year)
+    opb_requests = OPBRequest.objects.select_related('department_head').all()
+    if fiscal_year:
+        opb_requests = opb_requests.filter(fiscal_year=fiscal_year)
+    return opb_requests
+
+
+# Closing ----------------------------------------------------------------
+
+def _copy(queryset, archive_model, archived_at):
+    """Insert archive rows with the same primary keys and values"""
+    names = [f.attname for f in queryset.model._meta.concrete_fields]
+    rows = [archive_model(archived_at=archived_at, **row) for row in queryset.values(*names)]
+    archive_model.objects.bulk_create(rows)
+    return len(rows)
+
+
+def _move_requests(fiscal_year, batch_size, archived_at):
+    with serialized_atomic():
+        ids = list(OPBRequest.objects.filter(fiscal_year=fiscal_year)
+                   .order_by('pk').values_list('pk', flat=True)[:batch_size])
+        if not ids:
+            return 0, 0
+        units = set(OPBRequest.objects.filter(pk__in=ids).values_list('department_id', flat=True))
+        requests = _copy(OPBRequest.objects.filter(pk__in=ids), ArchivedOPBRequest, archived_at)
+        items = _copy(OPBItem.objects.filter(request_id__in=ids), ArchivedOPBItem, archived_at)
+        OPBItem.objects.filter(request_id__in=ids).delete()
+        OPBRequest.objects.filter(pk__in=ids).delete()
+        # The head dashboards only count the hot tables
+        for unit_id in units:
+            invalidate_unit(unit_id)
+    return requests, items
+
+
+def _move_notifications(fiscal_year, batch_size, archived_at):
+    # The requests may be in either table while the year is being closed
+    about_year = (Q(request_id__in=OPBRequest.objects.filter(fiscal_year=fiscal_year).values('pk'))
+                  | Q(request_id__in=ArchivedOPBRequest.objects.filter(fiscal_year=fiscal_year).values('pk')))
+    with serialized_atomic():
+        ids = list(Notification.objects.filter(about_year)
+                   .order_by('pk').values_list('pk', flat=True)[:batch_size])
+        if ids:
+            _copy(Notification.objects.filter(pk__in=ids), ArchivedNotification, archived_at)
+            Notification.objects.filter(pk__in=ids).delete()
+    return len(ids)
+
+
+def compact_database():
+    """Give the space freed by a close back to the file system (SQLite only)"""
+    if connection.vendor != 'sqlite':
+        return
+    # VACUUM cannot run inside a transaction, so hold the write gate's slot
+    # without opening one; live writers queue behind it instead of failing
+    # with SQLITE_BUSY
+    with get_write_gate().admit() if write_gate_enabled() else nullcontext():
+        with connection.cursor() as cursor:
+            cursor.execute('VACUUM')
+            cursor.execute('ANALYZE')
+
+
+def close_fiscal_year(fiscal_year, closed_by='', batch_size=500, force=False, progress=None):
+    """
+    Close ``fiscal_year`` and move its rows to the archive.
+
+    Refuses the current fiscal year and later ones unless ``force`` is set.
+    Returns the ``FiscalYearClose`` record and the rows this run moved.
+    """
+    fiscal_year = str(fiscal_year).strip()
+    if not (len(fiscal_year) == 4 and fiscal_year.isdigit()):
+        raise ArchiveError(f'{fiscal_year!r} is not a fiscal year')
+    if fiscal_year >= current_fiscal_year() and not force:
+        raise ArchiveError(f'{fiscal_year} is not before the current fiscal year {current_fiscal_year()}')
+
+    # Closed first, so nothing new is submitted for the year while it moves
+    with serialized_atomic():
+        record, _ = FiscalYearClose.objects.get_or_create(fiscal_year=fiscal_year, defaults={'closed_by': closed_by})
+
+    archived_at = timezone.now()
+    moved = {'requests': 0, 'items': 0, 'notifications': 0}
+    while True:
+        requests, items = _move_requests(fiscal_year, batch_size, archived_at)
+        if not requests:
+            break
+        moved['requests'] += requests
+        moved['items'] += items
+        if progress:
+            progress(moved)
+
+    while True:
+        notifications = _move_notifications(fiscal_year, batch_size, archived_at)
+        if not notifications:
+            break
+        moved['notifications'] += notifications
+        if progress:
+            progress(moved)
+
+    with serialized_atomic():
+        FiscalYearClose.objects.filter(pk=record.pk).update(
+            requests=ArchivedOPBRequest.objects.filter(fiscal_year=fiscal_year).count(),
+            items=ArchivedOPBItem.objects.filter(request__fiscal_year=fiscal_year).count(),
+            notifications=record.notifications + moved['notifications'],
+        )
+    record.refresh_from_db()
+    return record, moved
@@ -0,0 +1,454 @@
+"""
+Backend-aware database backup and restore.
+
+SQLite backups are taken with SQLite's online backup API; PostgreSQL backups
+are ``pg_dump`` archives restored with ``pg_restore``. Views talk to the
+strategy returned by ``get_backup_strategy()`` and never to the files or
+tools directly.
+
+With ``BACKUP_INCREMENTAL`` on, SQLite backups are split into chunks and kept
+in the deduplicating store in ``budget/backup_store.py``; each backup is then
+a manifest rather than a file, and ``open_backup()`` reassembles it.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import subprocess
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+from django.conf import settings
+from django.db import connections
+
+from caobp_system.locks import FileLock, LockTimeout
+from caobp_system.maintenance import DrainTimeout, maintenance
+
+from .backup_catalog import record_backup, record_restore, remove_backup
+from .backup_store import ChunkStore, LocalFile
+
+
+class BackupError(Exception):
+    """Raised when a backup or restore cannot be completed"""
+
+
+def file_checksum(path, chunk_size=1024 * 1024):
+    """SHA-256 of a file, read in chunks"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def backup_dir():
+    path = str(getattr(settings, 'BACKUP_DIR', os.path.join(settings.BASE_DIR, 'backups')))
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def backup_store():
+    return ChunkStore(
+        os.path.join(backup_dir(), 'store'),
+        chunk_size=getattr(settings, 'BACKUP_CHUNK_SIZE', 256 * 1024),
+    )
+
+
+class BackupStrategy:
+    vendor = None
+    extension = None
+    label = None
+    # Whether backups of this kind deduplicate well in the chunk store.
+    # pg_dump archives are compressed, so one change shifts every chunk.
+    chunked = False
+
+    def __init__(self, alias='default'):
+        self.alias = alias
+        self.settings_dict = settings.DATABASES[alias]
+
+    def database_size(self):
+        raise NotImplementedError
+
+    def create(self, dest_path, progress=None):
+        """
+        Write a backup of the live database to ``dest_path``.
+
+        ``progress(done, total, message)`` is called as the copy advances.
+        Returns a dict of verification details for the backup metadata.
+        """
+        raise NotImplementedError
+
+    def verify(self, path):
+        """Raise ``BackupError`` unless ``path`` is a complete, readable backup"""
+        raise NotImplementedError
+
+    def restore(self, src_path):
+        """Replace the live database with the backup at ``src_path``"""
+        raise NotImplementedError
+
+
+class SQLiteBackupStrategy(BackupStrategy):
+    vendor = 'sqlite'
+    extension = '.sqlite3'
+    label = 'SQLite 3'
+    chunked = True
+
+    @property
+    def db_path(self):
+        return str(self.settings_dict['NAME'])
+
+    def database_size(self):
+        return os.path.getsize(self.db_path) if os.path.exists(self.db_path) else 0
+
+    @property
+    def pages_per_step(self):
+        return getattr(settings, 'BACKUP_STEP_PAGES', 256)
+
+    @property
+    def step_sleep(self):
+        return getattr(settings, 'BACKUP_STEP_SLEEP', 0.01)
+
+    def create(self, dest_path, progress=None):
+        if not os.path.exists(self.db_path):
+            raise BackupError('Database file not found')
+
+        tmp_path = f'{dest_path}.partial'
+        source = sqlite3.connect(self.db_path, isolation_level=None)
+        dest = sqlite3.connect(tmp_path)
+        try:
+            source.execute(f'PRAGMA busy_timeout={int(self.step_sleep * 1000) + 5000}')
+            wal = source.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+            if wal:
+                # Pin one read snapshot for the whole copy. In WAL mode this
+                # does not block writers, and no step ever has to restart.
+                source.execute('BEGIN')
+                source.execute('SELECT count(*) FROM sqlite_master').fetchone()
+
+            def on_step(status, remaining, total):
+                if progress:
+                    progress(total - remaining, total, f'Copied {total - remaining} of {total} pages')
+
+            # A limited number of pages per step, with a pause in between,
+            # so the copy never holds the database for long.
+            source.backup(dest, pages=self.pages_per_step, sleep=self.step_sleep, progress=on_step)
+            if wal:
+                source.execute('COMMIT')
+
+            integrity = [row[0] for row in dest.execute('PRAGMA integrity_check').fetchall()]
+            page_count = dest.execute('PRAGMA page_count').fetchone()[0]
+        finally:
+            dest.close()
+            source.close()
+
+        if integrity != ['ok']:
+            os.remove(tmp_path)
+            raise BackupError(f'Backup failed integrity check: {"; ".join(integrity[:5])}')
+
+        os.replace(tmp_path, dest_path)
+        return {
+            'integrity_check': 'ok',
+            'page_count': page_count,
+            'checksum_sha256': file_checksum(dest_path),
+        }
+
+    def verify(self, path):
+        conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+        try:
+            integrity = [row[0] for row in conn.execute('PRAGMA integrity_check').fetchall()]
+        except sqlite3.DatabaseError as e:
+            raise BackupError(f'Backup is not a valid SQLite database: {e}')
+        finally:
+            conn.close()
+        if integrity != ['ok']:
+            raise BackupError(f'Backup failed integrity check: {"; ".join(integrity[:5])}')
+
+    def restore(self, src_path):
+        # Copy the backup into the live database with the backup API rather
+        # than renaming a file over it. The copy is one write transaction,
+        # so it goes through SQLite's own locking and WAL: connections other
+        # workers still hold see either the old or the new database, never a
+        # mix, and readers are not blocked while it runs.
+        connections[self.alias].close()
+        source = sqlite3.connect(f'file:{src_path}?mode=ro', uri=True)
+        dest = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            source.backup(dest)
+        finally:
+            dest.close()
+            source.close()
+
+
+class PostgresBackupStrategy(BackupStrategy):
+    vendor = 'postgresql'
+    extension = '.dump'
+    label = 'PostgreSQL'
+
+    def _connection_args(self):
+        s = self.settings_dict
+        args = ['--dbname', s['NAME']]
+        if s.get('HOST'):
+            args += ['--host', s['HOST']]
+        if s.get('PORT'):
+            args += ['--port', str(s['PORT'])]
+        if s.get('USER'):
+            args += ['--username', s['USER']]
+        return args
+
+    def _run(self, command):
+        env = os.environ.copy()
+        if self.settings_dict.get('PASSWORD'):
+            env['PGPASSWORD'] = self.settings_dict['PASSWORD']
+        try:
+            result = subprocess.run(command, env=env, capture_output=True, text=True)
+        except FileNotFoundError:
+            raise BackupError(f'{command[0]} was not found on PATH')
+        if result.returncode != 0:
+            raise BackupError(result.stderr.strip() or f'{command[0]} exited with {result.returncode}')
+
+    def database_size(self):
+        with connections[self.alias].cursor() as cursor:
+            cursor.execute('SELECT pg_database_size(current_database())')
+            return cursor.fetchone()[0]
+
+    def create(self, dest_path, progress=None):
+        tmp_path = f'{dest_path}.partial'
+        if progress:
+            progress(0, 1, 'Running pg_dump')
+        self._run(['pg_dump', '--format=custom', '--no-owner', '--file', tmp_path] + self._connection_args())
+        # Reading the archive's table of contents checks that it is complete
+        self.verify(tmp_path)
+        os.replace(tmp_path, dest_path)
+        return {
+            'integrity_check': 'ok',
+            'checksum_sha256': file_checksum(dest_path),
+        }
+
+    def verify(self, path):
+        self._run(['pg_restore', '--list', path])
+
+    def restore(self, src_path):
+        connections[self.alias].close()
+        self._run(
+            ['pg_restore', '--clean', '--if-exists', '--no-owner', '--single-transaction']
+            + self._connection_args() + [src_path]
+        )
+
+
+BACKUP_STRATEGIES = {
+    'sqlite': SQLiteBackupStrategy,
+    'postgresql': PostgresBackupStrategy,
+}
+
+BACKUP_EXTENSIONS = tuple(strategy.extension for strategy in BACKUP_STRATEGIES.values())
+
+
+def get_backup_strategy(alias='default'):
+    vendor = connections[alias].vendor
+    try:
+        return BACKUP_STRATEGIES[vendor](alias)
+    except KeyError:
+        raise BackupError(f'Backups are not supported for the {vendor} backend')
+
+
+def metadata_path_for(backup_path):
+    base, _ = os.path.splitext(backup_path)
+    return f'{base}_metadata.json'
+
+
+def read_backup_metadata(backup_path):
+    """Metadata written alongside a backup, or ``{}`` if there is none"""
+    try:
+        with open(metadata_path_for(backup_path)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def incremental_backups_enabled(strategy):
+    return strategy.chunked and getattr(settings, 'BACKUP_INCREMENTAL', True)
+
+
+def list_backups():
+    """Names of all backups, newest first, whether stored whole or chunked"""
+    path = backup_dir()
+    modified = {
+        f: os.path.getmtime(os.path.join(path, f))
+        for f in os.listdir(path) if f.endswith(BACKUP_EXTENSIONS)
+    }
+    store = backup_store()
+    for name in store.names():
+        modified[name] = os.path.getmtime(store.manifest_path(name))
+    return sorted(modified, key=modified.get, reverse=True)
+
+
+def open_backup(name):
+    """
+    The backup called ``name`` as a source with ``size``, ``iter_range()``
+    and ``materialize()``, or ``None`` if there is no such backup.
+    """
+    name = os.path.basename(name)
+    if not name.endswith(BACKUP_EXTENSIONS):
+        return None
+    path = os.path.join(backup_dir(), name)
+    if os.path.exists(path):
+        return LocalFile(path)
+    store = backup_store()
+    if store.exists(name):
+        return store.open(name)
+    return None
+
+
+def delete_backup(name):
+    """
+    Delete a backup and its metadata. Chunks no other backup uses are
+    garbage collected. Returns ``False`` if nothing was found.
+    """
+    name = os.path.basename(name)
+    path = os.path.join(backup_dir(), name)
+    deleted_any = backup_store().delete(name)
+    for existing in (path, metadata_path_for(path)):
+        if os.path.exists(existing):
+            os.remove(existing)
+            deleted_any = True
+    remove_backup(name)
+    return deleted_any
+
+
+@contextmanager
+def _backup_lock():
+    # Held by every backup and restore, in every worker
+    lock = FileLock(os.path.join(backup_dir(), '.backup.lock'))
+    try:
+        lock.acquire(timeout=0)
+    except LockTimeout:
+        raise BackupError('Another backup or restore is already running')
+    try:
+        yield
+    finally:
+        lock.release()
+
+
+def create_backup(created_by, progress=None, prefix='caobp_backup'):
+    """
+    Take a backup of the default database into the backup directory.
+
+    Writes ``<name>_metadata.json`` next to the backup and returns the
+    metadata, including the integrity check result and SHA-256 checksum.
+    Raises ``BackupError`` if another backup or restore is already running.
+    """
+    with _backup_lock():
+        return _create_backup(created_by, progress, prefix)
+
+
+def _create_backup(created_by, progress, prefix):
+    from accounts.models import User
+    from .models import OPBRequest
+
+    strategy = get_backup_strategy()
+    started = time.monotonic()
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    backup_filename = f'{prefix}_{timestamp}{strategy.extension}'
+    backup_path = os.path.join(backup_dir(), backup_filename)
+
+    if incremental_backups_enabled(strategy):
+        # Take a consistent snapshot, then keep only the chunks that
+        # changed since earlier backups.
+        store = backup_store()
+        snapshot_path = os.path.join(store.root, f'{backup_filename}.snapshot')
+        try:
+            verification = strategy.create(snapshot_path, progress=progress)
+            if progress:
+                progress(1, 1, 'Storing changed chunks')
+            manifest = store.ingest(snapshot_path, backup_filename)
+        finally:
+            if os.path.exists(snapshot_path):
+                os.remove(snapshot_path)
+        backup_size = manifest['size']
+        storage = {
+            'storage': 'chunked',
+            'stored_bytes': manifest['new_bytes'],
+            'new_chunks': manifest['new_chunks'],
+            'total_chunks': len(manifest['chunks']),
+        }
+    else:
+        verification = strategy.create(backup_path, progress=progress)
+        backup_size = os.path.getsize(backup_path)
+        storage = {'storage': 'file', 'stored_bytes': backup_size}
+
+    metadata = {
+        'filename': backup_filename,
+        'created_at': datetime.now().isoformat(),
+        'created_by': created_by,
+        'database_engine': strategy.vendor,
+        'database_size': strategy.database_size(),
+        'backup_size': backup_size,
+        'duration_seconds': round(time.monotonic() - started, 3),
+        'total_users': User.objects.count(),
+        'total_opb_requests': OPBRequest.objects.count(),
+        **storage,
+        **verification,
+    }
+    with open(metadata_path_for(backup_path), 'w') as f:
+        json.dump(metadata, f, indent=2)
+    record_backup(metadata)
+    return metadata
+
+
+def restore_backup(name, restored_by):
+    """
+    Replace the live database with backup ``name`` without downtime for
+    readers.
+
+    The backup is reassembled and verified first, while the site runs
+    normally. Then writes are blocked (maintenance mode), in-flight writes
+    are drained, a safety backup of the current database is taken and the
+    backup is swapped in. Returns the timings of each phase in seconds.
+    """
+    strategy = get_backup_strategy()
+    name = os.path.basename(name)
+    if not name.endswith(strategy.extension):
+        raise BackupError(f'This backup was not taken from a {strategy.label} database')
+    backup = open_backup(name)
+    if backup is None:
+        raise BackupError('Backup file not found')
+
+    with _backup_lock():
+        started = time.monotonic()
+        # Chunked backups are reassembled into a full file first
+        restore_path = os.path.join(backup_dir(), f'{name}.restore')
+        try:
+            try:
+                src_path = backup.materialize(restore_path)
+            except ValueError as e:
+                raise BackupError(str(e))
+            strategy.verify(src_path)
+            timings = {'prepare_seconds': round(time.monotonic() - started, 3)}
+
+            blocked = time.monotonic()
+            try:
+                with maintenance(f'Restoring {name}') as drain:
+                    timings.update(drain)
+                    step = time.monotonic()
+                    safety_backup = os.path.join(
+                        backup_dir(),
+                        f"pre_restore_{datetime.now().strftime('%Y%m%d_%H%M%S')}{strategy.extension}.bak"
+                    )
+                    strategy.create(safety_backup)
+                    timings['safety_backup_seconds'] = round(time.monotonic() - step, 3)
+
+                    step = time.monotonic()
+                    strategy.restore(src_path)
+                    timings['swap_seconds'] = round(time.monotonic() - step, 3)
+            except DrainTimeout as e:
+                raise BackupError(str(e))
+            timings['writes_blocked_seconds'] = round(time.monotonic() - blocked, 3)
+        finally:
+            # Opening a WAL-mode copy, even read-only, creates -wal/-shm files
+            for path in (restore_path, f'{restore_path}-wal', f'{restore_path}-shm'):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    timings['total_seconds'] = round(time.monotonic() - started, 3)
+    record_restore(name, restored_by, timings)
+    return timings
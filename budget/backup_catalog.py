@@ -0,0 +1,103 @@
+"""
+Catalog of database backups.
+
+Every backup's metadata is kept in one JSON file, ``BACKUP_DIR/catalog.json``,
+so the settings page can list backups with a single read instead of scanning
+the backup directory. It is a file rather than a table because restoring a
+backup replaces the tables, and the catalog has to describe the backups
+that exist on disk, not the ones that existed when the backup was taken.
+
+``create_backup()``, ``delete_backup()`` and restores keep it up to date; if
+the file goes missing it is rebuilt from the per-backup metadata files.
+"""
+import json
+import os
+from datetime import datetime
+
+from caobp_system.locks import FileLock
+
+CATALOG_VERSION = 1
+
+
+def _catalog_path():
+    from .backup import backup_dir
+    return os.path.join(backup_dir(), 'catalog.json')
+
+
+def _lock():
+    return FileLock(f'{_catalog_path()}.lock')
+
+
+def _read():
+    with open(_catalog_path()) as f:
+        catalog = json.load(f)
+    return catalog.get('backups', {})
+
+
+def _write(backups):
+    tmp_path = f'{_catalog_path()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'version': CATALOG_VERSION, 'backups': backups}, f, indent=2, default=str)
+    os.replace(tmp_path, _catalog_path())
+
+
+def _scan():
+    from .backup import backup_dir, list_backups, read_backup_metadata
+
+    backups = {}
+    for name in list_backups():
+        metadata = read_backup_metadata(os.path.join(backup_dir(), name))
+        backups[name] = {'filename': name, **metadata}
+    return backups
+
+
+def rebuild_catalog():
+    """Recreate the catalog from the backups and metadata files on disk"""
+    with _lock():
+        backups = _scan()
+        _write(backups)
+    return backups
+
+
+def load_catalog():
+    """All catalog entries by filename"""
+    try:
+        return _read()
+    except (OSError, ValueError):
+        return rebuild_catalog()
+
+
+def catalog_entries():
+    """Catalog entries, newest first"""
+    return sorted(load_catalog().values(), key=lambda e: e.get('created_at') or '', reverse=True)
+
+
+def _update(func):
+    with _lock():
+        try:
+            backups = _read()
+        except (OSError, ValueError):
+            backups = _scan()
+        func(backups)
+        _write(backups)
+
+
+def record_backup(metadata):
+    """Add or replace the entry for a newly created backup"""
+    def add(backups):
+        backups[metadata['filename']] = dict(metadata)
+    _update(add)
+
+
+def remove_backup(name):
+    _update(lambda backups: backups.pop(name, None))
+
+
+def record_restore(name, restored_by, timings=None):
+    """Note on the entry that the live database was restored from it"""
+    def mark(backups):
+        if name in backups:
+            backups[name]['last_restored_at'] = datetime.now().isoformat()
+            backups[name]['last_restored_by'] = restored_by
+            backups[name]['last_restore_timings'] = timings or {}
+    _update(mark)
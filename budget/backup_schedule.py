@@ -0,0 +1,304 @@
+"""
+Scheduled backups with grandfather-father-son retention.
+
+``BACKUP_SCHEDULE['CRON']`` is a five-field cron expression (minute, hour,
+day of month, month, day of week). The scheduler runs either as
+``manage.py run_backup_scheduler`` or, with ``BACKUP_SCHEDULE['ENABLED']``
+and ``BACKUP_SCHEDULE['IN_PROCESS']``, on a daemon thread in the web
+workers. Only one scheduler in the deployment is active at a time: the
+first to take the leader lock runs the schedule, the others stand by and
+take over if it exits. Runs also agree on each slot through a file lock and
+the status file, and ``create_backup()`` holds its own lock, so two backups
+never run at once.
+
+After each scheduled backup, older scheduled backups are pruned so that only
+the newest backup of each of the last N hours, days, weeks and months is
+kept. Backups taken by hand are never pruned.
+"""
+import json
+import logging
+import os
+import threading
+from datetime import datetime, timedelta
+
+from django.conf import settings
+
+from caobp_system.locks import FileLock, LockTimeout
+from caobp_system.maintenance import maintenance_active
+
+from .backup import BackupError, backup_dir, create_backup, delete_backup
+from .backup_catalog import load_catalog
+
+logger = logging.getLogger(__name__)
+
+SCHEDULED_PREFIX = 'scheduled_backup'
+
+# Seconds a standby scheduler waits between attempts to become the leader
+LEADER_RETRY = 60
+
+DEFAULT_RETENTION = {'hourly': 24, 'daily': 7, 'weekly': 4, 'monthly': 12}
+
+# (name, lowest, highest) for each cron field
+CRON_FIELDS = (
+    ('minute', 0, 59),
+    ('hour', 0, 23),
+    ('day', 1, 31),
+    ('month', 1, 12),
+    ('weekday', 0, 7),  # 0 and 7 are both Sunday
+)
+
+
+def schedule_config():
+    return getattr(settings, 'BACKUP_SCHEDULE', {})
+
+
+# Cron ---------------------------------------------------------------------
+
+def _parse_field(text, lowest, highest, name):
+    values = set()
+    for part in text.split(','):
+        step = 1
+        if '/' in part:
+            part, step_text = part.split('/', 1)
+            step = int(step_text)
+            if step < 1:
+                raise ValueError(f'Invalid step in cron {name} field: {text}')
+        if part == '*':
+            start, end = lowest, highest
+        elif '-' in part:
+            start, end = (int(v) for v in part.split('-', 1))
+        else:
+            start = int(part)
+            end = highest if step > 1 else start
+        if start < lowest or end > highest or start > end:
+            raise ValueError(f'Cron {name} field out of range: {text}')
+        values.update(range(start, end + 1, step))
+    if name == 'weekday':
+        values = {value % 7 for value in values}
+    return frozenset(values)
+
+
+class CronSchedule:
+    """A five-field cron expression, e.g. ``'0 */6 * * *'``"""
+
+    def __init__(self, expression):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f'Cron expression needs 5 fields, got {len(fields)}: {expression!r}')
+        self.expression = expression
+        for text, (name, lowest, highest) in zip(fields, CRON_FIELDS):
+            setattr(self, name, _parse_field(text, lowest, highest, name))
+        # As in cron, a restricted day of month and day of week are OR-ed
+        self._day_restricted = fields[2] != '*'
+        self._weekday_restricted = fields[4] != '*'
+
+    def _day_matches(self, dt):
+        in_day = dt.day in self.day
+        in_weekday = (dt.isoweekday() % 7) in self.weekday
+        if self._day_restricted and self._weekday_restricted:
+            return in_day or in_weekday
+        return in_day and in_weekday
+
+    def matches(self, dt):
+        return (dt.minute in self.minute and dt.hour in self.hour
+                and dt.month in self.month and self._day_matches(dt))
+
+    def next_after(self, dt):
+        """The first matching minute strictly after ``dt``"""
+        dt = dt.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = dt + timedelta(days=366 * 4)
+        while dt < limit:
+            if dt.month not in self.month or not self._day_matches(dt):
+                dt = dt.replace(hour=0, minute=0) + timedelta(days=1)
+            elif dt.hour not in self.hour:
+                dt = dt.replace(minute=0) + timedelta(hours=1)
+            elif dt.minute not in self.minute:
+                dt += timedelta(minutes=1)
+            else:
+                return dt
+        raise ValueError(f'Cron expression never matches: {self.expression!r}')
+
+
+# Retention --------------------------------------------------------------
+
+def _bucket_keys(dt):
+    iso_year, iso_week, _ = dt.isocalendar()
+    return {
+        'hourly': (dt.year, dt.month, dt.day, dt.hour),
+        'daily': (dt.year, dt.month, dt.day),
+        'weekly': (iso_year, iso_week),
+        'monthly': (dt.year, dt.month),
+    }
+
+
+def gfs_keep(backups, retention=None):
+    """
+    Names to keep from ``backups``, a list of ``(name, datetime)``.
+
+    The newest backup in each of the last ``retention[period]`` hours, days,
+    weeks and months is kept; a backup kept for any period survives.
+    """
+    retention = retention or DEFAULT_RETENTION
+    keep = set()
+    seen = {period: set() for period in retention}
+    for name, taken_at in sorted(backups, key=lambda b: b[1], reverse=True):
+        for period, key in _bucket_keys(taken_at).items():
+            limit = retention.get(period, 0)
+            if key not in seen.get(period, ()) and len(seen.get(period, ())) < limit:
+                seen[period].add(key)
+                keep.add(name)
+    return keep
+
+
+def _taken_at(name):
+    stem = os.path.splitext(name)[0][len(SCHEDULED_PREFIX) + 1:]
+    try:
+        return datetime.strptime(stem, '%Y%m%d_%H%M%S')
+    except ValueError:
+        return None
+
+
+def prune_scheduled_backups(retention=None):
+    """Delete scheduled backups the retention policy no longer keeps"""
+    scheduled = []
+    for name in load_catalog():
+        taken_at = _taken_at(name) if name.startswith(f'{SCHEDULED_PREFIX}_') else None
+        if taken_at is not None:
+            scheduled.append((name, taken_at))
+    keep = gfs_keep(scheduled, retention or schedule_config().get('RETENTION'))
+    pruned = [name for name, _ in scheduled if name not in keep]
+    for name in pruned:
+        delete_backup(name)
+    return pruned
+
+
+# Status -------------------------------------------------------------------
+
+def _status_path():
+    return os.path.join(backup_dir(), 'schedule_status.json')
+
+
+def read_schedule_status():
+    """Status of the last scheduled run, or ``{}`` if none has run yet"""
+    try:
+        with open(_status_path()) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_schedule_status(status):
+    tmp_path = f'{_status_path()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(status, f, indent=2, default=str)
+    os.replace(tmp_path, _status_path())
+
+
+# Running ------------------------------------------------------------------
+
+def run_scheduled_backup(slot=None):
+    """
+    Take the backup for ``slot`` (a datetime) and prune old backups.
+
+    Returns the new status, or ``None`` if another worker already took or is
+    taking the backup for this slot.
+    """
+    slot = (slot or datetime.now()).replace(second=0, microsecond=0)
+    lock = FileLock(os.path.join(backup_dir(), '.schedule.lock'))
+    try:
+        lock.acquire(timeout=0)
+    except LockTimeout:
+        return None
+
+    try:
+        previous = read_schedule_status()
+        if previous.get('last_slot') == slot.isoformat():
+            return None
+
+        status = {
+            'last_slot': slot.isoformat(),
+            'started_at': datetime.now().isoformat(),
+            'schedule': schedule_config().get('CRON'),
+        }
+        try:
+            if maintenance_active():
+                # A restore is running; skip this slot rather than fail it
+                status.update(state='skipped', error='Skipped while the database was being restored')
+            else:
+                metadata = create_backup('scheduler', prefix=SCHEDULED_PREFIX)
+                status.update(state='succeeded', filename=metadata['filename'],
+                              duration_seconds=metadata['duration_seconds'],
+                              pruned=prune_scheduled_backups())
+        except BackupError as e:
+            status.update(state='failed', error=str(e))
+        except Exception as e:
+            logger.exception('Scheduled backup failed')
+            status.update(state='failed', error=str(e))
+        status['finished_at'] = datetime.now().isoformat()
+        if status.get('schedule'):
+            status['next_run'] = CronSchedule(status['schedule']).next_after(datetime.now()).isoformat()
+        _write_schedule_status(status)
+        return status
+    finally:
+        lock.release()
+
+
+def acquire_leadership(stop_event):
+    """
+    Block until this process holds the scheduler leader lock and return
+    it, or return ``None`` once ``stop_event`` is set.
+    """
+    lock = FileLock(os.path.join(backup_dir(), '.scheduler.lock'))
+    while not stop_event.is_set():
+        try:
+            return lock.acquire(timeout=0)
+        except LockTimeout:
+            stop_event.wait(LEADER_RETRY)
+    return None
+
+
+def run_scheduler(stop_event=None, expression=None):
+    """Run scheduled backups until ``stop_event`` is set, once elected leader"""
+    schedule = CronSchedule(expression or schedule_config().get('CRON', '0 * * * *'))
+    stop_event = stop_event or threading.Event()
+    leader = acquire_leadership(stop_event)
+    if leader is None:
+        return
+    try:
+        _run_schedule(schedule, stop_event)
+    finally:
+        leader.release()
+
+
+def _run_schedule(schedule, stop_event):
+    while not stop_event.is_set():
+        slot = schedule.next_after(datetime.now())
+        # Sleep in short steps so clock changes and stop requests are noticed
+        while not stop_event.is_set() and datetime.now() < slot:
+            stop_event.wait(min(30.0, max(0.0, (slot - datetime.now()).total_seconds())))
+        if stop_event.is_set():
+            break
+        try:
+            run_scheduled_backup(slot)
+        except Exception:
+            logger.exception('Backup scheduler run failed')
+
+
+_scheduler_thread = None
+_scheduler_thread_lock = threading.Lock()
+
+
+def start_scheduler_thread():
+    """
+    Start the in-process scheduler in this worker, if it is enabled. Every
+    worker starts one, but only the elected leader takes backups.
+    """
+    global _scheduler_thread
+    config = schedule_config()
+    if not (config.get('ENABLED') and config.get('IN_PROCESS')):
+        return None
+    with _scheduler_thread_lock:
+        if _scheduler_thread is None or not _scheduler_thread.is_alive():
+            _scheduler_thread = threading.Thread(target=run_scheduler, name='backup-scheduler', daemon=True)
+            _scheduler_thread.start()
+    return _scheduler_thread
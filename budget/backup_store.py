@@ -0,0 +1,199 @@
+"""
+Incremental, deduplicated backup storage.
+
+A backup is split into fixed-size chunks (a whole number of SQLite pages)
+that are stored once under their SHA-256 in a content-addressed store::
+
+    backups/store/chunks/ab/ab12...ef
+    backups/store/manifests/caobp_backup_20260101_120000.sqlite3.json
+
+The manifest lists the chunk hashes in order, so only chunks that changed
+since an earlier backup take up new space. Chunks no longer referenced by
+any manifest are removed by ``ChunkStore.collect_garbage()``.
+"""
+import hashlib
+import json
+import os
+import time
+
+from caobp_system.locks import FileLock
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+
+
+class LocalFile:
+    """A backup stored as one ordinary file"""
+
+    def __init__(self, path):
+        self.path = path
+
+    @property
+    def size(self):
+        return os.path.getsize(self.path)
+
+    def iter_range(self, start, length, chunk_size=256 * 1024):
+        with open(self.path, 'rb') as f:
+            f.seek(start)
+            while length > 0:
+                data = f.read(min(chunk_size, length))
+                if not data:
+                    break
+                length -= len(data)
+                yield data
+
+    def materialize(self, dest_path):
+        return self.path
+
+
+class ChunkedFile:
+    """A backup reassembled on the fly from the chunk store"""
+
+    def __init__(self, store, manifest):
+        self.store = store
+        self.manifest = manifest
+
+    @property
+    def size(self):
+        return self.manifest['size']
+
+    def iter_range(self, start, length, chunk_size=None):
+        chunk_size = self.manifest['chunk_size']
+        index, offset = divmod(start, chunk_size)
+        for digest in self.manifest['chunks'][index:]:
+            if length <= 0:
+                break
+            with open(self.store.chunk_path(digest), 'rb') as f:
+                f.seek(offset)
+                data = f.read(min(chunk_size - offset, length))
+            offset = 0
+            length -= len(data)
+            yield data
+
+    def materialize(self, dest_path):
+        """Write the full backup file to ``dest_path`` and return it"""
+        digest = hashlib.sha256()
+        tmp_path = f'{dest_path}.partial'
+        with open(tmp_path, 'wb') as out:
+            for data in self.iter_range(0, self.size):
+                digest.update(data)
+                out.write(data)
+        if self.manifest.get('checksum_sha256') and digest.hexdigest() != self.manifest['checksum_sha256']:
+            os.remove(tmp_path)
+            raise ValueError(f'Reassembled backup {self.manifest["name"]} does not match its checksum')
+        os.replace(tmp_path, dest_path)
+        return dest_path
+
+
+class ChunkStore:
+    def __init__(self, root, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.root = str(root)
+        self.chunk_size = chunk_size
+        self.chunk_dir = os.path.join(self.root, 'chunks')
+        self.manifest_dir = os.path.join(self.root, 'manifests')
+        os.makedirs(self.chunk_dir, exist_ok=True)
+        os.makedirs(self.manifest_dir, exist_ok=True)
+        # Serialises ingest and garbage collection across workers
+        self.lock = FileLock(os.path.join(self.root, '.lock'))
+
+    def chunk_path(self, digest):
+        return os.path.join(self.chunk_dir, digest[:2], digest)
+
+    def manifest_path(self, name):
+        return os.path.join(self.manifest_dir, f'{os.path.basename(name)}.json')
+
+    # Manifests ------------------------------------------------------------
+
+    def names(self):
+        return [f[:-len('.json')] for f in os.listdir(self.manifest_dir) if f.endswith('.json')]
+
+    def exists(self, name):
+        return os.path.exists(self.manifest_path(name))
+
+    def manifest(self, name):
+        with open(self.manifest_path(name)) as f:
+            return json.load(f)
+
+    def open(self, name):
+        return ChunkedFile(self, self.manifest(name))
+
+    # Writing --------------------------------------------------------------
+
+    def _write_chunk(self, digest, data):
+        path = self.chunk_path(digest)
+        if os.path.exists(path):
+            return False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        return True
+
+    def ingest(self, path, name):
+        """
+        Store the file at ``path`` as backup ``name``.
+
+        Returns the manifest, which also records how many chunks were new.
+        """
+        started = time.monotonic()
+        whole = hashlib.sha256()
+        chunks, new_chunks, new_bytes, size = [], 0, 0, 0
+        with self.lock:
+            with open(path, 'rb') as f:
+                for data in iter(lambda: f.read(self.chunk_size), b''):
+                    whole.update(data)
+                    digest = hashlib.sha256(data).hexdigest()
+                    if self._write_chunk(digest, data):
+                        new_chunks += 1
+                        new_bytes += len(data)
+                    chunks.append(digest)
+                    size += len(data)
+
+            manifest = {
+                'name': name,
+                'chunk_size': self.chunk_size,
+                'size': size,
+                'chunks': chunks,
+                'checksum_sha256': whole.hexdigest(),
+                'new_chunks': new_chunks,
+                'new_bytes': new_bytes,
+                'created_at': time.time(),
+                'duration_seconds': round(time.monotonic() - started, 3),
+            }
+            tmp_path = self.manifest_path(name) + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(manifest, f)
+            os.replace(tmp_path, self.manifest_path(name))
+        return manifest
+
+    def delete(self, name, collect=True):
+        path = self.manifest_path(name)
+        if not os.path.exists(path):
+            return False
+        os.remove(path)
+        if collect:
+            self.collect_garbage()
+        return True
+
+    def collect_garbage(self):
+        """Remove chunks that no manifest references; returns bytes freed"""
+        freed = 0
+        with self.lock:
+            referenced = set()
+            for name in self.names():
+                referenced.update(self.manifest(name)['chunks'])
+            for prefix in os.listdir(self.chunk_dir):
+                prefix_dir = os.path.join(self.chunk_dir, prefix)
+                for digest in os.listdir(prefix_dir):
+                    if digest not in referenced:
+                        chunk = os.path.join(prefix_dir, digest)
+                        freed += os.path.getsize(chunk)
+                        os.remove(chunk)
+        return freed
+
+    def stored_bytes(self):
+        total = 0
+        for prefix in os.listdir(self.chunk_dir):
+            prefix_dir = os.path.join(self.chunk_dir, prefix)
+            total += sum(os.path.getsize(os.path.join(prefix_dir, d)) for d in os.listdir(prefix_dir))
+        return total
@@ -0,0 +1,147 @@
+"""
+Per-unit budget ceilings.
+
+A ``BudgetCeiling`` caps what a unit may request in one fiscal year, either
+from one source of fund or, with a blank ``source_of_fund``, in total. Its
+``committed`` column is kept equal to the sum of the matching OPB items, so
+checking a submission is one conditional UPDATE per ceiling rather than a
+scan of the unit's history::
+
+    UPDATE budget_budgetceiling SET committed = committed + %s
+    WHERE id = %s AND committed <= ceiling - %s
+
+No row updated means the request does not fit, and ``CeilingExceeded`` rolls
+back the caller's transaction along with the items. Units without a ceiling
+are not capped.
+"""
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db.models import F, Sum
+
+from .models import BudgetCeiling, FiscalYearClose, OPBItem
+
+
+class CeilingExceeded(Exception):
+    """Raised when a submission would take a unit over one of its ceilings"""
+
+
+def _source(value):
+    return (value or '').strip()
+
+
+def request_amounts(opb_request):
+    """``{source of fund: total}`` for the items of ``opb_request``"""
+    amounts = defaultdict(Decimal)
+    rows = opb_request.items.order_by().values('source_of_fund').annotate(total=Sum('budget_amount'))
+    for row in rows:
+        amounts[_source(row['source_of_fund'])] += row['total'] or 0
+    return dict(amounts)
+
+
+def apply_delta(unit_id, fiscal_year, deltas):
+    """
+    Add ``deltas`` (``{source of fund: amount}``, amounts may be negative)
+    to the unit's ceilings. Must run in the transaction that writes the
+    items; raises ``CeilingExceeded`` if an increase does not fit.
+    """
+    deltas = {_source(source): Decimal(amount) for source, amount in deltas.items() if amount}
+    if not deltas:
+        return
+    total = sum(deltas.values())
+    ceilings = (BudgetCeiling.objects
+                .filter(unit_id=unit_id, fiscal_year=fiscal_year, source_of_fund__in=set(deltas) | {''})
+                .order_by('pk').values_list('pk', 'source_of_fund'))
+    for pk, source in ceilings:
+        amount = total if source == '' else deltas.get(source, 0)
+        if not amount:
+            continue
+        rows = BudgetCeiling.objects.filter(pk=pk)
+        if amount > 0:
+            rows = rows.filter(committed__lte=F('ceiling') - amount)
+        if not rows.update(committed=F('committed') + amount):
+            ceiling = BudgetCeiling.objects.get(pk=pk)
+            scope = f'from {source}' if source else 'in total'
+            raise CeilingExceeded(
+                f'This request adds ₱{amount:,.2f} {scope} for FY {fiscal_year}, but only '
+                f'₱{max(ceiling.remaining, 0):,.2f} of the unit\'s ₱{ceiling.ceiling:,.2f} ceiling remains'
+            )
+
+
+def snapshot(opb_request):
+    """What ``opb_request`` currently counts against, for ``recommit()``"""
+    return opb_request.department_id, opb_request.fiscal_year, request_amounts(opb_request)
+
+
+def commit_request(opb_request):
+    """Count a newly submitted request against its unit's ceilings"""
+    apply_delta(opb_request.department_id, opb_request.fiscal_year, request_amounts(opb_request))
+
+
+def recommit(opb_request, previous):
+    """Move the request's commitment from ``previous`` (a ``snapshot()``) to its current items"""
+    unit_id, fiscal_year, old = previous
+    new = request_amounts(opb_request)
+    if (unit_id, fiscal_year) == (opb_request.department_id, opb_request.fiscal_year):
+        sources = set(old) | set(new)
+        apply_delta(unit_id, fiscal_year, {s: new.get(s, 0) - old.get(s, 0) for s in sources})
+    else:
+        apply_delta(unit_id, fiscal_year, {s: -amount for s, amount in old.items()})
+        apply_delta(opb_request.department_id, opb_request.fiscal_year, new)
+
+
+def release_request(opb_request):
+    """Give back what a request being deleted counted against"""
+    apply_delta(opb_request.department_id, opb_request.fiscal_year,
+                {s: -amount for s, amount in request_amounts(opb_request).items()})
+
+
+def release_items(item_ids):
+    """Give back what the OPB items ``item_ids``, about to be deleted, counted against"""
+    rows = (OPBItem.objects.filter(pk__in=item_ids).order_by()
+            .values('request__department_id', 'request__fiscal_year', 'source_of_fund')
+            .annotate(total=Sum('budget_amount')))
+    grouped = defaultdict(lambda: defaultdict(Decimal))
+    for row in rows:
+        grouped[row['request__department_id'], row['request__fiscal_year']][_source(row['source_of_fund'])] -= row['total'] or 0
+    for (unit_id, fiscal_year), deltas in grouped.items():
+        apply_delta(unit_id, fiscal_year, deltas)
+
+
+def committed_total(unit_id, fiscal_year, source_of_fund=''):
+    """Sum of the unit's items a ceiling covers, from the items themselves"""
+    items = OPBItem.objects.filter(request__department_id=unit_id, request__fiscal_year=fiscal_year)
+    total = Decimal(0)
+    rows = items.order_by().values('source_of_fund').annotate(total=Sum('budget_amount'))
+    for row in rows:
+        if not source_of_fund or _source(row['source_of_fund']) == source_of_fund:
+            total += row['total'] or 0
+    return total
+
+
+def recompute_committed(ceilings=None):
+    """
+    Reset ``committed`` from the items; returns the ceilings that were off.
+    Closed fiscal years are left alone, their items are in the archive.
+    """
+    if ceilings is None:
+        ceilings = BudgetCeiling.objects.exclude(fiscal_year__in=FiscalYearClose.objects.values('fiscal_year'))
+    fixed = []
+    for ceiling in ceilings:
+        actual = committed_total(ceiling.unit_id, ceiling.fiscal_year, ceiling.source_of_fund)
+        if actual != ceiling.committed:
+            BudgetCeiling.objects.filter(pk=ceiling.pk).update(committed=actual)
+            ceiling.committed = actual
+            fixed.append(ceiling)
+    return fixed
+
+
+def remaining_balances(unit_id, fiscal_year):
+    """The unit's ceilings for ``fiscal_year`` as dicts for JSON"""
+    ceilings = BudgetCeiling.objects.filter(unit_id=unit_id, fiscal_year=fiscal_year).order_by('source_of_fund')
+    return [{
+        'source_of_fund': ceiling.source_of_fund,
+        'ceiling': ceiling.ceiling,
+        'committed': ceiling.committed,
+        'remaining': ceiling.remaining,
+    } for ceiling in ceilings]
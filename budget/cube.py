@@ -0,0 +1,197 @@
+"""
+Aggregation cube over OPB items.
+
+``BudgetCubeCell`` holds the number of items and their total budget for
+every combination of unit, fiscal year, submission month, status, KRA,
+source of fund and responsible units that occurs. Writers keep it current
+the same way they keep the budget ceilings: ``remove_from_cube()`` before a
+request's items or status change and ``add_to_cube()`` after, inside the
+same transaction, each one grouped query plus an UPDATE per touched cell.
+Archived requests stay in the cube; filter on ``fiscal_year`` to leave
+them out.
+
+``pivot()`` groups and filters the cells, never the items, so a breakdown
+costs the same however many items there are. ``manage.py rebuild_cube``
+recomputes the cells from the items.
+"""
+import time
+from datetime import date
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, DateField, F, Sum, Value
+from django.db.models.functions import Coalesce, Trim, TruncMonth
+
+from accounts.models import UnitClosure
+from accounts.units import unit_code, unit_id, unit_name
+
+from .models import ArchivedOPBItem, BudgetCubeCell, OPBItem
+
+# Pivot dimension name -> cube column
+DIMENSIONS = {
+    'unit': 'department_id',
+    'fiscal_year': 'fiscal_year',
+    'month': 'month',
+    'status': 'status',
+    'kra': 'kra_no',
+    'fund': 'source_of_fund',
+    'responsible': 'responsible_units',
+}
+CELL_FIELDS = tuple(DIMENSIONS.values())
+DIMENSION_LABELS = (
+    ('unit', 'Unit'),
+    ('fiscal_year', 'Fiscal Year'),
+    ('month', 'Month'),
+    ('status', 'Status'),
+    ('kra', 'KRA'),
+    ('fund', 'Source of Fund'),
+    ('responsible', 'Responsible Units'),
+)
+
+
+class PivotError(Exception):
+    """Raised for an unknown dimension or a bad filter value"""
+
+
+def _text(field):
+    return Coalesce(Trim(field), Value(''))
+
+
+def _contributions(items):
+    """``items`` grouped into cube cells, as dicts of the cell fields plus ``items`` and ``amount``"""
+    return (items.order_by()
+            .annotate(
+                c_department_id=F('request__department_id'),
+                c_fiscal_year=F('request__fiscal_year'),
+                c_month=TruncMonth('request__created_at', output_field=DateField()),
+                c_status=F('request__status'),
+                c_kra_no=_text('kra_no'),
+                c_source_of_fund=_text('source_of_fund'),
+                c_responsible_units=_text('responsible_units'),
+            )
+            .values(*(f'c_{name}' for name in CELL_FIELDS))
+            .annotate(c_items=Count('id'), c_amount=Sum('budget_amount')))
+
+
+def _cells(items):
+    for row in _contributions(items):
+        cell = {name: row[f'c_{name}'] for name in CELL_FIELDS}
+        yield cell, row['c_items'], row['c_amount'] or 0
+
+
+def _apply(items, sign):
+    for cell, count, amount in _cells(items):
+        changes = {'items': F('items') + sign * count, 'amount': F('amount') + sign * amount}
+        if BudgetCubeCell.objects.filter(**cell).update(**changes):
+            if sign < 0:
+                BudgetCubeCell.objects.filter(items__lte=0, **cell).delete()
+            continue
+        if sign < 0:
+            continue
+        try:
+            with transaction.atomic():
+                BudgetCubeCell.objects.create(items=count, amount=amount, **cell)
+        except IntegrityError:
+            # Created by a concurrent writer in the meantime
+            BudgetCubeCell.objects.filter(**cell).update(**changes)
+
+
+def add_to_cube(opb_request):
+    """Count the request's items, as they are now, into the cube"""
+    _apply(OPBItem.objects.filter(request_id=opb_request.pk), 1)
+
+
+def remove_from_cube(opb_request):
+    """Take the request's items, as they are now, out of the cube"""
+    _apply(OPBItem.objects.filter(request_id=opb_request.pk), -1)
+
+
+def remove_items_from_cube(item_ids, model=OPBItem):
+    """Take the items ``item_ids`` (of ``model``), about to be deleted, out of the cube"""
+    _apply(model.objects.filter(pk__in=item_ids), -1)
+
+
+def rebuild_cube():
+    """Recompute every cell from the items; returns the number of cells"""
+    cells = {}
+    for model in (OPBItem, ArchivedOPBItem):
+        for cell, count, amount in _cells(model.objects.all()):
+            key = tuple(cell[name] for name in CELL_FIELDS)
+            if key in cells:
+                cells[key].items += count
+                cells[key].amount += amount
+            else:
+                cells[key] = BudgetCubeCell(items=count, amount=amount, **cell)
+    with transaction.atomic():
+        BudgetCubeCell.objects.all().delete()
+        BudgetCubeCell.objects.bulk_create(cells.values(), batch_size=1000)
+    return len(cells)
+
+
+# Pivot ----------------------------------------------------------------------
+
+def _filter_value(dimension, value):
+    if dimension == 'unit':
+        found = unit_id(value)
+        if found is None:
+            raise PivotError(f'Unknown unit {value!r}')
+        return found
+    if dimension == 'month':
+        try:
+            year, month = (int(part) for part in value.split('-')[:2])
+            return date(year, month, 1)
+        except ValueError:
+            raise PivotError(f'Month must look like 2026-01, not {value!r}')
+    return value
+
+
+def _label(dimension, value):
+    if dimension == 'unit':
+        return {'code': unit_code(value), 'name': unit_name(value)}
+    if dimension == 'month':
+        return value.strftime('%Y-%m')
+    return value
+
+
+def pivot(group_by, filters=None, limit=None):
+    """
+    Slice and dice the cube.
+
+    ``group_by`` is a list of ``DIMENSIONS`` names (may be empty for a grand
+    total); ``filters`` maps dimension names to a value or a list of values.
+    Units are given by code and include their subunits; months are given
+    as ``YYYY-MM``. Returns ``rows`` with
+    the group values, ``items`` and ``amount``, largest amount first, and
+    the ``totals`` of all matching cells.
+    """
+    started = time.perf_counter()
+    unknown = [d for d in list(group_by) + list(filters or {}) if d not in DIMENSIONS]
+    if unknown:
+        raise PivotError(f'Unknown dimension(s): {", ".join(unknown)}. Use {", ".join(DIMENSIONS)}')
+
+    cells = BudgetCubeCell.objects.all()
+    for dimension, value in (filters or {}).items():
+        values = [_filter_value(dimension, v) for v in (value if isinstance(value, (list, tuple)) else [value])]
+        if dimension == 'unit':
+            # A unit stands for its whole subtree, as in the drilldown
+            subtree = UnitClosure.objects.filter(ancestor_id__in=values).values('descendant_id')
+            cells = cells.filter(department_id__in=subtree)
+        else:
+            cells = cells.filter(**{f'{DIMENSIONS[dimension]}__in': values})
+
+    columns = [DIMENSIONS[d] for d in group_by]
+    grouped = (cells.values(*columns).annotate(items=Sum('items'), amount=Sum('amount')).order_by('-amount')
+               if columns else [])
+    if limit:
+        grouped = grouped[:limit]
+    rows = [{
+        **{d: _label(d, row[DIMENSIONS[d]]) for d in group_by},
+        'items': row['items'],
+        'amount': row['amount'] or 0,
+    } for row in grouped]
+    totals = cells.aggregate(items=Sum('items'), amount=Sum('amount'))
+    return {
+        'group_by': list(group_by),
+        'rows': rows,
+        'totals': {'items': totals['items'] or 0, 'amount': totals['amount'] or 0},
+        'elapsed_ms': round((time.perf_counter() - started) * 1000, 2),
+    }
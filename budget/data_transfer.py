@@ -0,0 +1,488 @@
+"""
+Logical export and import of all system data as gzip-compressed NDJSON.
+
+Unlike a backup, an export does not depend on the database engine, so it can
+move data from SQLite to PostgreSQL or between installations. Each line is
+one JSON object::
+
+    {"format": "caobp-ndjson", "version": 1, "exported_at": "...", ...}
+    {"model": "accounts.user", "pk": 7, "fields": {"username": "...", ...}}
+
+Rows are read with ``QuerySet.iterator()`` and written one line at a time,
+and the import works in batches of ``bulk_create``, so memory stays flat no
+matter how large the tables are.
+
+On import, units are matched by code, users by username, budget ceilings by
+unit, year and source of fund, closed fiscal years by year and OPB requests
+(archived or not) by their UUID; existing rows are kept and references to
+them remapped. The items of a request that was already present are not
+imported again, and notifications and status transitions already present
+(same user, request, title, message and time; same request, status and
+time) are skipped, so importing a file twice adds nothing the second time.
+The import writes a checkpoint after every committed batch and resumes
+from it if restarted.
+"""
+import gzip
+import json
+import os
+from datetime import datetime, timedelta
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models.functions import Lower
+
+from caobp_system.write_gate import serialized_atomic
+
+from accounts.models import Unit, User
+from accounts.unit_tree import rebuild_closure
+from accounts.units import invalidate as invalidate_units, unit_id
+
+from .ceilings import recompute_committed
+from .cube import rebuild_cube
+from .head_stats import invalidate_unit
+from .models import (
+    ArchivedNotification, ArchivedOPBItem, ArchivedOPBRequest, BudgetCeiling, FiscalYearClose, Notification, OPBItem,
+    OPBRequest, OPBRequestVersion, StatusTransition,
+)
+from .responsibilities import reindex_all
+from .similarity import sign_all_items
+from .status_history import rebuild_turnaround
+
+FORMAT_NAME = 'caobp-ndjson'
+# Version 2 added units; version 1 files reference units by code. Version 3
+# added the archive of closed fiscal years, version 4 the status history and
+# version 5 the saved versions of requests and version 6 the budget ceilings
+FORMAT_VERSION = 6
+
+# Parents before children, so references can be remapped as rows arrive
+EXPORT_MODELS = (
+    ('accounts.unit', Unit),
+    ('accounts.user', User),
+    ('budget.budgetceiling', BudgetCeiling),
+    ('budget.opbrequest', OPBRequest),
+    ('budget.opbitem', OPBItem),
+    ('budget.notification', Notification),
+    ('budget.fiscalyearclose', FiscalYearClose),
+    ('budget.archivedopbrequest', ArchivedOPBRequest),
+    ('budget.archivedopbitem', ArchivedOPBItem),
+    ('budget.archivednotification', ArchivedNotification),
+    ('budget.statustransition', StatusTransition),
+    ('budget.opbrequestversion', OPBRequestVersion),
+)
+MODELS_BY_LABEL = dict(EXPORT_MODELS)
+
+
+class DataImportError(Exception):
+    """Raised when an export file cannot be imported"""
+
+
+def _data_fields(model):
+    return [f for f in model._meta.concrete_fields if not f.primary_key]
+
+
+def _auto_timestamp_fields(model):
+    return [f.name for f in _data_fields(model) if getattr(f, 'auto_now', False) or getattr(f, 'auto_now_add', False)]
+
+
+def _to_millisecond(value):
+    """``value`` as written to an export; ``DjangoJSONEncoder`` keeps milliseconds"""
+    return value.replace(microsecond=value.microsecond // 1000 * 1000) if value else value
+
+
+def _time_range(values):
+    """Bounds of an ``__range`` lookup covering ``values`` at millisecond precision"""
+    return min(values), max(values) + timedelta(milliseconds=1)
+
+
+# Export ---------------------------------------------------------------------
+
+def export_lines(chunk_size=2000):
+    """Yield the export as NDJSON lines (bytes), one row at a time"""
+    yield (json.dumps({
+        'format': FORMAT_NAME,
+        'version': FORMAT_VERSION,
+        'exported_at': datetime.now().isoformat(),
+        'models': [label for label, _ in EXPORT_MODELS],
+    }) + '\n').encode()
+
+    for label, model in EXPORT_MODELS:
+        fields = _data_fields(model)
+        names = [model._meta.pk.attname] + [f.attname for f in fields]
+        rows = model.objects.order_by('pk').values_list(*names).iterator(chunk_size=chunk_size)
+        for row in rows:
+            record = {'model': label, 'pk': row[0], 'fields': dict(zip(names[1:], row[1:]))}
+            yield (json.dumps(record, cls=DjangoJSONEncoder) + '\n').encode()
+
+
+def export_to_file(path, chunk_size=2000, level=6):
+    """Write a gzip-compressed export to ``path``; returns the number of rows"""
+    rows = 0
+    tmp_path = f'{path}.partial'
+    with gzip.open(tmp_path, 'wb', compresslevel=level) as f:
+        for line in export_lines(chunk_size):
+            f.write(line)
+            rows += 1
+    os.replace(tmp_path, path)
+    return rows - 1  # not counting the header
+
+
+# Import ---------------------------------------------------------------------
+
+class Importer:
+    """
+    Imports an export file in batches.
+
+    ``unit_map`` and ``user_map`` map unit and user ids in the file to ids
+    in this database, and ``present_requests`` holds the OPB requests the
+    file shares with this database, whose items are already here. They are
+    saved with each checkpoint so a resumed import carries on consistently.
+    """
+
+    def __init__(self, path, batch_size=1000, checkpoint_path=None, progress=None):
+        self.path = path
+        self.batch_size = batch_size
+        self.checkpoint_path = checkpoint_path or f'{path}.checkpoint.json'
+        self.progress = progress
+        self.unit_map = {}
+        self.user_map = {}
+        self.present_requests = set()
+        self.line_no = 0
+        self.counts = {label: {'created': 0, 'existing': 0, 'skipped': 0} for label, _ in EXPORT_MODELS}
+        self.errors = []
+
+    # Checkpoints ------------------------------------------------------
+
+    def _load_checkpoint(self):
+        try:
+            with open(self.checkpoint_path) as f:
+                checkpoint = json.load(f)
+        except (OSError, ValueError):
+            return 0
+        self.unit_map = {int(k): v for k, v in checkpoint.get('unit_map', {}).items()}
+        self.user_map = {int(k): v for k, v in checkpoint['user_map'].items()}
+        self.present_requests = set(checkpoint.get('present_requests', []))
+        self.counts.update(checkpoint['counts'])
+        self.errors = checkpoint.get('errors', [])
+        return checkpoint['line']
+
+    def _save_checkpoint(self):
+        tmp_path = f'{self.checkpoint_path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({
+                'line': self.line_no,
+                'unit_map': self.unit_map,
+                'user_map': self.user_map,
+                'present_requests': sorted(self.present_requests),
+                'counts': self.counts,
+                'errors': self.errors,
+            }, f)
+        os.replace(tmp_path, self.checkpoint_path)
+
+    # Rows -------------------------------------------------------------
+
+    @staticmethod
+    def _build(model, record):
+        values = {}
+        for field in _data_fields(model):
+            if field.attname in record['fields']:
+                values[field.attname] = field.to_python(record['fields'][field.attname])
+        return values
+
+    def _skip(self, label, record, reason):
+        self.counts[label]['skipped'] += 1
+        if len(self.errors) < 1000:
+            self.errors.append({'model': label, 'pk': str(record['pk']), 'error': reason})
+
+    def _insert(self, model, label, objects, timestamps):
+        if not objects:
+            return
+        created = model.objects.bulk_create(objects, batch_size=self.batch_size)
+        # bulk_create stamps auto_now/auto_now_add fields with the current
+        # time; put the exported values back
+        fields = _auto_timestamp_fields(model)
+        if fields:
+            for obj, values in zip(created, timestamps):
+                for name in fields:
+                    setattr(obj, name, values[name])
+            model.objects.bulk_update(created, fields, batch_size=self.batch_size)
+        self.counts[label]['created'] += len(created)
+        return created
+
+    def _unit_id(self, fields):
+        """Id in this database of the unit a user or request references"""
+        if fields.get('department_id') is not None:
+            return self.unit_map.get(fields['department_id'])
+        if fields.get('department'):
+            return unit_id(fields['department'])
+        return None
+
+    def _import_units(self, label, batch):
+        codes = [r['fields']['code'] for r in batch]
+        existing = dict(Unit.objects.filter(code__in=codes).values_list('code', 'id'))
+        new_records, objects, timestamps = [], [], []
+        for record in batch:
+            code = record['fields']['code']
+            if code in existing:
+                self.unit_map[record['pk']] = existing[code]
+                self.counts[label]['existing'] += 1
+            else:
+                values = self._build(Unit, record)
+                values['parent_id'] = None
+                new_records.append(record)
+                objects.append(Unit(**values))
+                timestamps.append(values)
+        created = self._insert(Unit, label, objects, timestamps) or []
+        for record, unit in zip(new_records, created):
+            self.unit_map[record['pk']] = unit.pk
+        # Parents may be later in the batch, so link them once all exist
+        for record, unit in zip(new_records, created):
+            unit.parent_id = self.unit_map.get(record['fields'].get('parent_id'))
+        Unit.objects.bulk_update(created, ['parent_id'])
+        rebuild_closure()
+        invalidate_units()
+
+    def _import_users(self, label, batch):
+        usernames = [r['fields']['username'] for r in batch]
+        # Emails are compared case-insensitively, as the bulk import does
+        emails = {(r['fields'].get('email') or '').lower() for r in batch}
+        departments = {record['pk']: self._unit_id(record['fields']) for record in batch}
+        existing = dict(User.objects.filter(username__in=usernames).values_list('username', 'id'))
+        taken_emails = set(User.objects.annotate(email_lower=Lower('email')).filter(email_lower__in=emails)
+                           .values_list('email_lower', flat=True))
+        taken_departments = set(User.objects.filter(department__in=[d for d in departments.values() if d])
+                                .values_list('department_id', flat=True))
+
+        new_records, objects, timestamps = [], [], []
+        for record in batch:
+            fields = record['fields']
+            department = departments[record['pk']]
+            if fields['username'] in existing:
+                self.user_map[record['pk']] = existing[fields['username']]
+                self.counts[label]['existing'] += 1
+            elif (fields.get('email') or '').lower() in taken_emails:
+                self._skip(label, record, f'email {fields["email"]} belongs to another user')
+            elif department and department in taken_departments:
+                self._skip(label, record, f'unit {department} already has a unit head')
+            else:
+                values = self._build(User, record)
+                values['department_id'] = department
+                taken_emails.add((fields.get('email') or '').lower())
+                if department:
+                    taken_departments.add(department)
+                new_records.append(record)
+                objects.append(User(**values))
+                timestamps.append(values)
+        created = self._insert(User, label, objects, timestamps) or []
+        for record, user in zip(new_records, created):
+            self.user_map[record['pk']] = user.pk
+
+    def _import_ceilings(self, label, batch):
+        keys = {}
+        for record in batch:
+            fields = record['fields']
+            keys[record['pk']] = (self.unit_map.get(fields['unit_id']), fields['fiscal_year'], fields['source_of_fund'])
+        existing = set(BudgetCeiling.objects.filter(unit_id__in={k[0] for k in keys.values()})
+                       .values_list('unit_id', 'fiscal_year', 'source_of_fund'))
+        objects, timestamps = [], []
+        for record in batch:
+            key = keys[record['pk']]
+            if key[0] is None:
+                self._skip(label, record, 'unit was not imported')
+            elif key in existing:
+                self.counts[label]['existing'] += 1
+            else:
+                values = self._build(BudgetCeiling, record)
+                values['unit_id'] = key[0]
+                existing.add(key)
+                objects.append(BudgetCeiling(**values))
+                timestamps.append(values)
+        # ``committed`` is recomputed from the items once they are all in
+        self._insert(BudgetCeiling, label, objects, timestamps)
+
+    def _import_opb_requests(self, label, batch):
+        model = MODELS_BY_LABEL[label]
+        ids = [model._meta.pk.to_python(r['pk']) for r in batch]
+        existing = set(model.objects.filter(pk__in=ids).values_list('pk', flat=True))
+        objects, timestamps = [], []
+        for record, pk in zip(batch, ids):
+            head = self.user_map.get(record['fields']['department_head_id'])
+            department = self._unit_id(record['fields'])
+            if pk in existing:
+                self.present_requests.add(str(pk))
+                self.counts[label]['existing'] += 1
+            elif head is None:
+                self._skip(label, record, 'department head was not imported')
+            elif department is None:
+                self._skip(label, record, 'unit was not imported')
+            else:
+                values = self._build(model, record)
+                values['department_head_id'] = head
+                values['department_id'] = department
+                objects.append(model(pk=pk, **values))
+                timestamps.append(values)
+        self._insert(model, label, objects, timestamps)
+        for department in {obj.department_id for obj in objects}:
+            invalidate_unit(department)
+
+    def _import_opb_items(self, label, batch):
+        model = MODELS_BY_LABEL[label]
+        request_model = model._meta.get_field('request').related_model
+        request_ids = {request_model._meta.pk.to_python(r['fields']['request_id']) for r in batch}
+        known = set(request_model.objects.filter(pk__in=request_ids).values_list('pk', flat=True))
+        objects, timestamps = [], []
+        for record in batch:
+            values = self._build(model, record)
+            if str(values['request_id']) in self.present_requests:
+                # The request was already here, and so are its items
+                self.counts[label]['existing'] += 1
+                continue
+            if values['request_id'] not in known:
+                self._skip(label, record, 'OPB request was not imported')
+                continue
+            objects.append(model(**values))
+            timestamps.append(values)
+        self._insert(model, label, objects, timestamps)
+
+    def _import_notifications(self, label, batch):
+        model = MODELS_BY_LABEL[label]
+        rows = []
+        for record in batch:
+            values = self._build(model, record)
+            values['user_id'] = self.user_map.get(record['fields']['user_id'])
+            rows.append((record, values))
+        known = [values for _, values in rows if values['user_id'] is not None]
+        existing = set()
+        if known:
+            present = model.objects.filter(
+                user_id__in={values['user_id'] for values in known},
+                created_at__range=_time_range([values['created_at'] for values in known]),
+            ).values_list('user_id', 'request_id', 'title', 'message', 'created_at')
+            existing = {(user, request_id, title, message, _to_millisecond(at))
+                        for user, request_id, title, message, at in present}
+        objects, timestamps = [], []
+        for record, values in rows:
+            if values['user_id'] is None:
+                self._skip(label, record, 'user was not imported')
+                continue
+            key = (values['user_id'], values.get('request_id'), values['title'], values['message'],
+                   _to_millisecond(values['created_at']))
+            if key in existing:
+                self.counts[label]['existing'] += 1
+                continue
+            existing.add(key)
+            objects.append(model(**values))
+            timestamps.append(values)
+        self._insert(model, label, objects, timestamps)
+
+    def _import_fiscal_year_closes(self, label, batch):
+        years = [r['fields']['fiscal_year'] for r in batch]
+        existing = set(FiscalYearClose.objects.filter(fiscal_year__in=years).values_list('fiscal_year', flat=True))
+        objects, timestamps = [], []
+        for record in batch:
+            if record['fields']['fiscal_year'] in existing:
+                self.counts[label]['existing'] += 1
+                continue
+            values = self._build(FiscalYearClose, record)
+            objects.append(FiscalYearClose(**values))
+            timestamps.append(values)
+        self._insert(FiscalYearClose, label, objects, timestamps)
+
+    def _import_status_transitions(self, label, batch):
+        rows = [(record, self._build(StatusTransition, record)) for record in batch]
+        present = (StatusTransition.objects.filter(request_id__in={values['request_id'] for _, values in rows})
+                   .values_list('request_id', 'status', 'at'))
+        existing = {(request_id, status, _to_millisecond(at)) for request_id, status, at in present}
+        objects, timestamps = [], []
+        for record, values in rows:
+            department = self._unit_id(record['fields'])
+            if department is None:
+                self._skip(label, record, 'unit was not imported')
+                continue
+            key = (values['request_id'], values['status'], _to_millisecond(values['at']))
+            if key in existing:
+                self.counts[label]['existing'] += 1
+                continue
+            existing.add(key)
+            values['department_id'] = department
+            values['by_id'] = self.user_map.get(record['fields'].get('by_id'))
+            objects.append(StatusTransition(**values))
+            timestamps.append(values)
+        self._insert(StatusTransition, label, objects, timestamps)
+
+    def _import_versions(self, label, batch):
+        keys = {(OPBRequestVersion._meta.get_field('request_id').to_python(r['fields']['request_id']),
+                 r['fields']['number']) for r in batch}
+        existing = set(OPBRequestVersion.objects.filter(request_id__in={k[0] for k in keys})
+                       .values_list('request_id', 'number'))
+        objects, timestamps = [], []
+        for record in batch:
+            values = self._build(OPBRequestVersion, record)
+            if (values['request_id'], values['number']) in existing:
+                self.counts[label]['existing'] += 1
+                continue
+            values['by_id'] = self.user_map.get(record['fields'].get('by_id'))
+            objects.append(OPBRequestVersion(**values))
+            timestamps.append(values)
+        self._insert(OPBRequestVersion, label, objects, timestamps)
+
+    _handlers = {
+        'accounts.unit': _import_units,
+        'accounts.user': _import_users,
+        'budget.budgetceiling': _import_ceilings,
+        'budget.opbrequest': _import_opb_requests,
+        'budget.opbitem': _import_opb_items,
+        'budget.notification': _import_notifications,
+        'budget.fiscalyearclose': _import_fiscal_year_closes,
+        'budget.archivedopbrequest': _import_opb_requests,
+        'budget.archivedopbitem': _import_opb_items,
+        'budget.archivednotification': _import_notifications,
+        'budget.statustransition': _import_status_transitions,
+        'budget.opbrequestversion': _import_versions,
+    }
+
+    def _flush(self, label, batch, line_no):
+        if batch:
+            with transaction.atomic():
+                self._handlers[label](self, label, batch)
+        self.line_no = line_no
+        self._save_checkpoint()
+        if self.progress:
+            self.progress(line_no, self.counts)
+
+    # Driver -----------------------------------------------------------
+
+    def run(self):
+        """Import the file; returns ``{'counts': ..., 'errors': [...]}``"""
+        resume_from = self._load_checkpoint()
+        label, batch = None, []
+        with gzip.open(self.path, 'rt', encoding='utf-8') as f:
+            header = json.loads(f.readline() or '{}')
+            if header.get('format') != FORMAT_NAME or header.get('version', 0) > FORMAT_VERSION:
+                raise DataImportError(f'{self.path} is not a {FORMAT_NAME} export this version can read')
+            line_no = 1
+            for line in f:
+                line_no += 1
+                if line_no <= resume_from or not line.strip():
+                    continue
+                record = json.loads(line)
+                if record['model'] not in MODELS_BY_LABEL:
+                    raise DataImportError(f'Unknown model {record["model"]!r} on line {line_no}')
+                if record['model'] != label or len(batch) >= self.batch_size:
+                    self._flush(label, batch, line_no - 1)
+                    label, batch = record['model'], []
+                batch.append(record)
+            self._flush(label, batch, line_no)
+
+        if self.counts.get('budget.statustransition', {}).get('created'):
+            # The turnaround statistics are derived from the log
+            rebuild_turnaround()
+        if any(self.counts.get(label, {}).get('created') for label in ('budget.opbitem', 'budget.archivedopbitem')):
+            # So are the budget cube and the item indexes, from the items
+            rebuild_cube()
+            reindex_all()
+            sign_all_items()
+        # And the committed totals of the ceilings, from the items now present
+        with serialized_atomic():
+            recompute_committed()
+        os.remove(self.checkpoint_path)
+        return {'counts': self.counts, 'errors': self.errors}
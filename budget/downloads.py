@@ -0,0 +1,151 @@
+"""
+Streaming file downloads.
+
+Backups can be as large as the database, so they are never read into memory.
+Plain downloads stream the file in chunks and honour ``Range`` requests so an
+interrupted download can resume; compressed downloads are gzip (or zstd,
+when the ``zstandard`` package is installed) encoded on the fly.
+
+Anything with a ``size`` and an ``iter_range(start, length)`` method can be
+streamed in place of a path, such as a backup reassembled from the chunk
+store.
+"""
+import os
+import re
+import zlib
+
+from django.http import HttpResponse, StreamingHttpResponse
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CHUNK_SIZE = 256 * 1024
+
+COMPRESSIONS = {
+    'gzip': ('.gz', 'application/gzip'),
+    'zstd': ('.zst', 'application/zstd'),
+}
+
+_range_re = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def available_compressions():
+    return [name for name in COMPRESSIONS if name != 'zstd' or zstandard is not None]
+
+
+def _read_range(path, start, length):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+def _open(source):
+    """``(size, read_range)`` for a path or a file-like backup source"""
+    if hasattr(source, 'iter_range'):
+        return source.size, source.iter_range
+    return os.path.getsize(source), lambda start, length: _read_range(source, start, length)
+
+
+def gzip_stream(chunks, level=6):
+    """gzip-compress an iterable of byte strings on the fly"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # 31 = gzip container
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def _gzip_chunks(size, read_range, level):
+    return gzip_stream(read_range(0, size), level)
+
+
+def _zstd_chunks(size, read_range, level):
+    compressor = zstandard.ZstdCompressor(level=level).compressobj()
+    for chunk in read_range(0, size):
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def parse_range(header, size):
+    """Return ``(start, end)`` for a single ``bytes=`` range, or ``None``"""
+    match = _range_re.match(header.strip()) if header else None
+    if not match or (not match.group(1) and not match.group(2)):
+        return None
+    first, last = match.groups()
+    if first:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    else:
+        # Suffix range: the last N bytes
+        start = max(0, size - int(last))
+        end = size - 1
+    if start > end or start >= size:
+        return False
+    return start, end
+
+
+def file_download_response(request, source, filename, checksum=None, compression=None, level=None):
+    """
+    Stream ``source`` (a path or backup source) as an attachment.
+
+    ``checksum`` is the SHA-256 of the file as stored; it is sent as
+    ``X-Checksum-SHA256`` and used as the ETag so clients can verify the
+    download (after decompressing, for compressed responses).
+    """
+    size, read_range = _open(source)
+    headers = {}
+    if checksum:
+        headers['X-Checksum-SHA256'] = checksum
+
+    if compression:
+        suffix, content_type = COMPRESSIONS[compression]
+        if compression == 'zstd':
+            chunks = _zstd_chunks(size, read_range, level or 3)
+        else:
+            chunks = _gzip_chunks(size, read_range, level or 6)
+        response = StreamingHttpResponse(chunks, content_type=content_type)
+        response['Content-Disposition'] = f'attachment; filename="{filename}{suffix}"'
+        # Compressed output is produced on the fly and cannot be resumed
+        response['Accept-Ranges'] = 'none'
+        response['X-Uncompressed-Length'] = str(size)
+        for name, value in headers.items():
+            response[name] = value
+        return response
+
+    etag = f'"{checksum}"' if checksum else None
+    byte_range = None
+    if_range = request.headers.get('If-Range')
+    if request.headers.get('Range') and (not if_range or if_range == etag):
+        byte_range = parse_range(request.headers['Range'], size)
+        if byte_range is False:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{size}'
+            return response
+
+    if byte_range:
+        start, end = byte_range
+        response = StreamingHttpResponse(read_range(start, end - start + 1), status=206,
+                                         content_type='application/octet-stream')
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+        response['Content-Length'] = str(end - start + 1)
+    else:
+        response = StreamingHttpResponse(read_range(0, size), content_type='application/octet-stream')
+        response['Content-Length'] = str(size)
+
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    response['Accept-Ranges'] = 'bytes'
+    if etag:
+        response['ETag'] = etag
+    for name, value in headers.items():
+        response[name] = value
+    return response
@@ -0,0 +1,99 @@
+"""
+OPB request statistics for the unit head dashboard.
+
+The counts and budget totals for a unit, by fiscal year and status, come
+from one grouped query and are cached per user for ``HEAD_STATS_CACHE_TTL``
+seconds. Each unit has a generation number, a ``UnitStatsGeneration`` row,
+that is part of its users' cache keys. Code that writes a unit's requests
+or items calls ``invalidate_unit()`` once, in the same transaction, after
+the write; the views, the importer, user deletion and closing a fiscal year
+all do. The number lives in the database rather than in the (per-process)
+cache, so once that transaction commits every worker process looks up new
+keys and none serves stale numbers, while other units keep their cached
+entries. Reading it costs one primary-key lookup per dashboard view.
+
+A restore brings back older generation numbers, so each worker clears its
+cache when it notices the restore (see ``caobp_system/maintenance.py``).
+"""
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Sum
+
+from .models import OPBRequest, UnitStatsGeneration
+
+# Status values as template-friendly keys ('for-approval' -> 'for_approval')
+STATUS_KEYS = {status: status.replace('-', '_') for status, _ in OPBRequest.STATUS_CHOICES}
+
+
+def _ttl():
+    return getattr(settings, 'HEAD_STATS_CACHE_TTL', 300)
+
+
+def _generation(unit_id):
+    return (UnitStatsGeneration.objects.filter(unit_id=unit_id)
+            .values_list('generation', flat=True).first() or 0)
+
+
+def invalidate_unit(unit_id):
+    """Make every cached entry for ``unit_id`` stale once the current transaction commits"""
+    bump = {'generation': F('generation') + 1}
+    if UnitStatsGeneration.objects.filter(unit_id=unit_id).update(**bump):
+        return
+    try:
+        with transaction.atomic():
+            UnitStatsGeneration.objects.create(unit_id=unit_id, generation=1)
+    except IntegrityError:
+        # Created by a concurrent writer in the meantime
+        UnitStatsGeneration.objects.filter(unit_id=unit_id).update(**bump)
+
+
+def unit_stats(unit_id):
+    """Counts and totals of the unit's requests by fiscal year and status"""
+    def empty():
+        return {key: {'count': 0, 'total': Decimal('0')} for key in STATUS_KEYS.values()}
+
+    totals = empty()
+    years = {}
+    rows = (OPBRequest.objects.filter(department_id=unit_id)
+            .values('fiscal_year', 'status')
+            .annotate(count=Count('id', distinct=True), total=Sum('items__budget_amount'))
+            .order_by())
+    for row in rows:
+        year = years.setdefault(row['fiscal_year'], empty())
+        total = row['total'] or Decimal('0')
+        key = STATUS_KEYS[row['status']]
+        for bucket in (year[key], totals[key]):
+            bucket['count'] += row['count']
+            bucket['total'] += total
+
+    return {
+        'submitted_count': sum(t['count'] for t in totals.values()),
+        'pending_count': totals['pending']['count'],
+        'approved_count': totals['for_approval']['count'],
+        'rejected_count': totals['enhancement']['count'],
+        'total_budget': sum(t['total'] for t in totals.values()),
+        'by_status': totals,
+        'by_year': [
+            {'fiscal_year': fy, 'statuses': year,
+             'count': sum(s['count'] for s in year.values()),
+             'total': sum(s['total'] for s in year.values())}
+            for fy, year in sorted(years.items(), reverse=True)
+        ],
+    }
+
+
+def head_stats(user):
+    """``unit_stats`` for the user's unit, from the cache when still fresh"""
+    unit_id = user.department_id
+    if unit_id is None:
+        return unit_stats(None)
+    generation = _generation(unit_id)
+    key = f'head_stats:user:{user.pk}:{unit_id}:{generation}'
+    stats = cache.get(key)
+    if stats is None:
+        stats = unit_stats(unit_id)
+        cache.set(key, stats, timeout=_ttl())
+    return stats
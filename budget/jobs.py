@@ -0,0 +1,228 @@
+"""
+Background jobs for slow admin actions.
+
+A job runs on a daemon thread inside the worker that started it. Its status
+is written to a small JSON file under ``settings.JOB_DIR`` so that the
+browser can poll any worker for progress through ``ajax_job_status``.
+
+The status records the worker's host and pid, and a heartbeat the job
+refreshes every ``JOB_HEARTBEAT`` seconds while it runs. If that worker
+exits or is killed mid-job, the status file would say ``running`` forever;
+``get_job()`` reports such a job as failed once its pid is gone or its
+heartbeat is older than ``JOB_STALE_AFTER`` seconds. Status files of
+finished jobs are removed ``JOB_RETENTION`` seconds after they finish.
+
+A job holds the maintenance drain lock while it runs (see
+``caobp_system/maintenance.py``): a restore waits for running jobs, and
+jobs started during a restore fail straight away.
+"""
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import traceback
+import uuid
+
+from django.conf import settings
+from django.db import connections
+
+from caobp_system.maintenance import hold_writes
+
+logger = logging.getLogger(__name__)
+
+JOB_STATES = ('queued', 'running', 'succeeded', 'failed')
+FINISHED_STATES = ('succeeded', 'failed')
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def job_dir():
+    path = str(getattr(settings, 'JOB_DIR', os.path.join(settings.BASE_DIR, 'jobs')))
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def _job_path(job_id):
+    # Job ids are uuid4 hex strings; never let a caller escape the job dir
+    return os.path.join(job_dir(), f'{os.path.basename(str(job_id))}.json')
+
+
+def _write_status(status):
+    path = _job_path(status['id'])
+    # Unique per thread: the job and its heartbeat both write the status
+    tmp_path = f'{path}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(status, f, default=str)
+    os.replace(tmp_path, path)
+
+
+def _read_status(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _pid_alive(pid):
+    if os.name != 'posix':
+        # os.kill(pid, 0) would send a console event on Windows
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _stale(status, now=None):
+    """Why an unfinished job is dead, or ``None`` if it may still be running"""
+    if status['state'] in FINISHED_STATES:
+        return None
+    now = time.time() if now is None else now
+    if status.get('host') == socket.gethostname() and status.get('pid') and not _pid_alive(status['pid']):
+        return 'The worker running this job has exited'
+    heartbeat = status.get('heartbeat_at') or status['created_at']
+    if now - heartbeat > _setting('JOB_STALE_AFTER', 60):
+        return 'The worker running this job stopped responding'
+    return None
+
+
+def get_job(job_id):
+    """
+    Current status of a job, or ``None`` if it does not exist. A job whose
+    worker died is reported as failed.
+    """
+    status = _read_status(_job_path(job_id))
+    if status is None:
+        return None
+    reason = _stale(status)
+    if reason:
+        status.update(state='failed', error=reason, finished_at=status.get('heartbeat_at'))
+    return status
+
+
+def prune_jobs(retention=None):
+    """
+    Remove the status files of jobs that finished (or died) more than
+    ``retention`` seconds ago; returns how many were removed.
+    """
+    retention = _setting('JOB_RETENTION', 7 * 24 * 3600) if retention is None else retention
+    now = time.time()
+    removed = 0
+    for name in os.listdir(job_dir()):
+        path = os.path.join(job_dir(), name)
+        if name.endswith('.tmp'):
+            # Left behind by a worker killed mid-write
+            try:
+                expired = now - os.path.getmtime(path) > retention
+            except OSError:
+                continue
+        elif name.endswith('.json'):
+            status = _read_status(path)
+            if status is None:
+                continue
+            if status['state'] in FINISHED_STATES:
+                finished_at = status.get('finished_at') or status['created_at']
+            elif _stale(status, now):
+                finished_at = status.get('heartbeat_at') or status['created_at']
+            else:
+                continue
+            expired = now - finished_at > retention
+        else:
+            continue
+        if expired:
+            try:
+                os.remove(path)
+                removed += 1
+            except OSError:
+                pass
+    return removed
+
+
+class Job:
+    """Handle passed to the job function for reporting progress"""
+
+    def __init__(self, kind, created_by=None):
+        now = time.time()
+        self.status = {
+            'id': uuid.uuid4().hex,
+            'kind': kind,
+            'state': 'queued',
+            'created_by': created_by,
+            'host': socket.gethostname(),
+            'pid': os.getpid(),
+            'created_at': now,
+            'heartbeat_at': now,
+            'started_at': None,
+            'finished_at': None,
+            'progress': 0.0,
+            'message': '',
+            'result': None,
+            'error': None,
+        }
+        self._last_write = 0.0
+        self._lock = threading.Lock()
+        self._finished = threading.Event()
+
+    @property
+    def id(self):
+        return self.status['id']
+
+    def _save(self):
+        with self._lock:
+            self.status['heartbeat_at'] = time.time()
+            _write_status(self.status)
+
+    def progress(self, done, total, message=None):
+        """Record progress; writes are throttled to a few per second"""
+        self.status['progress'] = round(done / total * 100, 1) if total else 0.0
+        if message is not None:
+            self.status['message'] = message
+        now = time.monotonic()
+        if now - self._last_write >= 0.25:
+            self._last_write = now
+            self._save()
+
+    def _beat(self):
+        # Keeps the heartbeat fresh while the job works without reporting
+        while not self._finished.wait(_setting('JOB_HEARTBEAT', 10)):
+            self._save()
+
+    def _run(self, func, args, kwargs):
+        self.status.update(state='running', started_at=time.time())
+        self._save()
+        threading.Thread(target=self._beat, name=f'job-{self.id}-heartbeat', daemon=True).start()
+        try:
+            with hold_writes():
+                result = func(self, *args, **kwargs)
+            self.status.update(state='succeeded', progress=100.0, result=result)
+        except Exception as e:
+            logger.error('Job %s (%s) failed\n%s', self.id, self.status['kind'], traceback.format_exc())
+            self.status.update(state='failed', error=str(e))
+        finally:
+            self._finished.set()
+            self.status['finished_at'] = time.time()
+            self._save()
+            connections.close_all()
+
+
+def start_job(kind, func, *args, created_by=None, **kwargs):
+    """
+    Run ``func(job, *args, **kwargs)`` on a background thread.
+
+    Returns the job id. Whatever ``func`` returns is stored as the job's
+    ``result`` and must be JSON serialisable.
+    """
+    prune_jobs()
+    job = Job(kind, created_by=created_by)
+    _write_status(job.status)
+    thread = threading.Thread(target=job._run, args=(func, args, kwargs), name=f'job-{kind}', daemon=True)
+    thread.start()
+    return job.id
@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from budget.archive import ArchiveError, close_fiscal_year, compact_database
+
+
+class Command(BaseCommand):
+    help = "Close a fiscal year, moving its OPB requests, items and notifications to the read-only archive"
+
+    def add_arguments(self, parser):
+        parser.add_argument('fiscal_year', help='Year to close, e.g. 2025')
+        parser.add_argument('--batch-size', type=int, default=500, help='Rows moved per write transaction')
+        parser.add_argument('--force', action='store_true', help='Allow closing the current or a later fiscal year')
+        parser.add_argument('--no-compact', action='store_true',
+                            help='Skip the VACUUM that returns freed space to the file system (SQLite)')
+
+    def handle(self, *args, **options):
+        verbosity = options['verbosity']
+
+        def progress(moved):
+            if verbosity > 1:
+                self.stdout.write(f'  {moved["requests"]} requests, {moved["notifications"]} notifications moved')
+
+        try:
+            record, moved = close_fiscal_year(options['fiscal_year'], closed_by='manage.py',
+                                              batch_size=options['batch_size'], force=options['force'],
+                                              progress=progress)
+        except ArchiveError as e:
+            raise CommandError(str(e))
+
+        if not options['no_compact']:
+            compact_database()
+        self.stdout.write(
+            f'Moved {moved["requests"]} requests, {moved["items"]} items and '
+            f'{moved["notifications"]} notifications to the archive'
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f'Fiscal year {record.fiscal_year} is closed ({record.requests} archived requests)'
+        ))
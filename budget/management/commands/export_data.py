@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from budget.data_transfer import export_to_file
+
+
+class Command(BaseCommand):
+    help = 'Export users, OPB requests, items and notifications as gzip-compressed NDJSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Output file, e.g. caobp_export.ndjson.gz')
+        parser.add_argument('--chunk-size', type=int, default=2000, help='Rows fetched per query')
+        parser.add_argument('--level', type=int, default=6, help='gzip compression level (1-9)')
+
+    def handle(self, *args, **options):
+        rows = export_to_file(options['path'], chunk_size=options['chunk_size'], level=options['level'])
+        self.stdout.write(self.style.SUCCESS(f'Exported {rows} rows to {options["path"]}'))
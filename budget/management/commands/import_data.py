@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from budget.data_transfer import DataImportError, Importer
+
+
+class Command(BaseCommand):
+    help = 'Import an NDJSON export, resuming from its checkpoint if a previous run was interrupted'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='File written by export_data or the admin export')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Rows per bulk insert and transaction')
+        parser.add_argument('--checkpoint', help='Checkpoint file (default: <path>.checkpoint.json)')
+
+    def handle(self, *args, **options):
+        verbosity = options['verbosity']
+
+        def progress(line_no, counts):
+            if verbosity > 1:
+                self.stdout.write(f'  line {line_no}')
+
+        importer = Importer(options['path'], batch_size=options['batch_size'],
+                            checkpoint_path=options['checkpoint'], progress=progress)
+        try:
+            result = importer.run()
+        except DataImportError as e:
+            raise CommandError(str(e))
+
+        for label, counts in result['counts'].items():
+            self.stdout.write(
+                f'{label}: {counts["created"]} created, {counts["existing"]} already present, '
+                f'{counts["skipped"]} skipped'
+            )
+        for error in result['errors'][:20]:
+            self.stdout.write(self.style.WARNING(f'  {error["model"]} {error["pk"]}: {error["error"]}'))
+        self.stdout.write(self.style.SUCCESS('Import finished'))
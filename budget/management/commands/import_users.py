@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from accounts.bulk_import import BulkImportError, import_users, read_csv
+
+
+class Command(BaseCommand):
+    help = 'Create users from a CSV file (username, email, password, first_name, last_name, department, role)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='CSV file with a header row')
+        parser.add_argument('--dry-run', action='store_true', help='Validate the file without creating users')
+        parser.add_argument('--workers', type=int, help='Password hashing processes (default: one per CPU core)')
+
+    def handle(self, *args, **options):
+        try:
+            with open(options['path'], 'rb') as f:
+                rows = read_csv(f.read())
+        except (OSError, UnicodeDecodeError, BulkImportError) as e:
+            raise CommandError(str(e))
+
+        result = import_users(rows, dry_run=options['dry_run'], workers=options['workers'])
+
+        for row in result['rows']:
+            if row['errors']:
+                self.stdout.write(self.style.WARNING(f'  row {row["row"]} ({row["username"]}): {"; ".join(row["errors"])}'))
+        if result['dry_run']:
+            summary = f'{result["valid"]} valid, {result["failed"]} with errors (dry run, nothing created)'
+        else:
+            summary = (f'{result["created"]} created, {result["failed"]} with errors in {result["total_seconds"]}s '
+                       f'({result["hash_seconds"]}s hashing)')
+        self.stdout.write(self.style.SUCCESS(summary) if not result['failed'] else summary)
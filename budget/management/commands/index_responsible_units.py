@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from budget.responsibilities import reindex_all
+
+
+class Command(BaseCommand):
+    help = 'Parse the responsible units of every OPB item into the responsible units index'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=2000, help='Items indexed per transaction')
+
+    def handle(self, *args, **options):
+        verbosity = options['verbosity']
+
+        def progress(items, links):
+            if verbosity > 1:
+                self.stdout.write(f'  {items} items indexed, {links} unit links')
+
+        items, links = reindex_all(batch_size=options['batch_size'], progress=progress)
+        self.stdout.write(self.style.SUCCESS(f'Indexed {items} item(s) with {links} responsible unit link(s)'))
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from budget.similarity import sign_all_items
+
+
+class Command(BaseCommand):
+    help = 'Compute the MinHash signatures and LSH buckets used to find near-duplicate OPB items'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Items signed per write transaction')
+
+    def handle(self, *args, **options):
+        verbosity = options['verbosity']
+
+        def progress(items, signed):
+            if verbosity > 1:
+                self.stdout.write(f'  {items} items read, {signed} signed')
+
+        items, signed = sign_all_items(batch_size=options['batch_size'], progress=progress)
+        self.stdout.write(self.style.SUCCESS(f'Signed {signed} of {items} item(s)'))
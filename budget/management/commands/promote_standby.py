@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from caobp_system.standby import StandbyError, promote_standby, standby_config, standby_status
+
+
+class Command(BaseCommand):
+    help = 'Replace the primary SQLite database with the warm standby (stop the web workers first)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true',
+                            help='Promote even if the primary database still passes its integrity check')
+
+    def handle(self, *args, **options):
+        status = standby_status()
+        if status:
+            self.stdout.write(f'Standby last synced {status["lag_seconds"]}s behind the primary')
+        try:
+            moved_to = promote_standby(force=options['force'])
+        except StandbyError as e:
+            raise CommandError(str(e))
+        if moved_to:
+            self.stdout.write(f'Old primary moved to {moved_to}')
+        self.stdout.write(self.style.SUCCESS(f'Promoted {standby_config()["PATH"]} to primary'))
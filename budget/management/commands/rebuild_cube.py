@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from budget.cube import rebuild_cube
+
+
+class Command(BaseCommand):
+    help = 'Recompute the budget cube behind the reports pivot from the OPB items'
+
+    def handle(self, *args, **options):
+        cells = rebuild_cube()
+        self.stdout.write(self.style.SUCCESS(f'{cells} cube cell(s) rebuilt'))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from budget.status_history import rebuild_turnaround
+
+
+class Command(BaseCommand):
+    help = 'Recount the approval turnaround statistics from the status transition log'
+
+    def handle(self, *args, **options):
+        rows = rebuild_turnaround()
+        self.stdout.write(self.style.SUCCESS(f'{rows} turnaround row(s) rebuilt'))
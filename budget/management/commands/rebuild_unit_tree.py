@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from accounts.unit_tree import rebuild_closure
+from accounts.units import invalidate
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the unit closure table from the Unit.parent links'
+
+    def handle(self, *args, **options):
+        rows = rebuild_closure()
+        invalidate()
+        self.stdout.write(self.style.SUCCESS(f'Unit tree rebuilt ({rows} closure rows)'))
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from budget.ceilings import recompute_committed
+
+
+class Command(BaseCommand):
+    help = 'Recount the committed amount of every budget ceiling from the OPB items'
+
+    def handle(self, *args, **options):
+        fixed = recompute_committed()
+        for ceiling in fixed:
+            self.stdout.write(f'  {ceiling}: committed reset to {ceiling.committed}')
+        self.stdout.write(self.style.SUCCESS(f'{len(fixed)} ceiling(s) corrected'))
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from caobp_system.replica import (
+    refresh_sqlite_snapshot, replica_enabled, replica_is_sqlite, replica_lag,
+)
+
+
+class Command(BaseCommand):
+    help = 'Refresh the SQLite read-replica snapshot, or report the lag of a server replica'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--pages', type=int, default=1024, help='Pages copied per backup step')
+
+    def handle(self, *args, **options):
+        if not replica_enabled():
+            raise CommandError('Read replica is not enabled (set DB_REPLICA=1)')
+
+        if replica_is_sqlite():
+            if refresh_sqlite_snapshot(pages=options['pages']):
+                self.stdout.write(self.style.SUCCESS('Replica snapshot refreshed'))
+            else:
+                self.stdout.write(self.style.WARNING('Another refresh is already running'))
+            return
+
+        lag = replica_lag()
+        if lag is None:
+            raise CommandError('Replica is unreachable')
+        self.stdout.write(f'Replica lag: {lag:.1f}s')
@@ -0,0 +1,41 @@
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+
+from budget.backup_schedule import CronSchedule, run_scheduled_backup, run_scheduler, schedule_config
+
+
+class Command(BaseCommand):
+    help = 'Take database backups on the BACKUP_SCHEDULE cron schedule and prune old ones'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--cron', help='Cron expression to use instead of BACKUP_SCHEDULE["CRON"]')
+        parser.add_argument('--once', action='store_true',
+                            help='Take one scheduled backup now, prune, and exit (for use from cron)')
+
+    def handle(self, *args, **options):
+        expression = options['cron'] or schedule_config().get('CRON', '0 * * * *')
+        try:
+            schedule = CronSchedule(expression)
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        if options['once']:
+            status = run_scheduled_backup()
+            if status is None:
+                self.stdout.write(self.style.WARNING('A scheduled backup is already running'))
+            elif status['state'] == 'skipped':
+                self.stdout.write(self.style.WARNING(status['error']))
+            elif status['state'] == 'succeeded':
+                self.stdout.write(self.style.SUCCESS(
+                    f'Created {status["filename"]}; pruned {len(status["pruned"])} old backup(s)'
+                ))
+            else:
+                raise CommandError(f'Backup failed: {status["error"]}')
+            return
+
+        self.stdout.write(f'Backing up on "{expression}"; next run at {schedule.next_after(datetime.now()):%Y-%m-%d %H:%M}')
+        try:
+            run_scheduler(expression=expression)
+        except KeyboardInterrupt:
+            self.stdout.write('Backup scheduler stopped')
@@ -0,0 +1,37 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from caobp_system.database import is_sqlite
+from caobp_system.standby import StandbyError, StandbySync, standby_config
+
+
+class Command(BaseCommand):
+    help = 'Keep the warm standby copy of the SQLite database in sync with the primary'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Sync once and exit')
+        parser.add_argument('--poll', type=float, default=0.5, help='Seconds between change checks')
+
+    def handle(self, *args, **options):
+        if not is_sqlite(settings.DATABASES['default']):
+            raise CommandError('The warm standby is for SQLite; use streaming replication for PostgreSQL')
+        config = standby_config()
+        sync = StandbySync()
+
+        if options['once']:
+            try:
+                status = sync.sync(force=True)
+            except StandbyError as e:
+                raise CommandError(str(e))
+            finally:
+                sync.close()
+            self.stdout.write(self.style.SUCCESS(
+                f'Standby synced to {config["PATH"]} in {status["duration_seconds"]}s'
+            ))
+            return
+
+        self.stdout.write(f'Syncing standby at {config["PATH"]} (lag {config["LAG"]}s)')
+        try:
+            sync.run(poll_interval=options['poll'])
+        except KeyboardInterrupt:
+            self.stdout.write('Standby sync stopped')
@@ -0,0 +1,61 @@
+# Generated by Django 5.2.18 on 2026-10-19 01:29
+
+import django.db.models.deletion
+import uuid
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Notification',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('title', models.CharField(max_length=200)),
+                ('message', models.TextField()),
+                ('notification_type', models.CharField(choices=[('info', 'Information'), ('success', 'Success'), ('warning', 'Warning'), ('error', 'Error')], default='info', max_length=20)),
+                ('is_read', models.BooleanField(default=False)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='notifications', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='OPBRequest',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('department', models.CharField(choices=[('CAS', 'College of Arts and Sciences'), ('COLLEGE_IND_TECH', 'College of Industrial Technology'), ('COE', 'College of Education'), ('COA', 'College of Agriculture'), ('PRODUCTION_COMMERCIALIZATION', 'Production & Commercialization'), ('PRODUCTION_BAO', 'Production & Business Affairs Office'), ('PPSDO', 'Physical Plant & Site Development Office'), ('VETERINARY_SERVICES', 'Veterinary Services'), ('GUIDANCE', 'Guidance'), ('RECORDS_ARCHIVES', 'Records and Archives'), ('ALUMNI_AFFAIRS', 'Alumni Affairs'), ('BOARD_SECRETARY', 'Board Secretary'), ('MEDICAL_SERVICES', 'Medical Services Unit'), ('SUPERVISING_ADMIN', 'Supervising Administrative Office'), ('REGISTRAR', 'Registrar'), ('CAWAYAN_CAMPUS', 'Cawayan Campus'), ('BUDGET_UNIT', 'Budget Unit'), ('ACCOUNTING_UNIT', 'Accounting Unit'), ('CASH_UNIT', 'Cash Unit'), ('SUPPLY_UNIT', 'Supply Unit'), ('RECORDS_UNIT', 'Records Unit'), ('HRMO_OFFICE', 'HRMO Office'), ('PROCUREMENT_UNIT', 'Procurement Unit/BAC'), ('SECURITY_UNIT', 'Security Unit'), ('MOTORPOOL_UNIT', 'Motorpool Unit'), ('LIBRARY_SERVICES', 'Library Services'), ('NSTP_ROTC', 'NSTP/ROTC'), ('INTERNATIONAL_RELATIONS', 'International Relations Office'), ('SPORTS_CULTURAL', 'Sports and Cultural Development'), ('LEGAL_SERVICES', 'Legal Services Office'), ('PERSONNEL_SCHOLARSHIP', 'Personnel Scholarship Office'), ('QUALITY_ASSURANCE', 'Quality Assurance Office'), ('OFFICE_VPAA', 'Office of the VPAA'), ('OFFICE_VPAF', 'Office of the VPAF'), ('OFFICE_VPREICWKM', 'Office of the VPREICWKM'), ('OFFICE_BSB', 'Office of the Board Secretary/BOT'), ('PLANNING', 'Planning'), ('QUALITY_ASSURANCE', 'Quality Assurance'), ('ISO', 'ISO'), ('MIS', 'MIS'), ('SCUAA', 'SCUAA'), ('CSC', 'CSC'), ('CRCYC', 'CRCYC'), ('GAD', 'GAD'), ('PIO', 'PIO')], max_length=50)),
+                ('fiscal_year', models.CharField(default='2026', max_length=4)),
+                ('unit', models.CharField(blank=True, max_length=200, null=True)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('for-approval', 'For Approval'), ('enhancement', 'Enhancement')], default='pending', max_length=20)),
+                ('admin_notes', models.TextField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('department_head', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='opb_requests', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='OPBItem',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kra_no', models.CharField(blank=True, max_length=50, null=True)),
+                ('objective_no', models.CharField(blank=True, max_length=50, null=True)),
+                ('indicators', models.TextField(blank=True, null=True)),
+                ('annual_target', models.TextField(blank=True, null=True)),
+                ('activities', models.TextField(blank=True, null=True)),
+                ('timeframe', models.CharField(blank=True, max_length=100, null=True)),
+                ('budget_amount', models.DecimalField(decimal_places=2, default=0, max_digits=15)),
+                ('source_of_fund', models.CharField(blank=True, max_length=200, null=True)),
+                ('responsible_units', models.CharField(blank=True, max_length=200, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('request', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='items', to='budget.opbrequest')),
+            ],
+        ),
+    ]
@@ -0,0 +1,53 @@
+"""
+``OPBRequest.department`` becomes a key to ``accounts.Unit``.
+
+Existing rows store unit codes; they are copied into a temporary
+``department_unit`` key (creating units for unknown codes, as
+``accounts.0002_unit_department_unit`` does) before the text column is dropped.
+"""
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def codes_to_units(apps, schema_editor):
+    from accounts.units import units_for_codes
+
+    OPBRequest = apps.get_model('budget', 'OPBRequest')
+    using = schema_editor.connection.alias
+    requests = OPBRequest.objects.using(using)
+    codes = list(requests.values_list('department', flat=True).distinct())
+    ids = units_for_codes(apps, using, codes)
+    for code in codes:
+        requests.filter(department=code).update(department_unit_id=ids[code])
+
+
+def units_to_codes(apps, schema_editor):
+    OPBRequest = apps.get_model('budget', 'OPBRequest')
+    Unit = apps.get_model('accounts', 'Unit')
+    using = schema_editor.connection.alias
+    requests = OPBRequest.objects.using(using)
+    for unit_id, code in Unit.objects.using(using).values_list('id', 'code'):
+        requests.filter(department_unit_id=unit_id).update(department=code)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0003_user_department'),
+        ('budget', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='opbrequest',
+            name='department_unit',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='accounts.unit'),
+        ),
+        # Nullable while the codes are copied, so unapplying can re-add it
+        migrations.AlterField(
+            model_name='opbrequest',
+            name='department',
+            field=models.CharField(max_length=50, null=True),
+        ),
+        migrations.RunPython(codes_to_units, units_to_codes),
+    ]
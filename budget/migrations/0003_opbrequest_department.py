@@ -0,0 +1,31 @@
+"""
+Drop the unit code column in favour of the key filled in by
+``0002_opbrequest_department_unit``; a separate migration so PostgreSQL
+commits the copied keys before the table is altered again.
+"""
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('budget', '0002_opbrequest_department_unit'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='opbrequest',
+            name='department',
+        ),
+        migrations.RenameField(
+            model_name='opbrequest',
+            old_name='department_unit',
+            new_name='department',
+        ),
+        migrations.AlterField(
+            model_name='opbrequest',
+            name='department',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='opb_requests', to='accounts.unit'),
+        ),
+    ]
@@ -0,0 +1,232 @@
+# Generated by Django 5.2.18 on 2026-10-19 01:30
+
+import budget.models
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0003_user_department'),
+        ('budget', '0003_opbrequest_department'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FiscalYearClose',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('fiscal_year', models.CharField(max_length=4, unique=True)),
+                ('closed_at', models.DateTimeField(auto_now_add=True)),
+                ('closed_by', models.CharField(blank=True, default='', max_length=150)),
+                ('requests', models.PositiveIntegerField(default=0)),
+                ('items', models.PositiveIntegerField(default=0)),
+                ('notifications', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'ordering': ['-fiscal_year'],
+            },
+        ),
+        migrations.CreateModel(
+            name='ItemSignature',
+            fields=[
+                ('item', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='signature', serialize=False, to='budget.opbitem')),
+                ('fiscal_year', models.CharField(max_length=4)),
+                ('minhash', models.BinaryField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='UnitStatsGeneration',
+            fields=[
+                ('unit', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stats_generation', serialize=False, to='accounts.unit')),
+                ('generation', models.PositiveBigIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='notification',
+            name='request_id',
+            field=models.UUIDField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='opbrequest',
+            name='fiscal_year',
+            field=models.CharField(db_index=True, default=budget.models.current_fiscal_year, max_length=4),
+        ),
+        migrations.CreateModel(
+            name='ArchivedNotification',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('archived_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('request_id', models.UUIDField(blank=True, db_index=True, null=True)),
+                ('title', models.CharField(max_length=200)),
+                ('message', models.TextField()),
+                ('notification_type', models.CharField(choices=[('info', 'Information'), ('success', 'Success'), ('warning', 'Warning'), ('error', 'Error')], default='info', max_length=20)),
+                ('is_read', models.BooleanField(default=False)),
+                ('created_at', models.DateTimeField()),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_notifications', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='ArchivedOPBRequest',
+            fields=[
+                ('archived_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('id', models.UUIDField(editable=False, primary_key=True, serialize=False)),
+                ('fiscal_year', models.CharField(db_index=True, max_length=4)),
+                ('unit', models.CharField(blank=True, max_length=200, null=True)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('for-approval', 'For Approval'), ('enhancement', 'Enhancement')], max_length=20)),
+                ('admin_notes', models.TextField(blank=True, null=True)),
+                ('created_at', models.DateTimeField()),
+                ('updated_at', models.DateTimeField()),
+                ('department', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='archived_opb_requests', to='accounts.unit')),
+                ('department_head', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_opb_requests', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='ArchivedOPBItem',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('archived_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('kra_no', models.CharField(blank=True, max_length=50, null=True)),
+                ('objective_no', models.CharField(blank=True, max_length=50, null=True)),
+                ('indicators', models.TextField(blank=True, null=True)),
+                ('annual_target', models.TextField(blank=True, null=True)),
+                ('activities', models.TextField(blank=True, null=True)),
+                ('timeframe', models.CharField(blank=True, max_length=100, null=True)),
+                ('budget_amount', models.DecimalField(decimal_places=2, default=0, max_digits=15)),
+                ('source_of_fund', models.CharField(blank=True, max_length=200, null=True)),
+                ('responsible_units', models.CharField(blank=True, max_length=200, null=True)),
+                ('created_at', models.DateTimeField()),
+                ('request', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='items', to='budget.archivedopbrequest')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='ResponsibleUnit',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('item', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='responsible_links', to='budget.opbitem')),
+                ('unit', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='responsibilities', to='accounts.unit')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='opbitem',
+            name='responsible',
+            field=models.ManyToManyField(blank=True, related_name='responsible_items', through='budget.ResponsibleUnit', to='accounts.unit'),
+        ),
+        migrations.CreateModel(
+            name='SimilarityBucket',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('fiscal_year', models.CharField(max_length=4)),
+                ('key', models.BigIntegerField()),
+                ('item', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='similarity_buckets', to='budget.opbitem')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='StatusTransition',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('request_id', models.UUIDField()),
+                ('fiscal_year', models.CharField(max_length=4)),
+                ('from_status', models.CharField(blank=True, default='', max_length=20)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('for-approval', 'For Approval'), ('enhancement', 'Enhancement')], max_length=20)),
+                ('at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('note', models.TextField(blank=True, default='')),
+                ('by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='status_transitions', to=settings.AUTH_USER_MODEL)),
+                ('department', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='status_transitions', to='accounts.unit')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='TurnaroundStat',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField()),
+                ('outcome', models.CharField(choices=[('pending', 'Pending'), ('for-approval', 'For Approval'), ('enhancement', 'Enhancement')], max_length=20)),
+                ('decisions', models.PositiveIntegerField(default=0)),
+                ('total_seconds', models.BigIntegerField(default=0)),
+                ('max_seconds', models.BigIntegerField(default=0)),
+                ('within_sla', models.PositiveIntegerField(default=0)),
+                ('department', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='turnaround_stats', to='accounts.unit')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='BudgetCeiling',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('fiscal_year', models.CharField(max_length=4)),
+                ('source_of_fund', models.CharField(blank=True, default='', max_length=200)),
+                ('ceiling', models.DecimalField(decimal_places=2, max_digits=15)),
+                ('committed', models.DecimalField(decimal_places=2, default=0, max_digits=15)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('unit', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='budget_ceilings', to='accounts.unit')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('unit', 'fiscal_year', 'source_of_fund'), name='unique_budget_ceiling')],
+            },
+        ),
+        migrations.CreateModel(
+            name='BudgetCubeCell',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('fiscal_year', models.CharField(max_length=4)),
+                ('month', models.DateField()),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('for-approval', 'For Approval'), ('enhancement', 'Enhancement')], max_length=20)),
+                ('kra_no', models.CharField(blank=True, default='', max_length=50)),
+                ('source_of_fund', models.CharField(blank=True, default='', max_length=200)),
+                ('responsible_units', models.CharField(blank=True, default='', max_length=200)),
+                ('items', models.IntegerField(default=0)),
+                ('amount', models.DecimalField(decimal_places=2, default=0, max_digits=17)),
+                ('department', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='cube_cells', to='accounts.unit')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('department', 'fiscal_year', 'month', 'status', 'kra_no', 'source_of_fund', 'responsible_units'), name='unique_budget_cube_cell')],
+            },
+        ),
+        migrations.CreateModel(
+            name='OPBRequestVersion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('request_id', models.UUIDField()),
+                ('number', models.PositiveIntegerField()),
+                ('checkpoint', models.BooleanField(default=False)),
+                ('data', models.JSONField()),
+                ('at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='opb_versions', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('request_id', 'number'), name='unique_opb_request_version')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='responsibleunit',
+            constraint=models.UniqueConstraint(fields=('unit', 'item'), name='unique_responsible_unit'),
+        ),
+        migrations.AddIndex(
+            model_name='similaritybucket',
+            index=models.Index(fields=['fiscal_year', 'key'], name='similarity_bucket_key'),
+        ),
+        migrations.AddIndex(
+            model_name='statustransition',
+            index=models.Index(fields=['request_id', 'at'], name='transition_request_at'),
+        ),
+        migrations.AddIndex(
+            model_name='statustransition',
+            index=models.Index(fields=['status', 'at'], name='transition_status_at'),
+        ),
+        migrations.AddConstraint(
+            model_name='turnaroundstat',
+            constraint=models.UniqueConstraint(fields=('department', 'month', 'outcome'), name='unique_turnaround_stat'),
+        ),
+    ]
@@ -1,10 +1,17 @@
+from django.conf import settings
 from django.db import models
 from django.contrib.auth import get_user_model
 from django.utils import timezone
+from accounts.models import Unit
 import uuid
 
 User = get_user_model()
 
+
+def current_fiscal_year():
+    return str(settings.CURRENT_FISCAL_YEAR)
+
+
 class OPBRequest(models.Model):
     """Operational Plan and Budget Request"""
     STATUS_CHOICES = [
@@ -15,8 +22,8 @@ class OPBRequest(models.Model):
     
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     department_head = models.ForeignKey(User, on_delete=models.CASCADE, related_name='opb_requests')
-    department = models.CharField(max_length=50, choices=User.UNIT_CHOICES)
-    fiscal_year = models.CharField(max_length=4, default='2026')
+    department = models.ForeignKey(Unit, on_delete=models.PROTECT, related_name='opb_requests')
+    fiscal_year = models.CharField(max_length=4, default=current_fiscal_year, db_index=True)
     unit = models.CharField(max_length=200, blank=True, null=True)
     
     # Status and Admin
@@ -33,8 +40,12 @@ class OPBRequest(models.Model):
     def item_count(self):
         return self.items.count()
     
+    def get_department_display(self):
+        from accounts.units import unit_name
+        return unit_name(self.department_id)
+    
     def __str__(self):
-        return f"OPB Request - {self.unit} ({self.department}) - {self.fiscal_year}"
+        return f"OPB Request - {self.unit} ({self.get_department_display()}) - {self.fiscal_year}"
 
 
 class OPBItem(models.Model):
@@ -49,12 +60,78 @@ class OPBItem(models.Model):
     budget_amount = models.DecimalField(max_digits=15, decimal_places=2, default=0)
     source_of_fund = models.CharField(max_length=200, blank=True, null=True)
     responsible_units = models.CharField(max_length=200, blank=True, null=True)
+    # Units parsed from responsible_units; see budget/responsibilities.py
+    responsible = models.ManyToManyField(Unit, through='ResponsibleUnit', blank=True, related_name='responsible_items')
     created_at = models.DateTimeField(auto_now_add=True)
     
     def __str__(self):
         return f"OPB Item - {self.kra_no} ({self.request.unit})"
 
 
+class ResponsibleUnit(models.Model):
+    """A unit named in an item's ``responsible_units``, maintained by ``budget/responsibilities.py``"""
+    item = models.ForeignKey(OPBItem, on_delete=models.CASCADE, related_name='responsible_links')
+    unit = models.ForeignKey(Unit, on_delete=models.CASCADE, related_name='responsibilities')
+    
+    class Meta:
+        constraints = [
+            # Also the index behind "what is this unit responsible for"
+            models.UniqueConstraint(fields=['unit', 'item'], name='unique_responsible_unit'),
+        ]
+    
+    def __str__(self):
+        return f"{self.unit} responsible for item {self.item_id}"
+
+
+class ItemSignature(models.Model):
+    """MinHash signature of an item's activities and indicators; see ``budget/similarity.py``"""
+    item = models.OneToOneField(OPBItem, on_delete=models.CASCADE, primary_key=True, related_name='signature')
+    fiscal_year = models.CharField(max_length=4)
+    minhash = models.BinaryField()
+    
+    def __str__(self):
+        return f"Signature of item {self.item_id}"
+
+
+class SimilarityBucket(models.Model):
+    """One LSH band of an item's signature, hashed into ``key``"""
+    item = models.ForeignKey(OPBItem, on_delete=models.CASCADE, related_name='similarity_buckets')
+    fiscal_year = models.CharField(max_length=4)
+    key = models.BigIntegerField()
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=['fiscal_year', 'key'], name='similarity_bucket_key'),
+        ]
+    
+    def __str__(self):
+        return f"Bucket {self.key} ({self.fiscal_year}) of item {self.item_id}"
+
+
+class BudgetCeiling(models.Model):
+    """Cap on what a unit may request for a fiscal year; see ``budget/ceilings.py``"""
+    unit = models.ForeignKey(Unit, on_delete=models.CASCADE, related_name='budget_ceilings')
+    fiscal_year = models.CharField(max_length=4)
+    # Blank caps the unit's total across all sources of fund
+    source_of_fund = models.CharField(max_length=200, blank=True, default='')
+    ceiling = models.DecimalField(max_digits=15, decimal_places=2)
+    # Sum of the matching OPB items, maintained on every submission
+    committed = models.DecimalField(max_digits=15, decimal_places=2, default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['unit', 'fiscal_year', 'source_of_fund'], name='unique_budget_ceiling'),
+        ]
+    
+    @property
+    def remaining(self):
+        return self.ceiling - self.committed
+    
+    def __str__(self):
+        return f"{self.unit} {self.fiscal_year} {self.source_of_fund or 'all sources'}: {self.ceiling}"
+
+
 class Notification(models.Model):
     """System notifications"""
     NOTIFICATION_TYPES = [
@@ -65,6 +142,9 @@ class Notification(models.Model):
     ]
     
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='notifications')
+    # The OPB request it is about, if any; not a foreign key, so it can
+    # follow the request into the archive
+    request_id = models.UUIDField(null=True, blank=True, db_index=True)
     title = models.CharField(max_length=200)
     message = models.TextField()
     notification_type = models.CharField(max_length=20, choices=NOTIFICATION_TYPES, default='info')
@@ -73,3 +153,214 @@ class Notification(models.Model):
     
     def __str__(self):
         return f"{self.title} - {self.user.username}"
+
+
+class BudgetCubeCell(models.Model):
+    """
+    Items and their budget for one combination of dimensions; the cells
+    together are the aggregation cube of ``budget/cube.py``
+    """
+    department = models.ForeignKey(Unit, on_delete=models.CASCADE, related_name='cube_cells')
+    fiscal_year = models.CharField(max_length=4)
+    month = models.DateField()  # first day of the month the request was submitted
+    status = models.CharField(max_length=20, choices=OPBRequest.STATUS_CHOICES)
+    kra_no = models.CharField(max_length=50, blank=True, default='')
+    source_of_fund = models.CharField(max_length=200, blank=True, default='')
+    responsible_units = models.CharField(max_length=200, blank=True, default='')
+    items = models.IntegerField(default=0)
+    amount = models.DecimalField(max_digits=17, decimal_places=2, default=0)
+    
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['department', 'fiscal_year', 'month', 'status', 'kra_no', 'source_of_fund', 'responsible_units'],
+                name='unique_budget_cube_cell',
+            ),
+        ]
+    
+    def __str__(self):
+        return f"{self.department} {self.fiscal_year} {self.month:%Y-%m} {self.status}: {self.items} items"
+
+
+class UnitStatsGeneration(models.Model):
+    """Bumped whenever a unit's requests change; part of its users' ``head_stats`` cache keys"""
+    unit = models.OneToOneField(Unit, on_delete=models.CASCADE, primary_key=True, related_name='stats_generation')
+    generation = models.PositiveBigIntegerField(default=0)
+    
+    def __str__(self):
+        return f"{self.unit} statistics generation {self.generation}"
+
+
+# Status history (see budget/status_history.py) ------------------------------
+
+class StatusTransitionReadOnly(Exception):
+    """Raised when a logged status transition would be changed or deleted"""
+
+
+class StatusTransition(models.Model):
+    """
+    One change of an OPB request's status; rows are only ever added.
+
+    ``save()`` and ``delete()`` refuse to change a logged row, but queryset
+    ``update()`` and ``delete()`` do not go through them and are not
+    blocked. Code that rewrites the log that way must run ``manage.py
+    rebuild_turnaround`` afterwards.
+    """
+    # Not a foreign key, so the log outlives archiving and deleting requests
+    request_id = models.UUIDField()
+    department = models.ForeignKey(Unit, on_delete=models.PROTECT, related_name='status_transitions')
+    fiscal_year = models.CharField(max_length=4)
+    # Blank for the submission that created the request
+    from_status = models.CharField(max_length=20, blank=True, default='')
+    status = models.CharField(max_length=20, choices=OPBRequest.STATUS_CHOICES)
+    at = models.DateTimeField(default=timezone.now)
+    by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='status_transitions')
+    note = models.TextField(blank=True, default='')
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=['request_id', 'at'], name='transition_request_at'),
+            models.Index(fields=['status', 'at'], name='transition_status_at'),
+        ]
+    
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            raise StatusTransitionReadOnly('Status transitions cannot be changed')
+        super().save(*args, **kwargs)
+    
+    def delete(self, *args, **kwargs):
+        raise StatusTransitionReadOnly('Status transitions cannot be deleted')
+    
+    def __str__(self):
+        return f"{self.request_id}: {self.from_status or 'new'} -> {self.status} at {self.at:%Y-%m-%d %H:%M}"
+
+
+class TurnaroundStat(models.Model):
+    """Decisions on one unit's requests in one month, kept by each transition"""
+    department = models.ForeignKey(Unit, on_delete=models.CASCADE, related_name='turnaround_stats')
+    month = models.DateField()  # first day of the month the decision was made
+    outcome = models.CharField(max_length=20, choices=OPBRequest.STATUS_CHOICES)
+    decisions = models.PositiveIntegerField(default=0)
+    # Time from entering 'pending' to the decision
+    total_seconds = models.BigIntegerField(default=0)
+    max_seconds = models.BigIntegerField(default=0)
+    within_sla = models.PositiveIntegerField(default=0)
+    
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['department', 'month', 'outcome'], name='unique_turnaround_stat'),
+        ]
+    
+    def __str__(self):
+        return f"{self.department} {self.month:%Y-%m} {self.outcome}: {self.decisions}"
+
+
+class OPBRequestVersion(models.Model):
+    """
+    One saved version of an OPB request's content. Checkpoints hold the whole
+    content; other versions only what changed since the previous one (see
+    ``budget/versions.py``).
+    """
+    # Not a foreign key, like StatusTransition, so versions outlive archiving
+    request_id = models.UUIDField()
+    number = models.PositiveIntegerField()
+    checkpoint = models.BooleanField(default=False)
+    data = models.JSONField()
+    at = models.DateTimeField(default=timezone.now)
+    by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='opb_versions')
+    
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['request_id', 'number'], name='unique_opb_request_version'),
+        ]
+    
+    def __str__(self):
+        return f"{self.request_id} v{self.number}{' (checkpoint)' if self.checkpoint else ''}"
+
+
+# Archive of closed fiscal years (see budget/archive.py) ---------------------
+
+class ArchiveReadOnly(Exception):
+    """Raised when an archived row would be saved or deleted"""
+
+
+class ArchivedModel(models.Model):
+    """Rows are written only by closing a fiscal year and are read-only after"""
+    archived_at = models.DateTimeField(default=timezone.now)
+    
+    class Meta:
+        abstract = True
+    
+    def save(self, *args, **kwargs):
+        raise ArchiveReadOnly(f'{self._meta.verbose_name} rows are read-only')
+    
+    def delete(self, *args, **kwargs):
+        raise ArchiveReadOnly(f'{self._meta.verbose_name} rows are read-only')
+
+
+class FiscalYearClose(models.Model):
+    """A fiscal year whose requests were moved to the archive"""
+    fiscal_year = models.CharField(max_length=4, unique=True)
+    closed_at = models.DateTimeField(auto_now_add=True)
+    closed_by = models.CharField(max_length=150, blank=True, default='')
+    requests = models.PositiveIntegerField(default=0)
+    items = models.PositiveIntegerField(default=0)
+    notifications = models.PositiveIntegerField(default=0)
+    
+    class Meta:
+        ordering = ['-fiscal_year']
+    
+    def __str__(self):
+        return f"Fiscal year {self.fiscal_year} (closed {self.closed_at:%Y-%m-%d})"
+
+
+class ArchivedOPBRequest(ArchivedModel):
+    """An OPB request from a closed fiscal year"""
+    id = models.UUIDField(primary_key=True, editable=False)
+    department_head = models.ForeignKey(User, on_delete=models.CASCADE, related_name='archived_opb_requests')
+    department = models.ForeignKey(Unit, on_delete=models.PROTECT, related_name='archived_opb_requests')
+    fiscal_year = models.CharField(max_length=4, db_index=True)
+    unit = models.CharField(max_length=200, blank=True, null=True)
+    status = models.CharField(max_length=20, choices=OPBRequest.STATUS_CHOICES)
+    admin_notes = models.TextField(blank=True, null=True)
+    created_at = models.DateTimeField()
+    updated_at = models.DateTimeField()
+    
+    total_budget_amount = OPBRequest.total_budget_amount
+    item_count = OPBRequest.item_count
+    get_department_display = OPBRequest.get_department_display
+    
+    def __str__(self):
+        return f"Archived OPB Request - {self.unit} ({self.get_department_display()}) - {self.fiscal_year}"
+
+
+class ArchivedOPBItem(ArchivedModel):
+    """An item of an archived OPB request"""
+    request = models.ForeignKey(ArchivedOPBRequest, on_delete=models.CASCADE, related_name='items')
+    kra_no = models.CharField(max_length=50, blank=True, null=True)
+    objective_no = models.CharField(max_length=50, blank=True, null=True)
+    indicators = models.TextField(blank=True, null=True)
+    annual_target = models.TextField(blank=True, null=True)
+    activities = models.TextField(blank=True, null=True)
+    timeframe = models.CharField(max_length=100, blank=True, null=True)
+    budget_amount = models.DecimalField(max_digits=15, decimal_places=2, default=0)
+    source_of_fund = models.CharField(max_length=200, blank=True, null=True)
+    responsible_units = models.CharField(max_length=200, blank=True, null=True)
+    created_at = models.DateTimeField()
+    
+    def __str__(self):
+        return f"Archived OPB Item - {self.kra_no}"
+
+
+class ArchivedNotification(ArchivedModel):
+    """A notification about an OPB request of a closed fiscal year"""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='archived_notifications')
+    request_id = models.UUIDField(null=True, blank=True, db_index=True)
+    title = models.CharField(max_length=200)
+    message = models.TextField()
+    notification_type = models.CharField(max_length=20, choices=Notification.NOTIFICATION_TYPES, default='info')
+    is_read = models.BooleanField(default=False)
+    created_at = models.DateTimeField()
+    
+    def __str__(self):
+        return f"{self.title} - {self.user.username}"
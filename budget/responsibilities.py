@@ -0,0 +1,188 @@
+"""
+Index of the units named in OPB items' ``responsible_units``.
+
+The field is free text ("Supply Unit, BAC / HRMO"), so every item's text is
+parsed into the units it names and stored as ``ResponsibleUnit`` rows,
+whose unique (unit, item) index answers "what is this unit responsible
+for" without scanning the items. A unit is recognised by its name or code,
+by a ``/``-separated part of its name ("BAC" in "Procurement Unit/BAC") or
+by its name without a trailing "Unit" or "Office", as long as that alias
+names no other unit. All-capital aliases must match in capitals.
+
+The views index a request's items right after writing them; ``manage.py
+index_responsible_units`` backfills existing items, and should be run again
+after units are renamed. Archived items are not indexed.
+"""
+import re
+
+from django.db import transaction
+from django.db.models import Count, F, Sum
+
+from accounts.units import all_units, unit_code, unit_name
+from caobp_system.write_gate import serialized_atomic
+
+from .models import OPBItem, ResponsibleUnit
+
+_matcher = None
+
+
+def _aliases(unit):
+    names = {unit.code, unit.code.replace('_', ' ')}
+    for part in [unit.name] + unit.name.split('/'):
+        part = part.strip()
+        names.add(part)
+        for suffix in (' Unit', ' Office'):
+            if part.endswith(suffix):
+                names.add(part[:-len(suffix)].strip())
+    return {name for name in names if len(name) >= 2}
+
+
+class _Matcher:
+    """Finds the units named in a text; built from the unit registry"""
+
+    def __init__(self, units):
+        self.signature = tuple((u.id, u.code, u.name) for u in units)
+        owners = {}
+        for unit in units:
+            for alias in _aliases(unit):
+                key = alias if alias.isupper() else alias.casefold()
+                owners.setdefault(key, set()).add(unit.id)
+        # Ambiguous aliases ("Records") name no unit
+        self.lookup = {key: ids.pop() for key, ids in owners.items() if len(ids) == 1}
+        exact = sorted((key for key in self.lookup if key.isupper()), key=len, reverse=True)
+        folded = sorted((key for key in self.lookup if not key.isupper()), key=len, reverse=True)
+        # Longest alias first, so "Office of the Board Secretary" wins over "Board Secretary"
+        self.exact = self._pattern(exact, 0)
+        self.folded = self._pattern(folded, re.IGNORECASE)
+
+    @staticmethod
+    def _pattern(aliases, flags):
+        if not aliases:
+            return None
+        return re.compile(r'(?<!\w)(?:' + '|'.join(re.escape(a) for a in aliases) + r')(?!\w)', flags)
+
+    def units_in(self, text):
+        found = []
+        for pattern, normalize in ((self.folded, str.casefold), (self.exact, str)):
+            if pattern is None:
+                continue
+            for match in pattern.finditer(text):
+                unit_id = self.lookup.get(normalize(match.group(0)))
+                if unit_id is not None and unit_id not in found:
+                    found.append(unit_id)
+        return found
+
+
+def _current_matcher():
+    global _matcher
+    units = all_units(include_inactive=True)
+    if _matcher is None or _matcher.signature != tuple((u.id, u.code, u.name) for u in units):
+        _matcher = _Matcher(units)
+    return _matcher
+
+
+def parse_responsible_units(text):
+    """Ids of the units named in ``text``, in order of appearance"""
+    if not text or not text.strip():
+        return []
+    return _current_matcher().units_in(re.sub(r'\s+', ' ', text))
+
+
+def index_items(items):
+    """(Re)index the items of the ``items`` queryset; returns the number of links"""
+    rows = list(items.order_by().values_list('pk', 'responsible_units'))
+    links = [ResponsibleUnit(item_id=pk, unit_id=unit_id)
+             for pk, text in rows for unit_id in parse_responsible_units(text)]
+    with transaction.atomic():
+        ResponsibleUnit.objects.filter(item_id__in=[pk for pk, _ in rows]).delete()
+        ResponsibleUnit.objects.bulk_create(links, batch_size=1000)
+    return len(links)
+
+
+def index_request(opb_request):
+    """Index the request's items, as they are now; run it in the transaction that wrote them"""
+    return index_items(OPBItem.objects.filter(request_id=opb_request.pk))
+
+
+def reindex_all(batch_size=2000, progress=None):
+    """Index every item, ``batch_size`` per write transaction; returns ``(items, links)``"""
+    done = links = 0
+    last_pk = 0
+    while True:
+        pks = list(OPBItem.objects.filter(pk__gt=last_pk).order_by('pk').values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            break
+        with serialized_atomic():
+            links += index_items(OPBItem.objects.filter(pk__in=pks))
+        done += len(pks)
+        last_pk = pks[-1]
+        if progress:
+            progress(done, links)
+    return done, links
+
+
+# Queries ----------------------------------------------------------------
+
+def _cross_unit(opb_requests=None):
+    """Links where the responsible unit is not the unit that filed the request"""
+    links = ResponsibleUnit.objects.exclude(item__request__department_id=F('unit_id'))
+    if opb_requests is not None:
+        links = links.filter(item__request__in=opb_requests.order_by().values('pk'))
+    return links
+
+
+def responsibility_summary(opb_requests=None):
+    """
+    Every unit that other units named as responsible: the items, the units
+    that named it and their budget, largest budget first.
+    """
+    rows = (_cross_unit(opb_requests).values('unit_id')
+            .annotate(items=Count('item_id'), requesting_units=Count('item__request__department_id', distinct=True),
+                      total=Sum('item__budget_amount'))
+            .order_by('-total'))
+    return [{
+        'unit': unit_code(row['unit_id']),
+        'unit_name': unit_name(row['unit_id']),
+        'items': row['items'],
+        'requesting_units': row['requesting_units'],
+        'total': row['total'] or 0,
+    } for row in rows]
+
+
+def unit_responsibilities(unit_id, opb_requests=None, limit=200):
+    """
+    What other units named ``unit_id`` responsible for: totals per
+    requesting unit and the items themselves, largest first.
+    """
+    links = _cross_unit(opb_requests).filter(unit_id=unit_id)
+    by_unit = (links.values('item__request__department_id')
+               .annotate(items=Count('item_id'), total=Sum('item__budget_amount'))
+               .order_by('-total'))
+    items = (links.order_by('-item__budget_amount')
+             .values('item_id', 'item__request_id', 'item__request__department_id', 'item__request__fiscal_year',
+                     'item__request__status', 'item__kra_no', 'item__activities', 'item__budget_amount',
+                     'item__responsible_units')[:limit])
+    by_unit = [{
+        'unit': unit_code(row['item__request__department_id']),
+        'unit_name': unit_name(row['item__request__department_id']),
+        'items': row['items'],
+        'total': row['total'] or 0,
+    } for row in by_unit]
+    return {
+        'unit': unit_code(unit_id),
+        'unit_name': unit_name(unit_id),
+        'items_count': sum(row['items'] for row in by_unit),
+        'total': sum(row['total'] for row in by_unit),
+        'by_unit': by_unit,
+        'items': [{
+            'item_id': row['item_id'],
+            'request_id': str(row['item__request_id']),
+            'requested_by': unit_name(row['item__request__department_id']),
+            'fiscal_year': row['item__request__fiscal_year'],
+            'status': row['item__request__status'],
+            'kra_no': row['item__kra_no'],
+            'activities': row['item__activities'],
+            'budget_amount': row['item__budget_amount'],
+            'responsible_units': row['item__responsible_units'],
+        } for row in items],
+    }
@@ -0,0 +1,92 @@
+"""
+Budget and submission rollups over the unit hierarchy.
+
+Every function here aggregates through ``UnitClosure`` (see
+``accounts/unit_tree.py``): the subtree under a unit is the set of closure
+rows with that ``ancestor_id``, so the totals for any number of subtrees
+come from one grouped join, however deep the tree is.
+"""
+from django.db.models import Count, Q, Sum
+
+from accounts.models import UnitClosure
+from accounts.units import all_units, get_unit
+
+
+def in_subtree(opb_requests, unit_id):
+    """``opb_requests`` narrowed to the unit ``unit_id`` and everything below it"""
+    return opb_requests.filter(department__ancestor_links__ancestor_id=unit_id)
+
+
+def subtree_ids(unit_id):
+    """Ids of the unit ``unit_id`` and every unit below it"""
+    return list(UnitClosure.objects.filter(ancestor_id=unit_id).values_list('descendant_id', flat=True))
+
+
+def subtree_rollups(node_ids, opb_requests=None):
+    """
+    ``{unit id: totals}`` for the subtree under each of ``node_ids``.
+
+    Totals are ``units`` (units with a unit head), ``submitted_units``,
+    ``requests`` and ``total`` (sum of item budgets), counting only
+    ``opb_requests`` when given. ``opb_requests`` may also be archived
+    requests (see ``budget/archive.py``).
+    """
+    if opb_requests is None:
+        requests = 'descendant__opb_requests'
+        in_scope = Q(**{f'{requests}__isnull': False})
+    else:
+        relation = opb_requests.model._meta.get_field('department').related_query_name()
+        requests = f'descendant__{relation}'
+        in_scope = Q(**{f'{requests}__in': opb_requests.order_by().values('pk')})
+    rows = (UnitClosure.objects
+            .filter(ancestor_id__in=node_ids)
+            .values('ancestor_id')
+            .annotate(
+                units=Count('descendant_id', filter=Q(descendant__head__isnull=False), distinct=True),
+                submitted_units=Count('descendant_id', filter=in_scope, distinct=True),
+                requests=Count(requests, filter=in_scope, distinct=True),
+                total=Sum(f'{requests}__items__budget_amount', filter=in_scope),
+            ))
+    return {row.pop('ancestor_id'): row for row in rows}
+
+
+def breadcrumb(unit_id):
+    """Units from the top of the tree down to ``unit_id``, in one query"""
+    ancestor_ids = (UnitClosure.objects.filter(descendant_id=unit_id)
+                    .order_by('-depth').values_list('ancestor_id', flat=True))
+    return [get_unit(ancestor_id) for ancestor_id in ancestor_ids]
+
+
+def unit_drilldown(code=None, opb_requests=None):
+    """
+    Rollup rows for the children of the unit ``code`` (the top of the tree
+    when ``None``), for drilling from campus to office to unit.
+    """
+    current = get_unit(code) if code else None
+    parent_id = current.id if current else None
+    units = all_units()
+    parents = {unit.parent_id for unit in units}
+    children = [unit for unit in units if unit.parent_id == parent_id]
+    if current is not None:
+        # The unit's own requests, apart from those of its sub-units
+        children.insert(0, current)
+
+    totals = subtree_rollups([unit.id for unit in children], opb_requests)
+    rows = []
+    for unit in children:
+        row = {'units': 0, 'submitted_units': 0, 'requests': 0, 'total': 0}
+        row.update((k, v or 0) for k, v in totals.get(unit.id, {}).items())
+        own = unit is current
+        if own:
+            # Exclude what the children contribute
+            for child in children[1:]:
+                for key in row:
+                    row[key] -= totals.get(child.id, {}).get(key) or 0
+        row.update(unit=unit, own=own, has_children=unit.id in parents and not own)
+        rows.append(row)
+    rows.sort(key=lambda row: (not row['own'], -row['total'], row['unit'].name))
+    return {
+        'current': current,
+        'breadcrumb': breadcrumb(current.id) if current else [],
+        'rows': rows,
+    }
@@ -0,0 +1,248 @@
+"""
+Near-duplicate OPB items, found with MinHash and locality-sensitive hashing.
+
+An item's activities and indicators are normalised and cut into character
+5-grams. ``NUM_PERM`` hash functions each keep the smallest hash of those
+shingles, and the fraction of positions where two signatures agree
+estimates the Jaccard similarity of the two texts. The signature is split
+into ``BANDS`` bands of ``ROWS`` values, and each band is hashed into a
+``SimilarityBucket`` key. Two items with similarity ``s`` share at least one
+key with probability ``1 - (1 - s**ROWS)**BANDS``, which is about 0.64 at
+s = 0.5 and above 0.99 at s = 0.8.
+
+Candidates are therefore found with one indexed ``(fiscal_year, key)``
+lookup instead of comparing every pair of items, and are then confirmed
+against ``SIMILARITY_THRESHOLD`` with their signatures. The views sign a
+request's items right after writing them; ``manage.py index_similarity``
+signs existing items, and must be run again if the constants below change.
+Archived items are not indexed. NumPy, when installed, computes the same
+signatures several times faster.
+"""
+import random
+import re
+import struct
+from collections import defaultdict
+from hashlib import blake2b
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, F, Window
+from django.db.models.functions import RowNumber
+
+from accounts.units import unit_name
+from caobp_system.write_gate import serialized_atomic
+
+from .models import ItemSignature, OPBItem, SimilarityBucket
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+NUM_PERM = 64
+BANDS = 16
+ROWS = NUM_PERM // BANDS
+SHINGLE = 5
+# Buckets larger than this (the same boilerplate text in many items) only
+# pair up their first members, in the batch report and per request
+MAX_BUCKET = 100
+
+# Multiply-shift hash functions ((a * h + b) mod 2**64) >> 32 of 32-bit
+# shingle hashes; NumPy's uint64 arithmetic wraps the same way, so both
+# paths give identical signatures
+_MASK = (1 << 64) - 1
+_rng = random.Random(5003)
+_PERMUTATIONS = [(_rng.getrandbits(64) | 1, _rng.getrandbits(64)) for _ in range(NUM_PERM)]
+_FORMAT = f'<{NUM_PERM}I'
+if np is not None:
+    _A = np.array([a for a, _ in _PERMUTATIONS], dtype=np.uint64)[:, None]
+    _B = np.array([b for _, b in _PERMUTATIONS], dtype=np.uint64)[:, None]
+
+
+def _threshold():
+    return getattr(settings, 'SIMILARITY_THRESHOLD', 0.6)
+
+
+def item_text(activities, indicators):
+    return f'{activities or ""} {indicators or ""}'
+
+
+def _shingles(text):
+    text = ' '.join(re.sub(r'[^\w]+', ' ', text.casefold()).split())
+    if len(text) <= SHINGLE:
+        return {text} if text else set()
+    return {text[i:i + SHINGLE] for i in range(len(text) - SHINGLE + 1)}
+
+
+def minhash(text):
+    """The packed MinHash signature of ``text``, or ``None`` if it has no words"""
+    hashes = [int.from_bytes(blake2b(s.encode(), digest_size=4).digest(), 'little') for s in _shingles(text)]
+    if not hashes:
+        return None
+    if np is not None:
+        values = ((_A * np.array(hashes, dtype=np.uint64) + _B) >> np.uint64(32)).min(axis=1)
+        return values.astype('<u4').tobytes()
+    return struct.pack(_FORMAT, *(min(((a * h + b) & _MASK) >> 32 for h in hashes) for a, b in _PERMUTATIONS))
+
+
+def band_keys(signature):
+    """The ``BANDS`` bucket keys of a packed signature"""
+    width = ROWS * 4
+    return [int.from_bytes(blake2b(bytes([band]) + signature[band * width:(band + 1) * width], digest_size=8).digest(),
+                           'little', signed=True)
+            for band in range(BANDS)]
+
+
+# Indexing -----------------------------------------------------------------
+
+def sign_items(items):
+    """(Re)sign the items of the ``items`` queryset; returns the number signed"""
+    rows = list(items.order_by().values_list('pk', 'activities', 'indicators', 'request__fiscal_year'))
+    signatures, buckets = [], []
+    for pk, activities, indicators, fiscal_year in rows:
+        signature = minhash(item_text(activities, indicators))
+        if signature is None:
+            continue
+        signatures.append(ItemSignature(item_id=pk, fiscal_year=fiscal_year, minhash=signature))
+        buckets.extend(SimilarityBucket(item_id=pk, fiscal_year=fiscal_year, key=key) for key in band_keys(signature))
+    pks = [pk for pk, *_ in rows]
+    with transaction.atomic():
+        SimilarityBucket.objects.filter(item_id__in=pks).delete()
+        ItemSignature.objects.filter(item_id__in=pks).delete()
+        ItemSignature.objects.bulk_create(signatures, batch_size=1000)
+        SimilarityBucket.objects.bulk_create(buckets, batch_size=2000)
+    return len(signatures)
+
+
+def sign_request(opb_request):
+    """Sign the request's items, as they are now; run it in the transaction that wrote them"""
+    return sign_items(OPBItem.objects.filter(request_id=opb_request.pk))
+
+
+def sign_all_items(batch_size=1000, progress=None):
+    """Sign every item, ``batch_size`` per write transaction; returns ``(items, signed)``"""
+    done = signed = 0
+    last_pk = 0
+    while True:
+        pks = list(OPBItem.objects.filter(pk__gt=last_pk).order_by('pk').values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            break
+        with serialized_atomic():
+            signed += sign_items(OPBItem.objects.filter(pk__in=pks))
+        done += len(pks)
+        last_pk = pks[-1]
+        if progress:
+            progress(done, signed)
+    return done, signed
+
+
+# Queries ----------------------------------------------------------------
+
+def _details(item_ids):
+    rows = OPBItem.objects.filter(pk__in=item_ids).values(
+        'pk', 'request_id', 'request__department_id', 'request__status', 'kra_no', 'activities', 'indicators',
+        'budget_amount',
+    )
+    return {row['pk']: {
+        'item_id': row['pk'],
+        'request_id': row['request_id'],
+        'unit_id': row['request__department_id'],
+        'unit': unit_name(row['request__department_id']),
+        'status': row['request__status'],
+        'kra_no': row['kra_no'],
+        'activities': row['activities'],
+        'indicators': row['indicators'],
+        'budget_amount': row['budget_amount'],
+    } for row in rows}
+
+
+def _signatures(items):
+    """``{item_id: (signature, unit_id, budget_amount)}`` for the ``items`` (ids or an id subquery)"""
+    rows = (ItemSignature.objects.filter(item_id__in=items)
+            .values_list('item_id', 'minhash', 'item__request__department_id', 'item__budget_amount'))
+    return {pk: (bytes(signature), unit, amount) for pk, signature, unit, amount in rows}
+
+
+def _score_pairs(pairs, signatures):
+    """``(similarity, a, b)`` for each pair of item ids, from their ``_signatures``"""
+    pairs = [(a, b) for a, b in pairs if a in signatures and b in signatures]
+    if np is None or not pairs:
+        values = {pk: struct.unpack(_FORMAT, row[0]) for pk, row in signatures.items()}
+        return [(sum(x == y for x, y in zip(values[a], values[b])) / NUM_PERM, a, b) for a, b in pairs]
+    index = {pk: i for i, pk in enumerate(signatures)}
+    matrix = np.frombuffer(b''.join(row[0] for row in signatures.values()), dtype='<u4').reshape(-1, NUM_PERM)
+    first = np.array([index[a] for a, _ in pairs])
+    second = np.array([index[b] for _, b in pairs])
+    scores = (matrix[first] == matrix[second]).sum(axis=1) / NUM_PERM
+    return [(float(score), a, b) for score, (a, b) in zip(scores, pairs)]
+
+
+def similar_items(opb_request, threshold=None, limit=10):
+    """
+    For each item of ``opb_request``, the items of the same fiscal year (in
+    any request) that look like near duplicates, most similar first:
+    ``{item_id: [{'similarity': 0.82, 'item_id': ..., 'unit': ...}, ...]}``.
+    """
+    threshold = _threshold() if threshold is None else threshold
+    own_items = defaultdict(set)
+    for key, item_id in SimilarityBucket.objects.filter(item__request_id=opb_request.pk).values_list('key', 'item_id'):
+        own_items[key].add(item_id)
+    if not own_items:
+        return {}
+
+    # The first MAX_BUCKET members of each bucket, so a boilerplate text
+    # shared by thousands of items does not load them all
+    hits = (SimilarityBucket.objects.filter(fiscal_year=opb_request.fiscal_year, key__in=list(own_items))
+            .annotate(position=Window(RowNumber(), partition_by=F('key'), order_by=F('item_id').asc()))
+            .filter(position__lte=MAX_BUCKET))
+    pairs = {(item_id, other) for key, other in hits.values_list('key', 'item_id')
+             for item_id in own_items[key] if other != item_id}
+    signatures = {**_signatures(hits.values('item_id')),
+                  **_signatures(set().union(*own_items.values()))}
+    matches = defaultdict(list)
+    for score, item_id, other in sorted(_score_pairs(pairs, signatures), reverse=True):
+        if score >= threshold and len(matches[item_id]) < limit:
+            matches[item_id].append((score, other))
+
+    details = _details({o for scored in matches.values() for _, o in scored})
+    return {
+        item_id: [{**details[o], 'similarity': round(score, 2),
+                   'same_request': details[o]['request_id'] == opb_request.pk}
+                  for score, o in scored if o in details]
+        for item_id, scored in matches.items() if scored
+    }
+
+
+def duplicate_pairs(fiscal_year, threshold=None, include_same_unit=False, limit=100):
+    """
+    Likely duplicate items across a fiscal year, most similar (then largest
+    budget) first. Only pairs from different units are reported unless
+    ``include_same_unit`` is set.
+    """
+    threshold = _threshold() if threshold is None else threshold
+    shared = (SimilarityBucket.objects.filter(fiscal_year=fiscal_year).values('key')
+              .annotate(members=Count('item_id')).filter(members__gt=1).values('key'))
+    candidates = SimilarityBucket.objects.filter(fiscal_year=fiscal_year, key__in=shared)
+    buckets = defaultdict(list)
+    for key, item_id in candidates.order_by('key', 'item_id').values_list('key', 'item_id'):
+        if len(buckets[key]) < MAX_BUCKET:
+            buckets[key].append(item_id)
+    pairs = {(a, b) for members in buckets.values() for i, a in enumerate(members) for b in members[i + 1:]}
+    if not pairs:
+        return []
+
+    signatures = _signatures(candidates.values('item_id'))
+    if not include_same_unit:
+        pairs = {(a, b) for a, b in pairs if a in signatures and b in signatures
+                 and signatures[a][1] != signatures[b][1]}
+    scored = [(score, signatures[a][2] + signatures[b][2], a, b)
+              for score, a, b in _score_pairs(pairs, signatures) if score >= threshold]
+    scored = sorted(scored, reverse=True)[:limit]
+
+    details = _details({i for *_, a, b in scored for i in (a, b)})
+    return [{
+        'similarity': round(score, 2),
+        'first': details[a],
+        'second': details[b],
+        'combined_budget': combined,
+    } for score, combined, a, b in scored if a in details and b in details]
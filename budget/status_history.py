@@ -0,0 +1,174 @@
+"""
+Status history of OPB requests and turnaround statistics.
+
+Every status change is appended to ``StatusTransition`` by
+``record_transition()``, which must run in the transaction that changes the
+request, so the log and the request never disagree. A decision (a change
+out of 'pending') also adds the time the request waited to the
+``TurnaroundStat`` row of its unit, month and outcome with one UPDATE, so
+the SLA section of the reports reads a few dozen rows instead of the log.
+
+The wait starts at the request's latest move into 'pending' (submission or
+an edit sent back for review). ``within_sla`` counts waits of at most
+``APPROVAL_SLA_DAYS``; after changing the setting, ``manage.py
+rebuild_turnaround`` recounts the statistics from the log.
+"""
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+from accounts.units import unit_name
+
+from .models import StatusTransition, TurnaroundStat
+
+PENDING = 'pending'
+
+
+def sla_seconds():
+    return getattr(settings, 'APPROVAL_SLA_DAYS', 14) * 86400
+
+
+def _month(at):
+    return timezone.localtime(at).date().replace(day=1)
+
+
+def waiting_since(request_id):
+    """When the request last entered 'pending', from the log"""
+    return (StatusTransition.objects.filter(request_id=request_id, status=PENDING)
+            .order_by('-at').values_list('at', flat=True).first())
+
+
+def _add_turnaround(unit_id, at, outcome, seconds):
+    stats = {'department_id': unit_id, 'month': _month(at), 'outcome': outcome}
+    within = int(seconds <= sla_seconds())
+    changes = {
+        'decisions': F('decisions') + 1,
+        'total_seconds': F('total_seconds') + seconds,
+        'max_seconds': Greatest(F('max_seconds'), seconds),
+        'within_sla': F('within_sla') + within,
+    }
+    if TurnaroundStat.objects.filter(**stats).update(**changes):
+        return
+    try:
+        with transaction.atomic():
+            TurnaroundStat.objects.create(decisions=1, total_seconds=seconds, max_seconds=seconds,
+                                          within_sla=within, **stats)
+    except IntegrityError:
+        # Created by a concurrent decision in the meantime
+        TurnaroundStat.objects.filter(**stats).update(**changes)
+
+
+def record_transition(opb_request, from_status, by=None, note='', at=None):
+    """
+    Log that ``opb_request`` moved from ``from_status`` ('' when it was just
+    submitted) to its current status. Nothing is logged if it did not move.
+    """
+    if from_status == opb_request.status:
+        return None
+    at = at or timezone.now()
+    if from_status == PENDING:
+        since = waiting_since(opb_request.pk)
+        if since is None:
+            # Submitted before the log existed: log the submission first
+            since = opb_request.created_at
+            StatusTransition.objects.create(request_id=opb_request.pk, department_id=opb_request.department_id,
+                                            fiscal_year=opb_request.fiscal_year, status=PENDING, at=since)
+        _add_turnaround(opb_request.department_id, at, opb_request.status,
+                        max(int((at - since).total_seconds()), 0))
+    return StatusTransition.objects.create(
+        request_id=opb_request.pk,
+        department_id=opb_request.department_id,
+        fiscal_year=opb_request.fiscal_year,
+        from_status=from_status or '',
+        status=opb_request.status,
+        at=at,
+        by=by if by is not None and by.is_authenticated else None,
+        note=note or '',
+    )
+
+
+def request_history(request_id):
+    """The request's transitions, oldest first"""
+    return list(StatusTransition.objects.filter(request_id=request_id)
+                .select_related('by').order_by('at', 'pk'))
+
+
+def rebuild_turnaround():
+    """Recount ``TurnaroundStat`` from the log; returns the number of rows"""
+    stats = {}
+    since = {}
+    limit = sla_seconds()
+    transitions = (StatusTransition.objects.order_by('request_id', 'at', 'pk')
+                   .values_list('request_id', 'department_id', 'from_status', 'status', 'at')
+                   .iterator(chunk_size=2000))
+    for request_id, unit_id, from_status, status, at in transitions:
+        if from_status == PENDING and request_id in since:
+            seconds = max(int((at - since[request_id]).total_seconds()), 0)
+            key = (unit_id, _month(at), status)
+            row = stats.setdefault(key, {'decisions': 0, 'total_seconds': 0, 'max_seconds': 0, 'within_sla': 0})
+            row['decisions'] += 1
+            row['total_seconds'] += seconds
+            row['max_seconds'] = max(row['max_seconds'], seconds)
+            row['within_sla'] += int(seconds <= limit)
+        if status == PENDING:
+            since[request_id] = at
+
+    with transaction.atomic():
+        TurnaroundStat.objects.all().delete()
+        TurnaroundStat.objects.bulk_create(
+            TurnaroundStat(department_id=unit_id, month=month, outcome=outcome, **row)
+            for (unit_id, month, outcome), row in stats.items()
+        )
+    return len(stats)
+
+
+# Reporting ----------------------------------------------------------------
+
+def _summary(decisions, total_seconds, max_seconds, within_sla):
+    return {
+        'decisions': decisions,
+        'average_days': round(total_seconds / decisions / 86400, 1) if decisions else None,
+        'max_days': round(max_seconds / 86400, 1),
+        'sla_percent': round(100 * within_sla / decisions, 1) if decisions else None,
+    }
+
+
+def turnaround_report(months=12, unit_ids=None):
+    """
+    SLA figures from ``TurnaroundStat`` for the last ``months`` months:
+    ``overall``, ``by_unit`` (slowest first) and ``by_month`` (oldest first),
+    each with decisions, average and max days waited, and percent within SLA.
+    """
+    this_month = _month(timezone.now())
+    index = this_month.year * 12 + this_month.month - months
+    start = this_month.replace(year=index // 12, month=index % 12 + 1)
+    rows = TurnaroundStat.objects.filter(month__gte=start)
+    if unit_ids is not None:
+        rows = rows.filter(department_id__in=unit_ids)
+    rows = list(rows.values('department_id', 'month', 'decisions', 'total_seconds', 'max_seconds', 'within_sla'))
+
+    def group(key):
+        totals = defaultdict(lambda: [0, 0, 0, 0])
+        for row in rows:
+            t = totals[key(row)]
+            t[0] += row['decisions']
+            t[1] += row['total_seconds']
+            t[2] = max(t[2], row['max_seconds'])
+            t[3] += row['within_sla']
+        return totals
+
+    by_unit = [{'unit_id': unit_id, 'unit': unit_name(unit_id), **_summary(*t)}
+               for unit_id, t in group(lambda r: r['department_id']).items()]
+    by_unit.sort(key=lambda row: row['average_days'] or 0, reverse=True)
+    by_month = [{'month': month, **_summary(*t)} for month, t in sorted(group(lambda r: r['month']).items())]
+    overall = group(lambda r: None).get(None, [0, 0, 0, 0])
+    return {
+        'sla_days': getattr(settings, 'APPROVAL_SLA_DAYS', 14),
+        'overall': _summary(*overall),
+        'by_unit': by_unit,
+        'by_month': by_month,
+    }
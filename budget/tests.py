@@ -1,3 +1,890 @@
-from django.test import TestCase
+import os
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Max, Sum
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from accounts.models import Unit, User
+from caobp_system import maintenance as maintenance_module
+from caobp_system.maintenance import (
+    DrainTimeout, bump_generation, enter_maintenance, exit_maintenance, maintenance, read_generation,
+)
+
+from . import backup_schedule, similarity
+from .backup import SQLiteBackupStrategy, backup_dir, backup_store, restore_backup
+from .archive import ArchiveError, close_fiscal_year, report_requests
+from .backup_store import ChunkStore
+from .ceilings import recompute_committed, remaining_balances
+from .cube import PivotError, pivot, rebuild_cube
+from .head_stats import head_stats
+from .similarity import duplicate_pairs, similar_items
+from .status_history import rebuild_turnaround, record_transition
+from .data_transfer import Importer, _to_millisecond, export_to_file
+from .jobs import _write_status, get_job, prune_jobs, start_job
+from .models import (
+    ArchivedNotification, ArchivedOPBItem, ArchivedOPBRequest, BudgetCeiling, BudgetCubeCell, ItemSignature, Notification,
+    OPBItem, OPBRequest, OPBRequestVersion, ResponsibleUnit, SimilarityBucket, StatusTransition,
+    StatusTransitionReadOnly, TurnaroundStat, UnitStatsGeneration,
+)
+from .user_deletion import _delete_in_batches
+from .versions import VersionNotFound, get_version, list_versions, request_content
+
+
+def use_temp_dirs(test):
+    """Point backups, jobs and the maintenance files at a fresh directory"""
+    tmp = tempfile.TemporaryDirectory()
+    test.addCleanup(tmp.cleanup)
+    patcher = override_settings(
+        BACKUP_DIR=os.path.join(tmp.name, 'backups'),
+        JOB_DIR=os.path.join(tmp.name, 'jobs'),
+        MAINTENANCE={'FLAG_FILE': os.path.join(tmp.name, 'maintenance.json'),
+                     'DRAIN_FILE': os.path.join(tmp.name, 'maintenance.drain'),
+                     'GENERATION_FILE': os.path.join(tmp.name, 'maintenance.generation')},
+    )
+    patcher.enable()
+    test.addCleanup(patcher.disable)
+    return tmp.name
+
+
+def wait_for_job(job_id, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        job = get_job(job_id)
+        if job['state'] in ('succeeded', 'failed') or time.monotonic() > deadline:
+            return job
+        time.sleep(0.01)
+
+
+ITEM_FIELDS = ('kra_no', 'objective_no', 'indicators', 'annual_target', 'activities', 'timeframe',
+               'budget_amount', 'source_of_fund', 'responsible_units')
+
+
+def item(kra_no='1', budget_amount='100.00', **fields):
+    return {'kra_no': kra_no, 'budget_amount': budget_amount, **fields}
+
+
+class BudgetTestCase(TestCase):
+    """An admin and two unit heads, with helpers that go through the views"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.cas, cls.coe = Unit.objects.get(code='CAS'), Unit.objects.get(code='COE')
+        cls.admin = User.objects.create_user('admin', 'admin@example.org', 'pw', role='admin', is_staff=True)
+        cls.head = User.objects.create_user('cas_head', 'cas@example.org', 'pw', department=cls.cas)
+        cls.other_head = User.objects.create_user('coe_head', 'coe@example.org', 'pw', department=cls.coe)
+        cls.year = settings.CURRENT_FISCAL_YEAR
+
+    def post(self, user, url_name, data, args=()):
+        self.client.force_login(user)
+        return self.client.post(reverse(url_name, args=args), data)
+
+    @staticmethod
+    def item_data(items):
+        return {f'{name}[]': [str(i.get(name, '')) for i in items] for name in ITEM_FIELDS}
+
+    def submit(self, items, user=None, **fields):
+        """Submit a request; returns it, or the error message"""
+        body = self.post(user or self.head, 'ajax_submit_opb_request', {**fields, **self.item_data(items)}).json()
+        if not body['success']:
+            return body['message']
+        return OPBRequest.objects.get(pk=body['request_id'])
+
+    def edit(self, opb_request, items):
+        self.post(opb_request.department_head, 'head_opb_edit',
+                  {'fiscal_year': opb_request.fiscal_year, **self.item_data(items)}, args=[opb_request.pk])
+        opb_request.refresh_from_db()
+        return opb_request
+
+    def decide(self, opb_request, approve=True, notes=''):
+        body = self.post(self.admin, 'ajax_approve_request' if approve else 'ajax_reject_request',
+                         {'type': 'opb', 'request_id': opb_request.pk, 'notes': notes}).json()
+        self.assertTrue(body['success'], body['message'])
+        opb_request.refresh_from_db()
+        return opb_request
+
+    def delete(self, opb_request):
+        body = self.post(opb_request.department_head, 'ajax_delete_opb_request', {'request_id': opb_request.pk}).json()
+        self.assertTrue(body['success'], body['message'])
+
+    @staticmethod
+    def cube_cells():
+        """The cube's cells as comparable tuples"""
+        return sorted(BudgetCubeCell.objects.values_list(
+            'department_id', 'fiscal_year', 'month', 'status', 'kra_no', 'source_of_fund', 'responsible_units',
+            'items', 'amount'))
+
+    def assertCubeIsCurrent(self):
+        incremental = self.cube_cells()
+        rebuild_cube()
+        self.assertEqual(incremental, self.cube_cells())
+
+
+class ChunkStoreTests(SimpleTestCase):
+    chunk_size = 4096
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = tmp.name
+        self.store = ChunkStore(os.path.join(self.tmp, 'store'), chunk_size=self.chunk_size)
+
+    def write(self, name, data):
+        path = os.path.join(self.tmp, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def ingest(self, name, data):
+        return self.store.ingest(self.write(name, data), name)
+
+    def restored(self, name):
+        dest = self.store.open(name).materialize(os.path.join(self.tmp, f'{name}.restored'))
+        with open(dest, 'rb') as f:
+            return f.read()
+
+    def test_backups_round_trip_byte_for_byte(self):
+        first = os.urandom(self.chunk_size * 3 + 100)
+        # Same file with one chunk changed
+        second = first[:self.chunk_size] + os.urandom(self.chunk_size) + first[self.chunk_size * 2:]
+        self.assertEqual(self.ingest('a.sqlite3', first)['new_chunks'], 4)
+        manifest = self.ingest('b.sqlite3', second)
+        self.assertEqual((manifest['new_chunks'], manifest['new_bytes']), (1, self.chunk_size))
+
+        self.assertEqual(self.restored('a.sqlite3'), first)
+        self.assertEqual(self.restored('b.sqlite3'), second)
+        part = b''.join(self.store.open('b.sqlite3').iter_range(self.chunk_size - 10, self.chunk_size + 20))
+        self.assertEqual(part, second[self.chunk_size - 10:self.chunk_size * 2 + 10])
+        self.assertEqual(self.store.stored_bytes(), len(first) + self.chunk_size)
+
+    def test_repeated_chunks_are_stored_once(self):
+        data = os.urandom(self.chunk_size) * 3
+        self.assertEqual(self.ingest('a.sqlite3', data)['new_chunks'], 1)
+        self.assertEqual(self.store.stored_bytes(), self.chunk_size)
+        self.assertEqual(self.restored('a.sqlite3'), data)
+
+    def test_pruning_removes_only_unreferenced_chunks(self):
+        shared = os.urandom(self.chunk_size * 2)
+        only_a, only_b = os.urandom(self.chunk_size), os.urandom(self.chunk_size)
+        self.ingest('a.sqlite3', shared + only_a)
+        self.ingest('b.sqlite3', shared + only_b)
+        self.ingest('c.sqlite3', shared)
+
+        self.assertTrue(self.store.delete('a.sqlite3'))
+        self.assertEqual(sorted(self.store.names()), ['b.sqlite3', 'c.sqlite3'])
+        self.assertEqual(self.store.stored_bytes(), self.chunk_size * 3)
+        self.assertEqual(self.restored('b.sqlite3'), shared + only_b)
+        self.assertEqual(self.restored('c.sqlite3'), shared)
+
+        self.store.delete('b.sqlite3')
+        self.assertEqual(self.store.stored_bytes(), self.chunk_size * 2)
+        self.assertFalse(self.store.delete('b.sqlite3'))
+        self.assertEqual(self.store.collect_garbage(), 0)
+
+    def test_corrupt_chunk_fails_the_checksum(self):
+        manifest = self.ingest('a.sqlite3', os.urandom(self.chunk_size * 2))
+        with open(self.store.chunk_path(manifest['chunks'][1]), 'r+b') as f:
+            f.write(b'\0')
+        dest = os.path.join(self.tmp, 'restored')
+        with self.assertRaises(ValueError):
+            self.store.open('a.sqlite3').materialize(dest)
+        self.assertFalse(os.path.exists(dest))
+        self.assertFalse(os.path.exists(f'{dest}.partial'))
+
+
+class BackupSchedulerTests(SimpleTestCase):
+    def setUp(self):
+        use_temp_dirs(self)
+
+    def test_in_process_scheduler_is_off_by_default(self):
+        self.assertFalse(settings.BACKUP_SCHEDULE['ENABLED'])
+        self.assertIsNone(backup_schedule.start_scheduler_thread())
+
+    def test_only_one_scheduler_is_leader(self):
+        leader = backup_schedule.acquire_leadership(threading.Event())
+        self.assertTrue(leader.locked)
+        stop = threading.Event()
+        with mock.patch.object(backup_schedule, 'LEADER_RETRY', 0.01):
+            timer = threading.Timer(0.1, stop.set)
+            timer.start()
+            # Stands by until stopped
+            self.assertIsNone(backup_schedule.acquire_leadership(stop))
+            timer.join()
+            leader.release()
+            # ... and takes over once the leader is gone
+            successor = backup_schedule.acquire_leadership(threading.Event())
+        self.assertTrue(successor.locked)
+        successor.release()
+
+    def test_scheduled_backup_is_skipped_during_maintenance(self):
+        enter_maintenance('test')
+        self.addCleanup(exit_maintenance)
+        with mock.patch.object(backup_schedule, 'create_backup') as create_backup:
+            status = backup_schedule.run_scheduled_backup()
+        create_backup.assert_not_called()
+        self.assertEqual(status['state'], 'skipped')
+
+
+class RestoreTests(SimpleTestCase):
+    def setUp(self):
+        self.tmp = use_temp_dirs(self)
+        self.live = os.path.join(self.tmp, 'live.sqlite3')
+        conn = sqlite3.connect(self.live)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('CREATE TABLE note (text TEXT)')
+        conn.execute("INSERT INTO note VALUES ('backed up')")
+        conn.commit()
+        conn.close()
+        self.strategy = SQLiteBackupStrategy()
+        self.strategy.settings_dict = {'NAME': self.live}
+
+    def notes(self):
+        conn = sqlite3.connect(self.live)
+        try:
+            return [row[0] for row in conn.execute('SELECT text FROM note')]
+        finally:
+            conn.close()
+
+    def test_restore_swaps_the_database_and_cleans_up(self):
+        for incremental in (False, True):
+            with self.subTest(incremental=incremental), override_settings(BACKUP_INCREMENTAL=incremental):
+                name = f'caobp_backup_{int(incremental)}.sqlite3'
+                if incremental:
+                    snapshot = os.path.join(self.tmp, 'snapshot.sqlite3')
+                    self.strategy.create(snapshot)
+                    backup_store().ingest(snapshot, name)
+                else:
+                    self.strategy.create(os.path.join(backup_dir(), name))
+                conn = sqlite3.connect(self.live)
+                conn.execute("INSERT INTO note VALUES ('after the backup')")
+                conn.commit()
+                conn.close()
+
+                with mock.patch('budget.backup.get_backup_strategy', return_value=self.strategy):
+                    timings = restore_backup(name, 'admin')
+                self.assertIn('swap_seconds', timings)
+                self.assertEqual(self.notes(), ['backed up'])
+                leftovers = [f for f in os.listdir(backup_dir()) if '.restore' in f]
+                self.assertEqual(leftovers, [])
+
+
+class JobMaintenanceTests(SimpleTestCase):
+    def setUp(self):
+        use_temp_dirs(self)
+
+    def test_restore_waits_for_running_jobs(self):
+        started, release = threading.Event(), threading.Event()
+
+        def slow(job):
+            started.set()
+            release.wait(5)
+            return 'done'
+
+        job_id = start_job('slow', slow)
+        self.assertTrue(started.wait(5))
+        try:
+            with self.assertRaises(DrainTimeout):
+                with maintenance('test', drain_timeout=0.05):
+                    pass
+        finally:
+            release.set()
+        self.assertEqual(wait_for_job(job_id)['state'], 'succeeded')
+        with maintenance('test', drain_timeout=1) as timings:
+            self.assertIn('drain_seconds', timings)
+
+    def test_jobs_do_not_start_during_maintenance(self):
+        ran = []
+        with maintenance('test'), self.assertLogs('budget.jobs', 'ERROR'):
+            job = wait_for_job(start_job('write', lambda job: ran.append(job)))
+        self.assertEqual(job['state'], 'failed')
+        self.assertIn('restored', job['error'])
+        self.assertEqual(ran, [])
+
+
+class JobLivenessTests(BudgetTestCase):
+    def setUp(self):
+        self.dir = use_temp_dirs(self)
+
+    def write_job(self, job_id, state='running', age=0, **fields):
+        at = time.time() - age
+        status = {'id': job_id, 'kind': 'test', 'state': state, 'host': socket.gethostname(), 'pid': os.getpid(),
+                  'created_at': at, 'heartbeat_at': at, 'finished_at': None, 'error': None, **fields}
+        if state in ('succeeded', 'failed'):
+            status['finished_at'] = at
+        os.makedirs(settings.JOB_DIR, exist_ok=True)
+        _write_status(status)
+
+    def poll(self, job_id):
+        self.client.force_login(self.admin)
+        return self.client.get(reverse('ajax_job_status', args=[job_id])).json()['job']
+
+    def test_job_of_an_exited_worker_reads_as_failed(self):
+        worker = subprocess.run([sys.executable, '-c', 'import os; print(os.getpid())'], capture_output=True, text=True)
+        self.write_job('dead', pid=int(worker.stdout))
+        job = self.poll('dead')
+        self.assertEqual(job['state'], 'failed')
+        self.assertIn('exited', job['error'])
+
+    def test_job_without_a_heartbeat_reads_as_failed(self):
+        self.write_job('silent', age=120)
+        self.assertEqual(self.poll('silent')['state'], 'failed')
+        self.write_job('alive', age=5)
+        self.assertEqual(self.poll('alive')['state'], 'running')
+
+    @override_settings(JOB_HEARTBEAT=0.01)
+    def test_quiet_job_keeps_its_heartbeat(self):
+        release = threading.Event()
+        job_id = start_job('quiet', lambda job: release.wait(5))
+        try:
+            deadline = time.monotonic() + 5
+            beats = set()
+            while len(beats) < 3 and time.monotonic() < deadline:
+                job = get_job(job_id)
+                if job['state'] == 'running':
+                    beats.add(job['heartbeat_at'])
+                time.sleep(0.005)
+            self.assertEqual(len(beats), 3)
+        finally:
+            release.set()
+        self.assertEqual(wait_for_job(job_id)['state'], 'succeeded')
+
+    def test_prune_removes_only_old_finished_jobs(self):
+        self.write_job('old_done', 'succeeded', age=3600)
+        self.write_job('new_done', 'failed', age=60)
+        self.write_job('old_dead', 'running', age=3600)
+        self.write_job('running', 'running', age=5)
+        leftover = os.path.join(settings.JOB_DIR, 'old_done.json.1.tmp')
+        open(leftover, 'w').close()
+        os.utime(leftover, (time.time() - 3600,) * 2)
+        self.assertEqual(prune_jobs(retention=600), 3)
+        self.assertEqual(sorted(os.listdir(settings.JOB_DIR)), ['new_done.json', 'running.json'])
+
+
+class DataTransferTests(BudgetTestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, 'export.ndjson.gz')
+        BudgetCeiling.objects.create(unit=self.cas, fiscal_year=self.year, ceiling=1000)
+        first = self.submit([item('1', '100.00', activities='Training', source_of_fund='GAA'),
+                             item('2', '50.00', responsible_units='COE')])
+        self.edit(first, [item('1', '120.00', activities='Training', source_of_fund='GAA')])
+        self.decide(first)
+        self.decide(self.submit([item('3', '75.00')], user=self.other_head), approve=False, notes='Too vague')
+        export_to_file(self.path)
+
+    def contents(self):
+        """Everything the import should reproduce, in comparable form"""
+        return {
+            'users': sorted(User.objects.values_list('username', 'email', 'department__code')),
+            'requests': sorted(
+                (str(pk), code, head, status, _to_millisecond(at))
+                for pk, code, head, status, at in OPBRequest.objects.values_list(
+                    'pk', 'department__code', 'department_head__username', 'status', 'created_at')
+            ),
+            'items': sorted((str(r), k, a, s) for r, k, a, s in OPBItem.objects.values_list(
+                'request_id', 'kra_no', 'budget_amount', 'source_of_fund')),
+            'notifications': sorted((u, str(r), t) for u, r, t in Notification.objects.values_list(
+                'user__username', 'request_id', 'title')),
+            'transitions': sorted((str(r), f, s, _to_millisecond(at)) for r, f, s, at in StatusTransition.objects.values_list(
+                'request_id', 'from_status', 'status', 'at')),
+            'versions': sorted((str(r), n) for r, n in OPBRequestVersion.objects.values_list('request_id', 'number')),
+            'ceilings': sorted(BudgetCeiling.objects.values_list('unit__code', 'fiscal_year', 'ceiling', 'committed')),
+            'cube': sorted(BudgetCubeCell.objects.values_list('department__code', 'status', 'items', 'amount')),
+            'turnaround': sorted(TurnaroundStat.objects.values_list('department__code', 'outcome', 'decisions')),
+        }
+
+    def wipe(self):
+        for model in (StatusTransition, OPBRequestVersion, Notification, OPBRequest, BudgetCeiling,
+                      BudgetCubeCell, TurnaroundStat):
+            model.objects.all().delete()
+        User.objects.all().delete()
+
+    @staticmethod
+    def created(result):
+        return {label: counts['created'] for label, counts in result['counts'].items() if counts['created']}
+
+    def test_export_import_round_trip(self):
+        expected = self.contents()
+        self.wipe()
+        result = Importer(self.path).run()
+        self.assertEqual(result['errors'], [])
+        self.assertEqual(self.created(result), {
+            'accounts.user': 3, 'budget.budgetceiling': 1, 'budget.opbrequest': 2, 'budget.opbitem': 2,
+            'budget.notification': 2, 'budget.statustransition': 4, 'budget.opbrequestversion': 3,
+        })
+        self.assertEqual(self.contents(), expected)
+
+        # A second import of the same file adds nothing
+        again = Importer(self.path).run()
+        self.assertEqual(self.created(again), {})
+        self.assertEqual(again['errors'], [])
+        self.assertEqual(self.contents(), expected)
+
+    def test_interrupted_import_resumes_from_its_checkpoint(self):
+        expected = self.contents()
+        self.wipe()
+
+        class Interrupted(Exception):
+            pass
+
+        def interrupt(line_no, counts):
+            # Stop after the first of the two requests is in
+            if counts['budget.opbrequest']['created']:
+                raise Interrupted
+
+        importer = Importer(self.path, batch_size=1, progress=interrupt)
+        with self.assertRaises(Interrupted):
+            importer.run()
+        self.assertTrue(os.path.exists(importer.checkpoint_path))
+        self.assertEqual(OPBRequest.objects.count(), 1)
+
+        result = Importer(self.path, batch_size=1).run()
+        self.assertEqual(self.contents(), expected)
+        # Counts carry over from the interrupted run
+        self.assertEqual(result['counts']['budget.opbrequest']['created'], 2)
+        self.assertEqual(result['counts']['budget.statustransition']['created'], 4)
+        self.assertFalse(os.path.exists(importer.checkpoint_path))
+
+    def test_emails_are_matched_case_insensitively(self):
+        self.wipe()
+        User.objects.create_user('someone_else', 'CAS@Example.org', 'pw')
+        result = Importer(self.path).run()
+        skipped = [e for e in result['errors'] if e['model'] == 'accounts.user']
+        self.assertEqual(len(skipped), 1)
+        self.assertIn('belongs to another user', skipped[0]['error'])
+        self.assertFalse(User.objects.filter(username='cas_head').exists())
+
+
+class UserDeletionTests(BudgetTestCase):
+    def setUp(self):
+        use_temp_dirs(self)
+        self.ceiling = BudgetCeiling.objects.create(unit=self.cas, fiscal_year=self.year, ceiling=1000)
+        self.last_year = str(int(self.year) - 1)
+        old = self.submit([item('1', '10.00'), item('2', '20.00')], fiscal_year=self.last_year)
+        self.decide(old)
+        close_fiscal_year(self.last_year)
+        self.decide(self.submit([item('1', '100.00'), item('2', '50.00'), item('3', '25.00')]), approve=False)
+        self.submit([item('4', '200.00')])
+        self.kept = self.submit([item('1', '300.00')], user=self.other_head)
+        self.assertEqual(ArchivedOPBItem.objects.count(), 2)
+        self.assertTrue(ArchivedNotification.objects.filter(user_id=self.head.pk).exists())
+
+    def test_user_is_deleted_in_batches(self):
+        job = mock.Mock()
+        result = _delete_in_batches(job, self.head.pk, batch_size=2, pause=0)
+
+        self.assertEqual(result['deleted']['OPB items'], 4)
+        self.assertEqual(result['deleted']['archived OPB items'], 2)
+        messages = [call.args[2] for call in job.progress.call_args_list]
+        self.assertEqual([m for m in messages if m.endswith('of 4 OPB items')],
+                         ['Deleted 2 of 4 OPB items', 'Deleted 4 of 4 OPB items'])
+        self.assertEqual(messages[-1], 'Deleted user')
+
+        self.assertFalse(User.objects.filter(pk=self.head.pk).exists())
+        self.assertFalse(OPBRequest.objects.filter(department_head_id=self.head.pk).exists())
+        self.assertFalse(ArchivedOPBRequest.objects.exists())
+        self.assertFalse(ArchivedOPBItem.objects.exists())
+        self.assertFalse(ArchivedNotification.objects.filter(user_id=self.head.pk).exists())
+        self.assertTrue(OPBRequest.objects.filter(pk=self.kept.pk).exists())
+        # The unit's ceiling and the cube no longer count the deleted items
+        self.ceiling.refresh_from_db()
+        self.assertEqual(self.ceiling.committed, 0)
+        self.assertEqual(self.cube_cells(), [
+            (self.coe.pk, self.year, self.kept.created_at.date().replace(day=1), 'pending', '1', '', '', 1, 300),
+        ])
+        self.assertCubeIsCurrent()
+
+
+class CeilingTests(BudgetTestCase):
+    def setUp(self):
+        self.total = BudgetCeiling.objects.create(unit=self.cas, fiscal_year=self.year, ceiling=1000)
+        self.gaa = BudgetCeiling.objects.create(unit=self.cas, fiscal_year=self.year, source_of_fund='GAA',
+                                                ceiling=300)
+
+    def committed(self):
+        return {b['source_of_fund']: b['committed'] for b in remaining_balances(self.cas.pk, self.year)}
+
+    def assertCommittedIsCurrent(self):
+        self.assertEqual(recompute_committed(), [])
+
+    def test_submission_within_the_ceilings(self):
+        self.assertIsInstance(self.submit([item('1', '200.00', source_of_fund='GAA'), item('2', '500.00')]), OPBRequest)
+        self.assertEqual(self.committed(), {'': 700, 'GAA': 200})
+        # Another unit's request counts against nothing of CAS
+        self.submit([item('1', '5000.00', source_of_fund='GAA')], user=self.other_head)
+        self.assertEqual(self.committed(), {'': 700, 'GAA': 200})
+        self.assertCommittedIsCurrent()
+
+    def test_exceeding_a_ceiling_rolls_back_the_submission(self):
+        self.submit([item('1', '250.00', source_of_fund='GAA')])
+        message = self.submit([item('1', '10.00'), item('2', '100.00', source_of_fund=' GAA ')])
+        self.assertIn('from GAA', message)
+        self.assertIn('only ₱50.00', message)
+        message = self.submit([item('1', '800.00')])
+        self.assertIn('in total', message)
+        self.assertEqual(OPBRequest.objects.count(), 1)
+        self.assertEqual(OPBItem.objects.count(), 1)
+        self.assertEqual(self.committed(), {'': 250, 'GAA': 250})
+        self.assertCommittedIsCurrent()
+
+    def test_edits_move_the_commitment(self):
+        opb_request = self.submit([item('1', '200.00', source_of_fund='GAA'), item('2', '300.00')])
+        self.edit(opb_request, [item('1', '100.00', source_of_fund='GAA'), item('2', '50.00', source_of_fund='SEF')])
+        self.assertEqual(self.committed(), {'': 150, 'GAA': 100})
+        self.edit(opb_request, [item('1', '300.00', source_of_fund='GAA'), item('2', '700.00')])
+        self.assertEqual(self.committed(), {'': 1000, 'GAA': 300})
+        # Too much: the edit is rolled back, items and all
+        self.edit(opb_request, [item('1', '301.00', source_of_fund='GAA')])
+        self.assertEqual(sorted(opb_request.items.values_list('budget_amount', flat=True)), [300, 700])
+        self.assertEqual(self.committed(), {'': 1000, 'GAA': 300})
+        self.assertCommittedIsCurrent()
+
+    def test_delete_releases_the_amount(self):
+        kept = self.submit([item('1', '100.00', source_of_fund='GAA')])
+        deleted = self.submit([item('1', '200.00', source_of_fund='GAA'), item('2', '400.00')])
+        self.delete(deleted)
+        self.assertEqual(self.committed(), {'': 100, 'GAA': 100})
+        self.assertTrue(OPBRequest.objects.filter(pk=kept.pk).exists())
+        # The released amount can be requested again
+        self.assertIsInstance(self.submit([item('1', '200.00', source_of_fund='GAA')]), OPBRequest)
+        self.assertCommittedIsCurrent()
+
+    def test_recompute_repairs_a_drifted_counter(self):
+        self.submit([item('1', '120.00', source_of_fund='GAA'), item('2', '80.00')])
+        BudgetCeiling.objects.filter(pk=self.gaa.pk).update(committed=999)
+        fixed = recompute_committed()
+        self.assertEqual([c.pk for c in fixed], [self.gaa.pk])
+        self.assertEqual(self.committed(), {'': 200, 'GAA': 120})
+
+
+class HeadStatsTests(BudgetTestCase):
+    def setUp(self):
+        # Entries cached by other tests may carry the same keys
+        cache.clear()
+
+    def generation(self, unit):
+        return UnitStatsGeneration.objects.filter(unit=unit).values_list('generation', flat=True).first() or 0
+
+    def test_each_write_bumps_its_unit_once(self):
+        self.assertEqual(head_stats(self.head)['submitted_count'], 0)
+        opb_request = self.submit([item('1', '100.00'), item('2', '50.00'), item('3', '25.00')])
+        self.assertEqual(self.generation(self.cas), 1)
+        self.assertEqual((head_stats(self.head)['pending_count'], head_stats(self.head)['total_budget']), (1, 175))
+
+        self.decide(opb_request)
+        self.assertEqual(self.generation(self.cas), 2)
+        self.assertEqual(head_stats(self.head)['approved_count'], 1)
+        self.edit(opb_request, [item('1', '10.00')])
+        self.assertEqual(self.generation(self.cas), 3)
+        self.assertEqual((head_stats(self.head)['pending_count'], head_stats(self.head)['total_budget']), (1, 10))
+        self.decide(opb_request, approve=False)
+        self.assertEqual(head_stats(self.head)['rejected_count'], 1)
+        self.delete(opb_request)
+        self.assertEqual(self.generation(self.cas), 5)
+        self.assertEqual(head_stats(self.head)['submitted_count'], 0)
+        # Other units keep their cached entries
+        self.assertEqual(self.generation(self.coe), 0)
+
+    def test_closing_a_year_bumps_its_units(self):
+        last_year = str(int(self.year) - 1)
+        self.submit([item()], fiscal_year=last_year)
+        self.assertEqual(head_stats(self.head)['submitted_count'], 1)
+        close_fiscal_year(last_year)
+        self.assertEqual(head_stats(self.head)['submitted_count'], 0)
+
+    def test_restore_clears_the_cache(self):
+        use_temp_dirs(self)
+        self.submit([item()])
+        self.assertEqual(head_stats(self.head)['pending_count'], 1)
+        # As a restore would: the rows change without a new unit generation
+        OPBRequest.objects.update(status='for-approval')
+        self.assertEqual(head_stats(self.head)['pending_count'], 1)
+        with mock.patch.object(maintenance_module, '_seen_generation', read_generation()), \
+                mock.patch.object(maintenance_module, 'connections'):
+            bump_generation()
+            self.client.force_login(self.head)
+            self.client.get(reverse('head_opb'))
+        self.assertEqual(head_stats(self.head)['pending_count'], 0)
+        self.assertEqual(head_stats(self.head)['approved_count'], 1)
+
+
+class CloseFiscalYearTests(BudgetTestCase):
+    def setUp(self):
+        self.last_year = str(int(self.year) - 1)
+        closing = [
+            self.submit([item('1', responsible_units='COE'), item('2')], fiscal_year=self.last_year),
+            self.submit([item('1')], fiscal_year=self.last_year),
+            self.submit([item('1')], user=self.other_head, fiscal_year=self.last_year),
+        ]
+        for opb_request in closing:
+            self.decide(opb_request)
+        self.closing = {r.pk for r in closing}
+        self.open = self.decide(self.submit([item('1', responsible_units='COE')]))
+        Notification.objects.create(user=self.head, title='Welcome', message='About no request')
+
+    def test_close_moves_the_year_in_batches_and_resumes(self):
+        class Interrupted(Exception):
+            pass
+
+        def interrupt(moved):
+            raise Interrupted
+
+        with self.assertRaises(Interrupted):
+            close_fiscal_year(self.last_year, batch_size=1, progress=interrupt)
+        # Closed before anything moved; the first batch is in the archive
+        self.assertIn('is closed', self.submit([item()], fiscal_year=self.last_year))
+        self.assertEqual(ArchivedOPBRequest.objects.count(), 1)
+        self.assertEqual(OPBRequest.objects.filter(fiscal_year=self.last_year).count(), 2)
+        left = OPBItem.objects.filter(request__fiscal_year=self.last_year).count()
+
+        batches = []
+        record, moved = close_fiscal_year(self.last_year, batch_size=1, progress=lambda m: batches.append(dict(m)))
+        self.assertEqual(moved, {'requests': 2, 'items': left, 'notifications': 3})
+        self.assertEqual(len(batches), 5)
+        self.assertEqual((record.requests, record.items, record.notifications), (3, 4, 3))
+        self.assertEqual(set(ArchivedOPBRequest.objects.values_list('pk', flat=True)), self.closing)
+        self.assertEqual(ArchivedOPBItem.objects.count(), 4)
+        self.assertFalse(OPBRequest.objects.filter(fiscal_year=self.last_year).exists())
+        self.assertEqual(set(report_requests(self.last_year).values_list('pk', flat=True)), self.closing)
+
+        # Running it again finds nothing left to move
+        record, moved = close_fiscal_year(self.last_year)
+        self.assertEqual(moved, {'requests': 0, 'items': 0, 'notifications': 0})
+        self.assertEqual((record.requests, record.items, record.notifications), (3, 4, 3))
+
+    def test_notifications_stay_with_their_requests_year(self):
+        close_fiscal_year(self.last_year, batch_size=2)
+        self.assertEqual(set(ArchivedNotification.objects.values_list('request_id', flat=True)), self.closing)
+        self.assertEqual(sorted(Notification.objects.values_list('request_id', flat=True), key=str),
+                         sorted([None, self.open.pk], key=str))
+
+    def test_closed_items_leave_the_indexes(self):
+        close_fiscal_year(self.last_year)
+        self.assertEqual(set(ResponsibleUnit.objects.values_list('item__request_id', flat=True)), {self.open.pk})
+        self.assertFalse(ItemSignature.objects.filter(fiscal_year=self.last_year).exists())
+        self.assertFalse(SimilarityBucket.objects.filter(fiscal_year=self.last_year).exists())
+        # The cube keeps the closed year
+        self.assertCubeIsCurrent()
+        self.assertTrue(BudgetCubeCell.objects.filter(fiscal_year=self.last_year).exists())
+
+    def test_current_year_is_refused(self):
+        with self.assertRaises(ArchiveError):
+            close_fiscal_year(self.year)
+        with self.assertRaises(ArchiveError):
+            close_fiscal_year('25')
+
+
+class StatusHistoryTests(BudgetTestCase):
+    def turnaround(self):
+        return sorted(TurnaroundStat.objects.values_list(
+            'department_id', 'month', 'outcome', 'decisions', 'total_seconds', 'max_seconds', 'within_sla'))
+
+    def assertTurnaroundIsCurrent(self):
+        incremental = self.turnaround()
+        rebuild_turnaround()
+        self.assertEqual(incremental, self.turnaround())
+
+    def logged_request(self, days_waited):
+        """A request decided ``days_waited`` days after it was submitted"""
+        opb_request = OPBRequest.objects.create(department_head=self.head, department=self.cas,
+                                                fiscal_year=self.year)
+        record_transition(opb_request, '', at=opb_request.created_at)
+        opb_request.status = 'for-approval'
+        record_transition(opb_request, 'pending', by=self.admin,
+                          at=opb_request.created_at + timedelta(days=days_waited))
+        return opb_request
+
+    def test_record_transition(self):
+        opb_request = self.logged_request(3)
+        self.assertIsNone(record_transition(opb_request, 'for-approval'))
+        self.assertEqual(list(StatusTransition.objects.filter(request_id=opb_request.pk)
+                              .order_by('at').values_list('from_status', 'status', 'by')),
+                         [('', 'pending', None), ('pending', 'for-approval', self.admin.pk)])
+        self.logged_request(30)
+        self.logged_request(1)
+        # Decisions count in the month they were made
+        stats = TurnaroundStat.objects.aggregate(decisions=Sum('decisions'), within_sla=Sum('within_sla'),
+                                                 total_seconds=Sum('total_seconds'), max_seconds=Max('max_seconds'))
+        self.assertEqual(stats, {'decisions': 3, 'within_sla': 2,
+                                 'total_seconds': 34 * 86400, 'max_seconds': 30 * 86400})
+
+    def test_request_logged_before_the_history_gets_its_submission(self):
+        opb_request = OPBRequest.objects.create(department_head=self.head, department=self.cas,
+                                                fiscal_year=self.year)
+        opb_request.status = 'enhancement'
+        record_transition(opb_request, 'pending', at=opb_request.created_at + timedelta(days=2))
+        self.assertEqual(StatusTransition.objects.filter(request_id=opb_request.pk).count(), 2)
+        self.assertEqual(TurnaroundStat.objects.get().total_seconds, 2 * 86400)
+
+    def test_logged_rows_cannot_be_changed(self):
+        self.logged_request(1)
+        transition = StatusTransition.objects.first()
+        with self.assertRaises(StatusTransitionReadOnly):
+            transition.save()
+        with self.assertRaises(StatusTransitionReadOnly):
+            transition.delete()
+
+    def test_rebuild_matches_the_incremental_statistics(self):
+        for days in (1, 5, 20):
+            self.logged_request(days)
+        opb_request = self.submit([item()])
+        self.decide(opb_request, approve=False)
+        self.edit(opb_request, [item('2')])
+        self.decide(opb_request)
+        self.decide(self.submit([item()], user=self.other_head))
+        self.assertEqual(sum(TurnaroundStat.objects.values_list('decisions', flat=True)), 6)
+        self.assertTurnaroundIsCurrent()
+
+    def test_import_skips_logged_transitions(self):
+        self.decide(self.submit([item()]))
+        self.decide(self.submit([item()], user=self.other_head), approve=False)
+        expected = self.turnaround()
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        path = os.path.join(tmp.name, 'export.ndjson.gz')
+        export_to_file(path)
+
+        result = Importer(path).run()
+        self.assertEqual(result['counts']['budget.statustransition'], {'created': 0, 'existing': 4, 'skipped': 0})
+        self.assertEqual(self.turnaround(), expected)
+
+        # A transition lost from the log comes back, and the statistics are recounted
+        StatusTransition.objects.filter(pk=StatusTransition.objects.filter(from_status='pending')
+                                        .order_by('at').values('pk')[:1]).delete()
+        TurnaroundStat.objects.all().delete()
+        result = Importer(path).run()
+        self.assertEqual(result['counts']['budget.statustransition'], {'created': 1, 'existing': 3, 'skipped': 0})
+        self.assertEqual(self.turnaround(), expected)
+
+
+@override_settings(OPB_VERSION_CHECKPOINT_EVERY=3)
+class VersionTests(BudgetTestCase):
+    def test_every_version_is_reconstructed_exactly(self):
+        rows = [item(str(n), f'{n}00.00', activities=f'Activity {n}') for n in range(1, 5)]
+        opb_request = self.submit(rows)
+        contents = [request_content(opb_request)]
+        edits = [
+            lambda rows: [rows[0], {**rows[1], 'budget_amount': '250.00'}, *rows[2:]],
+            lambda rows: rows[:2] + [item('9', '900.00', activities='Inserted')] + rows[2:],
+            lambda rows: rows[:1] + rows[2:],
+            lambda rows: list(reversed(rows)),
+            lambda rows: rows + [item('10', '10.00'), item('11', '11.00')],
+            lambda rows: [{**row, 'source_of_fund': 'GAA'} for row in rows],
+            lambda rows: rows[1:-1],
+            lambda rows: [item('12', '1.00')],
+            lambda rows: rows + [item('13', '2.00', responsible_units='COE')],
+        ]
+        for edit in edits:
+            rows = edit(rows)
+            self.edit(opb_request, rows)
+            contents.append(request_content(opb_request))
+        self.assertEqual([i['kra_no'] for i in contents[-1]['items']], ['12', '13'])
+        # Saving the same items again is not a new version
+        self.edit(opb_request, rows)
+
+        versions = list_versions(opb_request.pk)
+        self.assertEqual([v.number for v in versions], list(range(1, len(edits) + 2)))
+        self.assertEqual([v.number for v in versions if v.checkpoint], [1, 4, 7, 10])
+        for number, content in enumerate(contents, start=1):
+            self.assertEqual(get_version(opb_request.pk, number), content, f'version {number}')
+        with self.assertRaises(VersionNotFound):
+            get_version(opb_request.pk, len(contents) + 1)
+
+
+class CubeTests(BudgetTestCase):
+    def setUp(self):
+        self.supply = Unit.objects.get(code='SUPPLY_UNIT')
+        self.supply_head = User.objects.create_user('supply_head', 'supply@example.org', 'pw', department=self.supply)
+
+    def test_writes_keep_the_cube_equal_to_a_rebuild(self):
+        first = self.submit([item('1', '100.00', source_of_fund='GAA'), item('1', '50.00', source_of_fund='GAA'),
+                             item('2', '25.00', responsible_units='COE')])
+        second = self.submit([item('1', '300.00')], user=self.other_head)
+        self.assertCubeIsCurrent()
+        self.edit(first, [item('1', '120.00', source_of_fund='GAA'), item('3', '10.00', source_of_fund='SEF')])
+        self.assertCubeIsCurrent()
+        self.decide(first)
+        self.decide(second, approve=False)
+        self.assertCubeIsCurrent()
+        self.edit(second, [item('1', '200.00')])
+        self.delete(first)
+        self.assertCubeIsCurrent()
+        self.assertEqual(pivot([])['totals'], {'items': 1, 'amount': 200})
+
+    def test_unit_filter_rolls_up_the_subtree(self):
+        self.submit([item('1', '100.00')])
+        self.submit([item('1', '300.00'), item('2', '50.00')], user=self.other_head)
+        self.submit([item('1', '1000.00')], user=self.supply_head)
+
+        vpaa = pivot(['unit'], {'unit': 'OFFICE_VPAA'})
+        self.assertEqual([(row['unit']['code'], row['items'], row['amount']) for row in vpaa['rows']],
+                         [('COE', 2, 350), ('CAS', 1, 100)])
+        self.assertEqual(vpaa['totals'], {'items': 3, 'amount': 450})
+        self.assertEqual(pivot([], {'unit': ['CAS', 'SUPPLY_UNIT']})['totals'], {'items': 2, 'amount': 1100})
+
+        month = timezone.localdate().strftime('%Y-%m')
+        by_kra = pivot(['kra', 'month'], {'month': month, 'fiscal_year': self.year})
+        self.assertEqual([(row['kra'], row['month'], row['amount']) for row in by_kra['rows']],
+                         [('1', month, 1400), ('2', month, 50)])
+
+    def test_bad_dimensions_and_values(self):
+        with self.assertRaisesMessage(PivotError, 'Unknown dimension(s): colour'):
+            pivot(['colour'])
+        with self.assertRaises(PivotError):
+            pivot(['unit'], {'size': 'large'})
+        for month in ('2026-13', 'January', '2026'):
+            with self.assertRaises(PivotError, msg=month):
+                pivot([], {'month': month})
+        with self.assertRaisesMessage(PivotError, 'Unknown unit'):
+            pivot([], {'unit': 'NOWHERE'})
+
+
+class SimilarityTests(BudgetTestCase):
+    TRAINING = 'Conduct a faculty training workshop on research methods and publication'
+
+    def test_near_duplicates_are_found(self):
+        original = self.submit([item('1', '500.00', activities=self.TRAINING, indicators='Faculty trained')])
+        opb_request = self.submit([
+            item('1', '450.00', activities=self.TRAINING.replace('workshop', 'workshops'), indicators='Faculty trained'),
+            item('2', '900.00', activities='Procurement of laboratory equipment for the chemistry building',
+                 indicators='Equipment delivered'),
+        ], user=self.other_head)
+        copy, unrelated = opb_request.items.order_by('kra_no')
+
+        matches = similar_items(opb_request)
+        self.assertEqual(list(matches), [copy.pk])
+        [match] = matches[copy.pk]
+        self.assertEqual((match['item_id'], match['request_id'], match['same_request']),
+                         (original.items.get().pk, original.pk, False))
+        self.assertGreaterEqual(match['similarity'], 0.6)
+        self.assertNotIn(unrelated.pk, matches)
+
+        [pair] = duplicate_pairs(self.year)
+        self.assertEqual({pair['first']['item_id'], pair['second']['item_id']}, {copy.pk, original.items.get().pk})
+        self.assertEqual(pair['combined_budget'], 950)
+        # Pairs within one unit are only reported when asked for
+        self.submit([item('3', '10.00', activities=self.TRAINING, indicators='Faculty trained')])
+        self.assertEqual(len(duplicate_pairs(self.year)), 2)
+        self.assertEqual(len(duplicate_pairs(self.year, include_same_unit=True)), 3)
+
+    def test_large_buckets_are_capped(self):
+        for _ in range(4):
+            opb_request = self.submit([item(activities=self.TRAINING)])
+        own = opb_request.items.get()
+        self.assertEqual(len(similar_items(opb_request)[own.pk]), 3)
+        with mock.patch.object(similarity, 'MAX_BUCKET', 2):
+            matches = similar_items(opb_request)[own.pk]
+        self.assertEqual(len(matches), 2)
+        self.assertEqual({m['similarity'] for m in matches}, {1.0})
@@ -19,6 +19,7 @@ urlpatterns = [
     
     # AJAX endpoints
     path('ajax/add-user/', views.ajax_add_user, name='ajax_add_user'),
+    path('ajax/bulk-import-users/', views.ajax_bulk_import_users, name='ajax_bulk_import_users'),
     path('ajax/get-user/<int:user_id>/', views.ajax_get_user, name='ajax_get_user'),
     path('ajax/edit-user/', views.ajax_edit_user, name='ajax_edit_user'),
     path('ajax/delete-user/', views.ajax_delete_user, name='ajax_delete_user'),
@@ -26,6 +27,10 @@ urlpatterns = [
     path('ajax/approve-request/', views.ajax_approve_request, name='ajax_approve_request'),
     path('ajax/reject-request/', views.ajax_reject_request, name='ajax_reject_request'),
     path('ajax/submit-opb-request/', views.ajax_submit_opb_request, name='ajax_submit_opb_request'),
+    path('ajax/budget-balance/', views.ajax_budget_balance, name='ajax_budget_balance'),
+    path('ajax/opb-versions/<uuid:request_id>/', views.ajax_opb_versions, name='ajax_opb_versions'),
+    path('ajax/budget-pivot/', views.ajax_budget_pivot, name='ajax_budget_pivot'),
+    path('ajax/unit-responsibilities/', views.ajax_unit_responsibilities, name='ajax_unit_responsibilities'),
     path('ajax/delete-opb-request/', views.ajax_delete_opb_request, name='ajax_delete_opb_request'),
     path('ajax/mark-notification-read/', views.ajax_mark_notification_read, name='ajax_mark_notification_read'),
     path('ajax/delete-notification/', views.ajax_delete_notification, name='ajax_delete_notification'),
@@ -37,4 +42,6 @@ urlpatterns = [
     path('ajax/download-backup/', views.ajax_download_backup, name='ajax_download_backup'),
     path('ajax/delete-backup/', views.ajax_delete_backup, name='ajax_delete_backup'),
     path('ajax/restore-backup/', views.ajax_restore_backup, name='ajax_restore_backup'),
+    path('ajax/export-data/', views.ajax_export_data, name='ajax_export_data'),
+    path('ajax/job-status/<str:job_id>/', views.ajax_job_status, name='ajax_job_status'),
 ]
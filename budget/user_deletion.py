@@ -0,0 +1,91 @@
+"""
+Background deletion of users and everything they own.
+
+``user.delete()`` makes Django's collector load every dependent row into
+memory and delete it all in one transaction. For a long-serving unit head
+that is slow and holds the SQLite write lock for the whole time. Instead the
+user is deactivated at once (so they are logged out and cannot sign in),
+and a background job deletes their rows in small batches, children before
+parents, each batch in its own short write transaction.
+"""
+import time
+
+from django.conf import settings
+
+from accounts.models import PasswordResetCode, User
+from caobp_system.write_gate import serialized_atomic
+
+from .ceilings import release_items
+from .cube import remove_items_from_cube
+from .head_stats import invalidate_unit
+from .jobs import start_job
+from .models import (
+    ArchivedNotification, ArchivedOPBItem, ArchivedOPBRequest, Notification, OPBItem, OPBRequest,
+)
+
+# (description, queryset of the user's rows); children before parents
+DELETION_PLAN = (
+    ('OPB items', lambda user_id: OPBItem.objects.filter(request__department_head_id=user_id)),
+    ('OPB requests', lambda user_id: OPBRequest.objects.filter(department_head_id=user_id)),
+    ('notifications', lambda user_id: Notification.objects.filter(user_id=user_id)),
+    ('archived OPB items', lambda user_id: ArchivedOPBItem.objects.filter(request__department_head_id=user_id)),
+    ('archived OPB requests', lambda user_id: ArchivedOPBRequest.objects.filter(department_head_id=user_id)),
+    ('archived notifications', lambda user_id: ArchivedNotification.objects.filter(user_id=user_id)),
+    ('password reset codes', lambda user_id: PasswordResetCode.objects.filter(user_id=user_id)),
+)
+
+
+def _delete_in_batches(job, user_id, batch_size, pause):
+    counts = {description: rows(user_id).count() for description, rows in DELETION_PLAN}
+    total = sum(counts.values()) + 1
+    done = 0
+    deleted = {}
+    for description, rows in DELETION_PLAN:
+        deleted[description] = 0
+        while True:
+            with serialized_atomic():
+                pks = list(rows(user_id).order_by('pk').values_list('pk', flat=True)[:batch_size])
+                if not pks:
+                    break
+                if rows(user_id).model is OPBItem:
+                    # Give the unit back their share of its budget ceilings
+                    release_items(pks)
+                if rows(user_id).model in (OPBItem, ArchivedOPBItem):
+                    remove_items_from_cube(pks, rows(user_id).model)
+                if rows(user_id).model in (OPBItem, OPBRequest):
+                    unit_field = 'request__department_id' if rows(user_id).model is OPBItem else 'department_id'
+                    units = set(rows(user_id).filter(pk__in=pks).values_list(unit_field, flat=True))
+                else:
+                    units = set()
+                rows(user_id).model.objects.filter(pk__in=pks).delete()
+                for unit_id in units:
+                    invalidate_unit(unit_id)
+            deleted[description] += len(pks)
+            done += len(pks)
+            job.progress(done, total, f'Deleted {deleted[description]} of {counts[description]} {description}')
+            # Give other writers a turn between batches
+            time.sleep(pause)
+
+    with serialized_atomic():
+        # Anything left (e.g. rows created after the counts) goes with the user
+        User.objects.filter(pk=user_id).delete()
+    job.progress(total, total, 'Deleted user')
+    return {'user_id': user_id, 'deleted': deleted}
+
+
+def start_user_deletion(user, created_by=None):
+    """
+    Deactivate ``user`` now and delete them in the background.
+
+    Returns the job id.
+    """
+    with serialized_atomic():
+        User.objects.filter(pk=user.pk).update(is_active=False)
+    return start_job(
+        'delete_user',
+        _delete_in_batches,
+        user.pk,
+        getattr(settings, 'USER_DELETE_BATCH_SIZE', 500),
+        getattr(settings, 'USER_DELETE_BATCH_PAUSE', 0.05),
+        created_by=created_by,
+    )
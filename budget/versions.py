@@ -0,0 +1,203 @@
+"""
+Versions of OPB requests.
+
+Every submission and edit saves a version of the request's content: its
+fiscal year and unit and the ordered list of its items. Version 1 and every
+``OPB_VERSION_CHECKPOINT_EVERY``-th version after it are checkpoints that
+hold the whole content. The others hold only a delta against the previous
+version, so storage grows with the size of each edit, not of the request::
+
+    {"fields": {"unit": "..."},
+     "items": [["eq", 12], ["chg", {"budget_amount": "5000.00"}], ["del", 1],
+               ["ins", {"kra_no": "3", ...}]]}
+
+Items are lined up with ``difflib.SequenceMatcher``, so inserting or
+removing a row in the middle stays a one-row delta. Any version is rebuilt
+from its nearest checkpoint and the few deltas after it, read in one query.
+"""
+from difflib import SequenceMatcher
+
+from django.conf import settings
+
+from .models import OPBRequestVersion
+
+REQUEST_FIELDS = ('fiscal_year', 'unit')
+ITEM_FIELDS = (
+    'kra_no', 'objective_no', 'indicators', 'annual_target', 'activities', 'timeframe',
+    'budget_amount', 'source_of_fund', 'responsible_units',
+)
+
+
+class VersionNotFound(Exception):
+    """Raised when a request has no such version"""
+
+
+def _checkpoint_every():
+    return max(getattr(settings, 'OPB_VERSION_CHECKPOINT_EVERY', 10), 1)
+
+
+def _text(value):
+    return '' if value is None else str(value)
+
+
+def request_content(opb_request):
+    """The versioned content of ``opb_request`` as it is in the database now"""
+    items = opb_request.items.order_by('pk').values_list(*ITEM_FIELDS)
+    return {
+        'fields': {name: _text(getattr(opb_request, name)) for name in REQUEST_FIELDS},
+        'items': [dict(zip(ITEM_FIELDS, map(_text, row))) for row in items],
+    }
+
+
+# Deltas -------------------------------------------------------------------
+
+def _signature(item):
+    return tuple(item.get(name, '') for name in ITEM_FIELDS)
+
+
+def item_ops(old, new):
+    """Edit operations turning the item list ``old`` into ``new``"""
+    ops = []
+    matcher = SequenceMatcher(None, [_signature(i) for i in old], [_signature(i) for i in new], autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            ops.append(['eq', i2 - i1])
+            continue
+        paired = min(i2 - i1, j2 - j1) if tag == 'replace' else 0
+        for old_item, new_item in zip(old[i1:i1 + paired], new[j1:j1 + paired]):
+            ops.append(['chg', {k: v for k, v in new_item.items() if old_item.get(k) != v}])
+        if i2 - i1 > paired:
+            ops.append(['del', i2 - i1 - paired])
+        for item in new[j1 + paired:j2]:
+            ops.append(['ins', item])
+    # Trailing unchanged items are implied
+    if ops and ops[-1][0] == 'eq':
+        ops.pop()
+    return ops
+
+
+def apply_ops(old, ops):
+    items, pos = [], 0
+    for op, arg in ops:
+        if op == 'eq':
+            items.extend(old[pos:pos + arg])
+            pos += arg
+        elif op == 'chg':
+            items.append({**old[pos], **arg})
+            pos += 1
+        elif op == 'del':
+            pos += arg
+        elif op == 'ins':
+            items.append(arg)
+    items.extend(old[pos:])
+    return items
+
+
+def make_delta(old, new):
+    """Delta turning the content ``old`` into ``new``, or ``None`` if equal"""
+    fields = {k: v for k, v in new['fields'].items() if old['fields'].get(k) != v}
+    ops = item_ops(old['items'], new['items'])
+    if not fields and not ops:
+        return None
+    return {'fields': fields, 'items': ops}
+
+
+def apply_delta(content, delta):
+    return {
+        'fields': {**content['fields'], **delta['fields']},
+        'items': apply_ops(content['items'], delta['items']),
+    }
+
+
+# Saving -------------------------------------------------------------------
+
+def _create(request_id, number, checkpoint, data, by, at=None):
+    extra = {'at': at} if at else {}
+    by = by if by is not None and by.is_authenticated else None
+    # The unique (request_id, number) constraint fails a concurrent edit
+    return OPBRequestVersion.objects.create(request_id=request_id, number=number, checkpoint=checkpoint,
+                                            data=data, by=by, **extra)
+
+
+def record_version(opb_request, previous=None, by=None):
+    """
+    Save the current content of ``opb_request`` as its next version.
+
+    ``previous`` is the content before the change (``request_content()``
+    taken at the start of the edit); requests from before versioning get it
+    saved as their version 1 first. Returns the new version, or ``None`` if
+    nothing changed. Run it in the transaction that changes the request.
+    """
+    content = request_content(opb_request)
+    last = (OPBRequestVersion.objects.filter(request_id=opb_request.pk)
+            .order_by('-number').values_list('number', flat=True).first())
+    if last is None:
+        if previous is None:
+            return _create(opb_request.pk, 1, True, content, by)
+        _create(opb_request.pk, 1, True, previous, None, at=opb_request.created_at)
+        last = 1
+    elif previous is None:
+        previous = get_version(opb_request.pk, last)
+
+    delta = make_delta(previous, content)
+    if delta is None:
+        return None
+    number = last + 1
+    if (number - 1) % _checkpoint_every() == 0:
+        return _create(opb_request.pk, number, True, content, by)
+    return _create(opb_request.pk, number, False, delta, by)
+
+
+# Reading ------------------------------------------------------------------
+
+def list_versions(request_id):
+    """Versions of a request, oldest first, without their content"""
+    return list(OPBRequestVersion.objects.filter(request_id=request_id)
+                .select_related('by').defer('data').order_by('number'))
+
+
+def get_version(request_id, number):
+    """The content of version ``number``, from its checkpoint and the deltas after it"""
+    start = (OPBRequestVersion.objects.filter(request_id=request_id, number__lte=number, checkpoint=True)
+             .order_by('-number').values_list('number', flat=True).first())
+    if start is None:
+        raise VersionNotFound(f'Version {number} of request {request_id} does not exist')
+    rows = list(OPBRequestVersion.objects.filter(request_id=request_id, number__gte=start, number__lte=number)
+                .order_by('number').values_list('number', 'data'))
+    if rows[-1][0] != number:
+        raise VersionNotFound(f'Version {number} of request {request_id} does not exist')
+    content = rows[0][1]
+    for _, delta in rows[1:]:
+        content = apply_delta(content, delta)
+    return content
+
+
+def diff_versions(request_id, old_number, new_number):
+    """
+    Side-by-side comparison of two versions: changed request fields and one
+    row per item, each ``same``, ``changed``, ``added`` or ``removed``.
+    """
+    old, new = get_version(request_id, old_number), get_version(request_id, new_number)
+    fields = [{'field': name, 'old': old['fields'].get(name, ''), 'new': new['fields'].get(name, '')}
+              for name in REQUEST_FIELDS if old['fields'].get(name) != new['fields'].get(name)]
+    rows, pos, new_pos = [], 0, 0
+    ops = item_ops(old['items'], new['items'])
+    for op, arg in ops + [['eq', len(old['items'])]]:
+        if op == 'eq':
+            for item in old['items'][pos:pos + arg]:
+                rows.append({'status': 'same', 'old': item, 'new': item, 'changed': []})
+            pos += arg
+            new_pos += arg
+        elif op == 'chg':
+            rows.append({'status': 'changed', 'old': old['items'][pos], 'new': new['items'][new_pos],
+                         'changed': sorted(arg)})
+            pos += 1
+            new_pos += 1
+        elif op == 'del':
+            for item in old['items'][pos:pos + arg]:
+                rows.append({'status': 'removed', 'old': item, 'new': None, 'changed': []})
+            pos += arg
+        elif op == 'ins':
+            rows.append({'status': 'added', 'old': None, 'new': arg, 'changed': []})
+            new_pos += 1
+    return {'from': old_number, 'to': new_number, 'fields': fields, 'items': rows}
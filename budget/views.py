@@ -1,15 +1,42 @@
 from django.shortcuts import render, redirect, get_object_or_404
+from django.urls import reverse
 from django.contrib.auth.decorators import login_required
 from django.contrib.admin.views.decorators import staff_member_required
-from django.http import JsonResponse, HttpResponse
+from django.http import JsonResponse, HttpResponse, StreamingHttpResponse
 from django.contrib import messages
 from django.db.models import Sum, Count, Q
 from django.utils import timezone
 from django.core.paginator import Paginator
 from django.contrib.auth import get_user_model
 from datetime import datetime, timedelta
-from .models import Notification, OPBRequest, OPBItem
+from .models import Notification, OPBRequest, OPBItem, current_fiscal_year
+from .analytics import analytics_available, export_tables, report_analytics
+from .archive import ALL_ARCHIVED, check_open, closed_fiscal_years, open_fiscal_years, report_requests
+from .backup import (
+    BackupError, backup_dir as get_backup_dir, create_backup, delete_backup, get_backup_strategy,
+    open_backup, read_backup_metadata, restore_backup,
+)
+from .backup_catalog import catalog_entries
+from .backup_schedule import read_schedule_status, schedule_config
+from .data_transfer import export_lines
+from .downloads import available_compressions, file_download_response, gzip_stream
+from .head_stats import head_stats, invalidate_unit
+from .ceilings import CeilingExceeded, commit_request, recommit, release_request, remaining_balances, snapshot
+from .cube import DIMENSION_LABELS, DIMENSIONS, PivotError, add_to_cube, pivot, remove_from_cube
+from .jobs import get_job, start_job
+from .responsibilities import index_request, responsibility_summary, unit_responsibilities
+from .rollups import in_subtree, subtree_ids, unit_drilldown
+from .similarity import duplicate_pairs, sign_request, similar_items
+from .status_history import record_transition, turnaround_report
+from .user_deletion import start_user_deletion
+from .versions import diff_versions, list_versions, record_version, request_content
+from accounts.bulk_import import import_users, read_csv
 from accounts.models import User
+from accounts.units import get_unit, unit_choices, unit_code, unit_id, unit_name
+from caobp_system.maintenance import maintenance_exempt
+from caobp_system.replica import read_from_replica
+from caobp_system.standby import standby_config, standby_status
+from caobp_system.write_gate import get_write_gate, serialized_atomic, serialized_write, write_gate_enabled
 import json
 import csv
 import os
@@ -27,29 +54,48 @@ def decimal_default(obj):
         return float(obj)
     raise TypeError
 
+
+def unit_head_unit_ids():
+    """Ids of the units that have a unit head"""
+    return list(User.objects.filter(role='unit_head', department__isnull=False).values_list('department_id', flat=True))
+
+
+def request_counts_by_unit(opb_requests=None):
+    """``{unit id: number of OPB requests}`` in one grouped query"""
+    opb_requests = OPBRequest.objects.all() if opb_requests is None else opb_requests
+    rows = opb_requests.order_by().values('department_id').annotate(count=Count('id'))
+    return {row['department_id']: row['count'] for row in rows}
+
+
+def budget_by_unit(opb_requests=None):
+    """``{unit id: total item budget}`` in one grouped query (also for archived requests)"""
+    opb_requests = OPBRequest.objects.all() if opb_requests is None else opb_requests
+    rows = opb_requests.order_by().values('department_id').annotate(total=Sum('items__budget_amount'))
+    return {row['department_id']: row['total'] or 0 for row in rows}
+
 @login_required
 @staff_member_required
+@read_from_replica
 def admin_dashboard(request):
     # Get statistics
-    total_departments = User.objects.filter(role='unit_head').values('department').distinct().count()
+    all_departments = unit_head_unit_ids()
+    total_departments = len(all_departments)
     total_opb_requests = OPBRequest.objects.count()
     total_requests = total_opb_requests 
     pending_requests = OPBRequest.objects.filter(status='pending').count()
     
-    # Get all departments
-    all_departments = User.objects.filter(role='unit_head').values_list('department', flat=True).distinct()
-    
     # Calculate submitted departments
+    request_counts = request_counts_by_unit()
     submitted_depts = set()
     submitted_breakdown = []
     for dept in all_departments:
-        dept_count = OPBRequest.objects.filter(department=dept).count()
+        dept_count = request_counts.get(dept, 0)
         if dept_count > 0:
             submitted_depts.add(dept)
             submitted_breakdown.append({
-                'department': dept,
+                'department': unit_code(dept),
                 'count': dept_count,
-                'display': dict(User.UNIT_CHOICES).get(dept, dept)
+                'display': unit_name(dept)
             })
     
     # Calculate not submitted departments
@@ -57,8 +103,8 @@ def admin_dashboard(request):
     not_submitted_breakdown = []
     for dept in not_submitted_depts:
         not_submitted_breakdown.append({
-            'department': dept,
-            'display': dict(User.UNIT_CHOICES).get(dept, dept)
+            'department': unit_code(dept),
+            'display': unit_name(dept)
         })
     
     total_submitted = len(submitted_depts)
@@ -69,17 +115,17 @@ def admin_dashboard(request):
     recent_opb = OPBRequest.objects.filter(status='pending').order_by('-created_at')[:5]
     
     # Get budget allocation by department (combine PRE, and OPB)
-    departments = User.objects.filter(role='unit_head').values_list('department', flat=True).distinct()
+    approved_budgets = budget_by_unit(OPBRequest.objects.filter(status='for-approval'))
     dept_budget_data = []
     
-    for dept in departments:
+    for dept in all_departments:
         
-        opb_total = sum([req.total_budget_amount for req in OPBRequest.objects.filter(department=dept, status='for-approval')])
+        opb_total = approved_budgets.get(dept, 0)
         combined_total = opb_total
         
         if combined_total > 0:  # Only include departments with budget
             dept_budget_data.append({
-                'department': dept,
+                'department': unit_code(dept),
                 'total': combined_total,
                 'opb': opb_total
             })
@@ -97,6 +143,9 @@ def admin_dashboard(request):
     # Sort by total budget descending
     dept_budget_data.sort(key=lambda x: x['total'], reverse=True)
     
+    # Budget by unit hierarchy, drilled down with ?unit=<code>
+    unit_tree = unit_drilldown(request.GET.get('unit'))
+    
     # Get monthly budget data for the line chart (last 12 months)
     from datetime import datetime, timedelta
     monthly_data = []
@@ -140,6 +189,7 @@ def admin_dashboard(request):
         'recent_opb': recent_opb,
         'dept_budget_data': json.dumps(dept_budget_data, default=decimal_default),
         'monthly_data': json.dumps(monthly_data, default=decimal_default),
+        'unit_tree': unit_tree,
     }
     
     return render(request, 'admin_dashboard.html', context)
@@ -168,12 +218,12 @@ def admin_users(request):
     page_obj = paginator.get_page(page_number)
     
     # Get departments that already have users
-    taken_departments = set(User.objects.filter(department__isnull=False).values_list('department', flat=True))
+    taken_departments = {unit_code(dept) for dept in User.objects.filter(department__isnull=False).values_list('department_id', flat=True)}
     
     context = {
         'users': page_obj,
         'search_query': search_query,
-        'unit_choices': User.UNIT_CHOICES,
+        'unit_choices': unit_choices(),
         'taken_departments': json.dumps(list(taken_departments)),
     }
     
@@ -181,22 +231,24 @@ def admin_users(request):
 
 @login_required
 @staff_member_required
+@read_from_replica
 def admin_reports(request):
     # Get filter parameters
     dept_filter = request.GET.get('department', '')
     status_filter = request.GET.get('status', '')
     date_from = request.GET.get('date_from', '')
     date_to = request.GET.get('date_to', '')
+    fiscal_year_filter = request.GET.get('fiscal_year', '')
     export_format = request.GET.get('export', '')
     
-    # Get data for reports
-    opb_requests = OPBRequest.objects.select_related('department_head').all()
+    # Get data for reports; closed fiscal years come from the archive
+    opb_requests = report_requests(fiscal_year_filter)
     
     if status_filter:
         opb_requests = opb_requests.filter(status=status_filter)
 
     if dept_filter:
-        opb_requests = opb_requests.filter(department=dept_filter)
+        opb_requests = in_subtree(opb_requests, unit_id(dept_filter))
     
     if date_from:
         opb_requests = opb_requests.filter(created_at__date__gte=date_from)
@@ -205,7 +257,7 @@ def admin_reports(request):
         opb_requests = opb_requests.filter(created_at__date__lte=date_to)
     
     # Calculate totals
-    opb_total = sum(request.total_budget_amount for request in opb_requests)
+    opb_total = opb_requests.aggregate(total=Sum('items__budget_amount'))['total'] or 0
     
     # Calculate summary statistics
     total_requests = opb_requests.count()
@@ -215,26 +267,50 @@ def admin_reports(request):
     
     # Department ranking
     dept_ranking = []
-    departments = User.objects.filter(role='unit_head').values_list('department', flat=True).distinct()
-    for dept in departments:
+    dept_budgets = budget_by_unit(opb_requests)
+    for dept in unit_head_unit_ids():
         
-        dept_opb = sum(request.total_budget_amount for request in opb_requests.filter(department=dept))
+        dept_opb = dept_budgets.get(dept, 0)
         dept_total = dept_opb 
         dept_ranking.append({
-            'department': dept,
+            'department': unit_code(dept),
+            'unit_id': dept,
             'total': dept_total,
             'opb': dept_opb,
            
         })
     dept_ranking.sort(key=lambda x: x['total'], reverse=True)
     
+    # Unit hierarchy rollup; drill links keep the other filters
+    unit_tree = unit_drilldown(request.GET.get('unit'), opb_requests)
+    drill_params = request.GET.copy()
+    for key in ('unit', 'export', 'page'):
+        drill_params.pop(key, None)
+    
+    # Distribution statistics; a single fiscal year is compared with the one before
+    previous_requests = None
+    if fiscal_year_filter.isdigit():
+        previous_requests = report_requests(str(int(fiscal_year_filter) - 1))
+        if status_filter:
+            previous_requests = previous_requests.filter(status=status_filter)
+        if dept_filter:
+            previous_requests = in_subtree(previous_requests, unit_id(dept_filter))
+    analytics = report_analytics(opb_requests, previous_requests)
+    
+    # Cross-unit responsibilities come from the index of open fiscal years
+    responsibilities = responsibility_summary(opb_requests) if opb_requests.model is OPBRequest else None
+    
+    # Likely double funding among the open fiscal year on show
+    duplicates_year = fiscal_year_filter or current_fiscal_year()
+    duplicates = None if opb_requests.model is not OPBRequest else duplicate_pairs(duplicates_year, limit=50)
+    
     # Handle export
     if export_format == 'csv':
-        return export_reports_csv(opb_requests, dept_ranking)
+        return export_reports_csv(opb_requests, dept_ranking, analytics)
     elif export_format == 'pdf':
-        return export_reports_pdf(opb_requests, dept_ranking)
+        return export_reports_pdf(opb_requests, dept_ranking, analytics)
     elif export_format == 'docx':
-        return export_reports_docx(opb_requests, dept_ranking)
+        return export_reports_docx(opb_requests, dept_ranking, analytics)
     elif export_format == 'print':
         return render(request, 'admin_reports_print.html', {
             'opb_requests': opb_requests,
@@ -246,16 +322,38 @@ def admin_reports(request):
             'opb_total': opb_total,
         })
     
+    # Approval turnaround from the precomputed monthly statistics
+    turnaround = turnaround_report(unit_ids=subtree_ids(unit_id(dept_filter)) if dept_filter else None)
+    
+    # The pivot reads the budget cube with the page's filters it can express
+    pivot_filters = {'unit': dept_filter, 'status': status_filter}
+    if fiscal_year_filter != ALL_ARCHIVED:
+        pivot_filters['fiscal_year'] = fiscal_year_filter
+    
     context = {
         'opb_requests': opb_requests[:10],  # Limit for display
-        'unit_choices': User.UNIT_CHOICES,
+        'unit_choices': unit_choices(),
         'opb_total': opb_total,
         'total_requests': total_requests,
         'approved_requests': approved_requests,
         'pending_requests': pending_requests,
         'rejected_requests': rejected_requests,
         'dept_ranking': dept_ranking,
+        'unit_tree': unit_tree,
+        'turnaround': turnaround,
+        'analytics': analytics,
+        'responsibilities': responsibilities,
+        'duplicates': duplicates,
+        'duplicates_year': duplicates_year,
+        'analytics_available': analytics_available(),
+        'pivot_dimensions': DIMENSION_LABELS,
+        'pivot_filters': {d: v for d, v in pivot_filters.items() if v},
+        'drill_query': drill_params.urlencode(),
         'dept_filter': dept_filter,
+        'fiscal_year_filter': fiscal_year_filter,
+        'open_fiscal_years': open_fiscal_years(),
+        'closed_fiscal_years': closed_fiscal_years(),
+        'all_archived': ALL_ARCHIVED,
         'date_from': date_from,
         'date_to': date_to,
         'status_filter': status_filter,
@@ -270,37 +368,52 @@ def admin_settings(request):
     # Get system statistics
     total_users = User.objects.count()
     total_notifications = Notification.objects.count()
-    all_departments = User.objects.filter(role='unit_head').values_list('department', flat=True).distinct()
+    all_departments = unit_head_unit_ids()
     
     
     # Get database size (approximate)
-    import os
-    db_path = settings.DATABASES['default']['NAME']
-    db_size = 0
-    if os.path.exists(db_path):
-        db_size = os.path.getsize(db_path)
+    backup_strategy = get_backup_strategy()
+    db_size = backup_strategy.database_size()
     
     # Get system health metrics
     active_users = User.objects.filter(is_active=True).count()
     inactive_users = User.objects.filter(is_active=False).count()
+    request_counts = request_counts_by_unit()
     submitted_depts = set()
     submitted_breakdown = []
     for dept in all_departments:
-        dept_count = OPBRequest.objects.filter(department=dept).count()
+        dept_count = request_counts.get(dept, 0)
         if dept_count > 0:
             submitted_depts.add(dept)
             submitted_breakdown.append({
-                'department': dept,
+                'department': unit_code(dept),
                 'count': dept_count,
-                'display': dict(User.UNIT_CHOICES).get(dept, dept)
+                'display': unit_name(dept)
             })
     total_submitted = len(submitted_depts)
     # Get backup information
-    backup_dir = os.path.join(settings.BASE_DIR, 'backups')
-    backup_files = []
-    if os.path.exists(backup_dir):
-        backup_files = [f for f in os.listdir(backup_dir) if f.endswith('.sqlite3')]
-        backup_files.sort(key=lambda x: os.path.getmtime(os.path.join(backup_dir, x)), reverse=True)
+    backup_files = catalog_entries()
+    for backup in backup_files:
+        for key in ('created_at', 'last_restored_at'):
+            if backup.get(key):
+                backup[key] = datetime.fromisoformat(backup[key])
+    
+    # Last scheduled backup run
+    backup_schedule = schedule_config()
+    schedule_status = read_schedule_status()
+    for key in ('finished_at', 'next_run'):
+        if schedule_status.get(key):
+            schedule_status[key] = datetime.fromisoformat(schedule_status[key])
+    
+    # Warm standby sync state
+    standby = None
+    if standby_config()['ENABLED']:
+        standby = standby_status()
+        if standby.get('synced_at'):
+            standby['synced_at'] = datetime.fromtimestamp(standby['synced_at'])
+    
+    # Write admission statistics for this worker
+    write_queue = get_write_gate().stats() if write_gate_enabled() else None
     
     context = {
         'total_users': total_users,
@@ -310,6 +423,12 @@ def admin_settings(request):
         'inactive_users': inactive_users,
         'total_opb_submitted': total_submitted,
         'backup_files': backup_files,
+        'write_queue': write_queue,
+        'database_engine': backup_strategy.label,
+        'backup_schedule': backup_schedule,
+        'schedule_status': schedule_status,
+        'standby': standby,
+        'standby_lag_limit': standby_config()['LAG'],
     }
     
     return render(request, 'admin_settings.html', context)
@@ -320,6 +439,7 @@ def admin_settings(request):
 
 @login_required
 @staff_member_required
+@serialized_write
 def ajax_add_user(request):
     """AJAX endpoint to add user"""
     if request.method == 'POST':
@@ -344,26 +464,35 @@ def ajax_add_user(request):
                     'message': 'Email already exists'
                 })
             
+            department = get_unit(data['department']) if data.get('department') else None
+            if data.get('department') and department is None:
+                return JsonResponse({
+                    'success': False,
+                    'message': 'Unknown unit'
+                })
+            
             # Check if department already has a user (only for unit_head role)
-            if data['role'] == 'unit_head' and data.get('department'):
-                existing_user = User.objects.filter(department=data['department']).first()
+            if data['role'] == 'unit_head' and department:
+                existing_user = User.objects.filter(department_id=department.id).first()
                 if existing_user:
-                    department_display = dict(User.UNIT_CHOICES).get(data['department'], data['department'])
                     return JsonResponse({
                         'success': False,
-                        'message': f"There's already an existing user in this Unit ({department_display})"
+                        'message': f"There's already an existing user in this Unit ({department.name})"
                     })
             
-            # Create user
-            user = User.objects.create_user(
-                username=data['username'],
-                email=data['email'],
-                password=data['password'],
+            # Create user; the password is hashed before taking the write
+            # gate, as hashing is the slow part
+            user = User(
+                username=User.normalize_username(data['username']),
+                email=User.objects.normalize_email(data['email']),
                 first_name=data['first_name'],
                 last_name=data['last_name'],
-                department=data.get('department', ''),
+                department=department,
                 role=data['role']
             )
+            user.set_password(data['password'])
+            with serialized_atomic():
+                user.save()
             
             return JsonResponse({
                 'success': True,
@@ -380,6 +509,7 @@ def ajax_add_user(request):
 
 @login_required
 @staff_member_required
+@serialized_write
 def ajax_edit_user(request):
     """AJAX endpoint to edit user"""
     if request.method == 'POST':
@@ -393,28 +523,35 @@ def ajax_edit_user(request):
             
             user = get_object_or_404(User, id=user_id)
             
+            department = get_unit(data['department']) if data.get('department') else None
+            if data.get('department') and department is None:
+                return JsonResponse({
+                    'success': False,
+                    'message': 'Unknown unit'
+                })
+            
             # Check if department is already taken by another user
-            if data['role'] == 'unit_head' and data.get('department'):
-                existing_user = User.objects.filter(department=data['department']).exclude(id=user_id).first()
+            if data['role'] == 'unit_head' and department:
+                existing_user = User.objects.filter(department_id=department.id).exclude(id=user_id).first()
                 if existing_user:
-                    department_display = dict(User.UNIT_CHOICES).get(data['department'], data['department'])
                     return JsonResponse({
                         'success': False,
-                        'message': f"There's already an existing user in this Unit ({department_display})"
+                        'message': f"There's already an existing user in this Unit ({department.name})"
                     })
             
             # Update user fields
             user.first_name = data['first_name']
             user.last_name = data['last_name']
             user.email = data['email']
-            user.department = data.get('department', '')
+            user.department = department
             user.role = data['role']
             
             # Update password if provided
             if data.get('password'):
                 user.set_password(data['password'])
             
-            user.save()
+            with serialized_atomic():
+                user.save()
             
             return JsonResponse({
                 'success': True,
@@ -430,6 +567,7 @@ def ajax_edit_user(request):
 
 @login_required
 @staff_member_required
+@serialized_write
 def ajax_delete_user(request):
     """AJAX endpoint to delete user"""
     if request.method == 'POST':
@@ -450,11 +588,14 @@ def ajax_delete_user(request):
                     'message': 'Cannot delete your own account'
                 })
             
-            user.delete()
+            # Locked out now; rows are deleted in batches in the background
+            job_id = start_user_deletion(user, created_by=request.user.username)
             
             return JsonResponse({
                 'success': True,
-                'message': 'User deleted successfully'
+                'message': 'User deactivated; deleting their data in the background',
+                'job_id': job_id,
+                'status_url': reverse('ajax_job_status', args=[job_id]),
             })
         except Exception as e:
             return JsonResponse({
@@ -466,6 +607,7 @@ def ajax_delete_user(request):
 
 @login_required
 @staff_member_required
+@serialized_write
 def ajax_toggle_user_status(request):
     """AJAX endpoint to toggle user active status"""
     if request.method == 'POST':
@@ -487,7 +629,8 @@ def ajax_toggle_user_status(request):
                 })
             
             user.is_active = not user.is_active
-            user.save()
+            with serialized_atomic():
+                user.save()
             
             status = 'activated' if user.is_active else 'deactivated'
             
@@ -507,14 +650,10 @@ def ajax_toggle_user_status(request):
 @login_required
 def head_dashboard(request):
     # Get user's department
-    user_dept = request.user.department
+    user_dept = unit_name(request.user.department_id, default=None)
     
-    # Get statistics for this department head
-    
-    submitted_count = 0 
-    approved_count = 0
-    rejected_count = 0
-    pending_count = 0
+    # Counts and budget totals of the unit's requests (cached per user)
+    stats = head_stats(request.user)
     
     # Get recent notifications
     notifications = Notification.objects.filter(user=request.user).order_by('-created_at')[:5]
@@ -523,10 +662,7 @@ def head_dashboard(request):
     
     
     context = {
-        'submitted_count': submitted_count,
-        'approved_count': approved_count,
-        'rejected_count': rejected_count,
-        'pending_count': pending_count,
+        **stats,
         'notifications': notifications,
         'unread_count': unread_count,
         'user_dept': user_dept,
@@ -535,16 +671,19 @@ def head_dashboard(request):
     return render(request, 'head_dashboard.html', context)
 
 @login_required
+@serialized_write
 def head_notifications(request):
     # Handle bulk actions
     if request.method == 'POST':
         action = request.POST.get('action')
         
         if action == 'mark_all_read':
-            Notification.objects.filter(user=request.user, is_read=False).update(is_read=True)
+            with serialized_atomic():
+                Notification.objects.filter(user=request.user, is_read=False).update(is_read=True)
             messages.success(request, 'All notifications marked as read!')
         elif action == 'delete_all':
-            Notification.objects.filter(user=request.user).delete()
+            with serialized_atomic():
+                Notification.objects.filter(user=request.user).delete()
             messages.success(request, 'All notifications deleted!')
         
         return redirect('head_notifications')
@@ -560,13 +699,15 @@ def head_notifications(request):
 
 # OPB Views
 @login_required
+@serialized_write
 def head_opb_requests(request):
     # Handle form submission
     if request.method == 'POST':
         try:
             # Get common fields
-            fiscal_year = request.POST.get('fiscal_year', '2026')
-            unit = request.user.get_department_display() if request.user.department else 'No Unit Assigned'
+            fiscal_year = request.POST.get('fiscal_year') or current_fiscal_year()
+            check_open(fiscal_year)
+            unit = request.user.get_department_display()
             
             # Get array fields for multiple entries
             kra_nos = request.POST.getlist('kra_no[]') if 'kra_no[]' in request.POST else [request.POST.get('kra_no', '')]
@@ -579,38 +720,52 @@ def head_opb_requests(request):
             source_of_funds = request.POST.getlist('source_of_fund[]') if 'source_of_fund[]' in request.POST else [request.POST.get('source_of_fund', '')]
             responsible_units_list = request.POST.getlist('responsible_units[]') if 'responsible_units[]' in request.POST else [request.POST.get('responsible_units', '')]
             
-            # Create single OPB request
-            opb_request = OPBRequest.objects.create(
-                department_head=request.user,
-                department=request.user.department,
-                fiscal_year=fiscal_year,
-                unit=unit,
-            )
-            
-            # Create OPB items for each row
-            created_count = 0
-            for i in range(len(kra_nos)):
-                if kra_nos[i].strip() or objective_nos[i].strip() or indicators_list[i].strip():
-                    OPBItem.objects.create(
-                        request=opb_request,
-                        kra_no=kra_nos[i] if i < len(kra_nos) else '',
-                        objective_no=objective_nos[i] if i < len(objective_nos) else '',
-                        indicators=indicators_list[i] if i < len(indicators_list) else '',
-                        annual_target=annual_targets[i] if i < len(annual_targets) else '',
-                        activities=activities_list[i] if i < len(activities_list) else '',
-                        timeframe=timeframes[i] if i < len(timeframes) else '',
-                        budget_amount=float(budget_amounts[i]) if i < len(budget_amounts) and budget_amounts[i] else 0,
-                        source_of_fund=source_of_funds[i] if i < len(source_of_funds) else '',
-                        responsible_units=responsible_units_list[i] if i < len(responsible_units_list) else '',
-                    )
-                    created_count += 1
+            with serialized_atomic():
+                # Create single OPB request
+                opb_request = OPBRequest.objects.create(
+                    department_head=request.user,
+                    department_id=request.user.department_id,
+                    fiscal_year=fiscal_year,
+                    unit=unit,
+                )
+            
+                # Create OPB items for each row
+                created_count = 0
+                for i in range(len(kra_nos)):
+                    if kra_nos[i].strip() or objective_nos[i].strip() or indicators_list[i].strip():
+                        OPBItem.objects.create(
+                            request=opb_request,
+                            kra_no=kra_nos[i] if i < len(kra_nos) else '',
+                            objective_no=objective_nos[i] if i < len(objective_nos) else '',
+                            indicators=indicators_list[i] if i < len(indicators_list) else '',
+                            annual_target=annual_targets[i] if i < len(annual_targets) else '',
+                            activities=activities_list[i] if i < len(activities_list) else '',
+                            timeframe=timeframes[i] if i < len(timeframes) else '',
+                            budget_amount=float(budget_amounts[i]) if i < len(budget_amounts) and budget_amounts[i] else 0,
+                            source_of_fund=source_of_funds[i] if i < len(source_of_funds) else '',
+                            responsible_units=responsible_units_list[i] if i < len(responsible_units_list) else '',
+                        )
+                        created_count += 1
+                
+                # Count against the unit's budget ceilings (rolls back if over)
+                if created_count:
+                    commit_request(opb_request)
+                    record_transition(opb_request, '', by=request.user)
+                    record_version(opb_request, by=request.user)
+                    add_to_cube(opb_request)
+                    index_request(opb_request)
+                    sign_request(opb_request)
+                    invalidate_unit(opb_request.department_id)
             
             if created_count == 0:
-                opb_request.delete()  # Delete the empty request
+                with serialized_atomic():
+                    opb_request.delete()  # Delete the empty request
                 messages.error(request, 'Please fill in at least one row with data')
             else:
                 messages.success(request, f'OPB request submitted successfully! ({created_count} entries)')
             return redirect('head_opb')
+        except CeilingExceeded as e:
+            messages.error(request, str(e))
         except Exception as e:
             messages.error(request, f'Error submitting request: {str(e)}')
     
@@ -618,78 +773,97 @@ def head_opb_requests(request):
     requests = OPBRequest.objects.filter(department_head=request.user).order_by('-created_at')
     
     # Get user's department display name
-    user_department_display = request.user.get_department_display() if request.user.department else 'No Unit Assigned'
+    user_department_display = request.user.get_department_display()
     unread_count = Notification.objects.filter(user=request.user, is_read=False).count()
     
     context = {
         'requests': requests,
-        'user_department': request.user.department,
+        'user_department': unit_code(request.user.department_id),
         'user_department_display': user_department_display,
         'unread_count': unread_count,
+        'current_fiscal_year': current_fiscal_year(),
     }
     
     return render(request, 'head_opb.html', context)
 
 
 @login_required
+@serialized_write
 def head_opb_edit(request, request_id):
     opb_request = get_object_or_404(OPBRequest, id=request_id, department_head=request.user)
     
     if request.method == 'POST':
         try:
-            # Update basic request info
-            opb_request.fiscal_year = request.POST.get('fiscal_year', '2026')
-            opb_request.unit = request.user.get_department_display() if request.user.department else 'No Unit Assigned'
-            opb_request.status = 'pending'  # Reset status to pending after edit
-            opb_request.save()
-            
-            # Clear existing items
-            opb_request.items.all().delete()
-            
-            # Get array fields for multiple entries
-            kra_nos = request.POST.getlist('kra_no[]')
-            objective_nos = request.POST.getlist('objective_no[]')
-            indicators_list = request.POST.getlist('indicators[]')
-            annual_targets = request.POST.getlist('annual_target[]')
-            activities_list = request.POST.getlist('activities[]')
-            timeframes = request.POST.getlist('timeframe[]')
-            budget_amounts = request.POST.getlist('budget_amount[]')
-            source_of_funds = request.POST.getlist('source_of_fund[]')
-            responsible_units_list = request.POST.getlist('responsible_units[]')
-            
-            # Create new OPB items
-            created_count = 0
-            for i in range(len(kra_nos)):
-                if kra_nos[i].strip() or objective_nos[i].strip() or indicators_list[i].strip():
-                    OPBItem.objects.create(
-                        request=opb_request,
-                        kra_no=kra_nos[i] if i < len(kra_nos) else '',
-                        objective_no=objective_nos[i] if i < len(objective_nos) else '',
-                        indicators=indicators_list[i] if i < len(indicators_list) else '',
-                        annual_target=annual_targets[i] if i < len(annual_targets) else '',
-                        activities=activities_list[i] if i < len(activities_list) else '',
-                        timeframe=timeframes[i] if i < len(timeframes) else '',
-                        budget_amount=float(budget_amounts[i]) if i < len(budget_amounts) and budget_amounts[i] else 0,
-                        source_of_fund=source_of_funds[i] if i < len(source_of_funds) else '',
-                        responsible_units=responsible_units_list[i] if i < len(responsible_units_list) else '',
-                    )
-                    created_count += 1
+            with serialized_atomic():
+                previous = snapshot(opb_request)
+                previous_status = opb_request.status
+                previous_content = request_content(opb_request)
+                remove_from_cube(opb_request)
+                # Update basic request info
+                opb_request.fiscal_year = request.POST.get('fiscal_year') or current_fiscal_year()
+                check_open(opb_request.fiscal_year)
+                opb_request.unit = request.user.get_department_display()
+                opb_request.status = 'pending'  # Reset status to pending after edit
+                opb_request.save()
+            
+                # Clear existing items
+                opb_request.items.all().delete()
+            
+                # Get array fields for multiple entries
+                kra_nos = request.POST.getlist('kra_no[]')
+                objective_nos = request.POST.getlist('objective_no[]')
+                indicators_list = request.POST.getlist('indicators[]')
+                annual_targets = request.POST.getlist('annual_target[]')
+                activities_list = request.POST.getlist('activities[]')
+                timeframes = request.POST.getlist('timeframe[]')
+                budget_amounts = request.POST.getlist('budget_amount[]')
+                source_of_funds = request.POST.getlist('source_of_fund[]')
+                responsible_units_list = request.POST.getlist('responsible_units[]')
+            
+                # Create new OPB items
+                created_count = 0
+                for i in range(len(kra_nos)):
+                    if kra_nos[i].strip() or objective_nos[i].strip() or indicators_list[i].strip():
+                        OPBItem.objects.create(
+                            request=opb_request,
+                            kra_no=kra_nos[i] if i < len(kra_nos) else '',
+                            objective_no=objective_nos[i] if i < len(objective_nos) else '',
+                            indicators=indicators_list[i] if i < len(indicators_list) else '',
+                            annual_target=annual_targets[i] if i < len(annual_targets) else '',
+                            activities=activities_list[i] if i < len(activities_list) else '',
+                            timeframe=timeframes[i] if i < len(timeframes) else '',
+                            budget_amount=float(budget_amounts[i]) if i < len(budget_amounts) and budget_amounts[i] else 0,
+                            source_of_fund=source_of_funds[i] if i < len(source_of_funds) else '',
+                            responsible_units=responsible_units_list[i] if i < len(responsible_units_list) else '',
+                        )
+                        created_count += 1
+                
+                # Move the request's share of the unit's budget ceilings
+                recommit(opb_request, previous)
+                record_transition(opb_request, previous_status, by=request.user, note='Edited by the unit head')
+                record_version(opb_request, previous_content, by=request.user)
+                add_to_cube(opb_request)
+                index_request(opb_request)
+                sign_request(opb_request)
+                invalidate_unit(opb_request.department_id)
             
             if created_count == 0:
                 messages.error(request, 'Please fill in at least one row with data')
             else:
                 messages.success(request, f'OPB request updated successfully! ({created_count} entries)')
             return redirect('head_opb')
+        except CeilingExceeded as e:
+            messages.error(request, str(e))
         except Exception as e:
             messages.error(request, f'Error updating request: {str(e)}')
     
     # Get user's department display name
-    user_department_display = request.user.get_department_display() if request.user.department else 'No Unit Assigned'
+    user_department_display = request.user.get_department_display()
     unread_count = Notification.objects.filter(user=request.user, is_read=False).count()
     
     context = {
         'opb_request': opb_request,
-        'user_department': request.user.department,
+        'user_department': unit_code(request.user.department_id),
         'user_department_display': user_department_display,
         'unread_count': unread_count,
     }
@@ -731,7 +905,7 @@ def admin_opb_requests(request):
         requests = requests.filter(status=status_filter)
     
     if dept_filter:
-        requests = requests.filter(department=dept_filter)
+        requests = in_subtree(requests, unit_id(dept_filter))
     
     requests = requests.order_by('-created_at')
     
@@ -745,7 +919,7 @@ def admin_opb_requests(request):
         'search_query': search_query,
         'status_filter': status_filter,
         'dept_filter': dept_filter,
-        'unit_choices': User.UNIT_CHOICES,
+        'unit_choices': unit_choices(),
     }
     
     return render(request, 'admin_opb.html', context)
@@ -756,16 +930,93 @@ def admin_opb_requests(request):
 def admin_opb_view_details(request, request_id):
     opb_request = get_object_or_404(OPBRequest, id=request_id)
     
+    # Near duplicates of each item elsewhere in the fiscal year
+    matches = similar_items(opb_request)
+    similar = [{'item': item, 'matches': matches[item.pk]} for item in opb_request.items.all() if item.pk in matches]
+    
     context = {
         'request': opb_request,
+        'similar_items': similar,
     }
     
     return render(request, 'admin_opb_details.html', context)
 
 
+
+@login_required
+@staff_member_required
+def ajax_opb_versions(request, request_id):
+    """AJAX endpoint with the versions of an OPB request and a diff of two of them"""
+    if request.method == 'GET':
+        try:
+            versions = list_versions(request_id)
+            if not versions:
+                return JsonResponse({'success': True, 'versions': [], 'diff': None})
+            latest = versions[-1].number
+            new_number = int(request.GET.get('to') or latest)
+            old_number = int(request.GET.get('from') or max(new_number - 1, 1))
+            return JsonResponse({
+                'success': True,
+                'versions': [{
+                    'number': v.number,
+                    'at': v.at.isoformat(),
+                    'by': (v.by.get_full_name() or v.by.username) if v.by else '',
+                    'checkpoint': v.checkpoint,
+                } for v in versions],
+                'diff': diff_versions(request_id, old_number, new_number),
+            })
+        except Exception as e:
+            return JsonResponse({'success': False, 'message': str(e)})
+    return JsonResponse({'success': False, 'message': 'Invalid request'})
+
+
+
+@login_required
+@staff_member_required
+@read_from_replica
+def ajax_budget_pivot(request):
+    """AJAX endpoint slicing the budget cube: ?rows=unit,kra&status=pending&fiscal_year=2026"""
+    if request.method == 'GET':
+        try:
+            group_by = [d for d in request.GET.get('rows', '').split(',') if d]
+            filters = {d: request.GET.getlist(d) for d in DIMENSIONS if request.GET.getlist(d)}
+            limit = int(request.GET.get('limit') or 500)
+            return JsonResponse({
+                'success': True,
+                **pivot(group_by, filters, limit=limit),
+            }, json_dumps_params={'default': decimal_default})
+        except (PivotError, ValueError) as e:
+            return JsonResponse({'success': False, 'message': str(e)})
+    return JsonResponse({'success': False, 'message': 'Invalid request'})
+
+
+@login_required
+@staff_member_required
+@read_from_replica
+def ajax_unit_responsibilities(request):
+    """AJAX endpoint listing what other units named a unit responsible for: ?unit=SUPPLY_UNIT&fiscal_year=2026"""
+    if request.method == 'GET':
+        try:
+            unit = get_unit(request.GET.get('unit', ''))
+            if unit is None:
+                return JsonResponse({'success': False, 'message': 'Unknown unit'})
+            opb_requests = OPBRequest.objects.all()
+            if request.GET.get('fiscal_year'):
+                opb_requests = opb_requests.filter(fiscal_year=request.GET['fiscal_year'])
+            if request.GET.get('status'):
+                opb_requests = opb_requests.filter(status=request.GET['status'])
+            return JsonResponse({
+                'success': True,
+                **unit_responsibilities(unit.id, opb_requests),
+            }, json_dumps_params={'default': decimal_default})
+        except Exception as e:
+            return JsonResponse({'success': False, 'message': str(e)})
+    return JsonResponse({'success': False, 'message': 'Invalid request'})
+
 # AJAX Views for Department Head
 
 @login_required
+@serialized_write
 def ajax_mark_notification_read(request):
     """AJAX endpoint to mark notification as read"""
     if request.method == 'POST':
@@ -779,7 +1030,8 @@ def ajax_mark_notification_read(request):
             
             notification = get_object_or_404(Notification, id=notification_id, user=request.user)
             notification.is_read = True
-            notification.save()
+            with serialized_atomic():
+                notification.save()
             
             return JsonResponse({
                 'success': True,
@@ -794,6 +1046,7 @@ def ajax_mark_notification_read(request):
 
 
 @login_required
+@serialized_write
 def ajax_delete_notification(request):
     """AJAX endpoint to delete notification"""
     if request.method == 'POST':
@@ -806,7 +1059,8 @@ def ajax_delete_notification(request):
             notification_id = data['notification_id']
             
             notification = get_object_or_404(Notification, id=notification_id, user=request.user)
-            notification.delete()
+            with serialized_atomic():
+                notification.delete()
             
             return JsonResponse({
                 'success': True,
@@ -820,11 +1074,13 @@ def ajax_delete_notification(request):
     return JsonResponse({'success': False, 'message': 'Invalid request'})
 
 @login_required
+@serialized_write
 def ajax_mark_all_notifications_read(request):
     """AJAX endpoint to mark all notifications as read"""
     if request.method == 'POST':
         try:
-            Notification.objects.filter(user=request.user, is_read=False).update(is_read=True)
+            with serialized_atomic():
+                Notification.objects.filter(user=request.user, is_read=False).update(is_read=True)
             
             return JsonResponse({
                 'success': True,
@@ -839,11 +1095,13 @@ def ajax_mark_all_notifications_read(request):
 
 
 @login_required
+@serialized_write
 def ajax_delete_all_notifications(request):
     """AJAX endpoint to delete all notifications"""
     if request.method == 'POST':
         try:
-            Notification.objects.filter(user=request.user).delete()
+            with serialized_atomic():
+                Notification.objects.filter(user=request.user).delete()
             
             return JsonResponse({
                 'success': True,
@@ -859,6 +1117,7 @@ def ajax_delete_all_notifications(request):
 
 # OPB AJAX Views
 @login_required
+@serialized_write
 def ajax_submit_opb_request(request):
     """AJAX endpoint to submit OPB request"""
     if request.method == 'POST':
@@ -870,7 +1129,8 @@ def ajax_submit_opb_request(request):
                 data = request.POST
             
             # Get common fields
-            fiscal_year = data.get('fiscal_year', '2026')
+            fiscal_year = data.get('fiscal_year') or current_fiscal_year()
+            check_open(fiscal_year)
             unit = data.get('unit', '')
             
             # Get array fields for multiple entries
@@ -884,34 +1144,46 @@ def ajax_submit_opb_request(request):
             source_of_funds = data.getlist('source_of_fund[]') if 'source_of_fund[]' in data else [data.get('source_of_fund', '')]
             responsible_units_list = data.getlist('responsible_units[]') if 'responsible_units[]' in data else [data.get('responsible_units', '')]
             
-            # Create single OPB request
-            opb_request = OPBRequest.objects.create(
-                department_head=request.user,
-                department=request.user.department,
-                fiscal_year=fiscal_year,
-                unit=unit,
-            )
-            
-            # Create OPB items for each row
-            created_count = 0
-            for i in range(len(kra_nos)):
-                if kra_nos[i].strip() or objective_nos[i].strip() or indicators_list[i].strip():
-                    OPBItem.objects.create(
-                        request=opb_request,
-                        kra_no=kra_nos[i] if i < len(kra_nos) else '',
-                        objective_no=objective_nos[i] if i < len(objective_nos) else '',
-                        indicators=indicators_list[i] if i < len(indicators_list) else '',
-                        annual_target=annual_targets[i] if i < len(annual_targets) else '',
-                        activities=activities_list[i] if i < len(activities_list) else '',
-                        timeframe=timeframes[i] if i < len(timeframes) else '',
-                        budget_amount=float(budget_amounts[i]) if i < len(budget_amounts) and budget_amounts[i] else 0,
-                        source_of_fund=source_of_funds[i] if i < len(source_of_funds) else '',
-                        responsible_units=responsible_units_list[i] if i < len(responsible_units_list) else '',
-                    )
-                    created_count += 1
+            with serialized_atomic():
+                # Create single OPB request
+                opb_request = OPBRequest.objects.create(
+                    department_head=request.user,
+                    department_id=request.user.department_id,
+                    fiscal_year=fiscal_year,
+                    unit=unit,
+                )
+            
+                # Create OPB items for each row
+                created_count = 0
+                for i in range(len(kra_nos)):
+                    if kra_nos[i].strip() or objective_nos[i].strip() or indicators_list[i].strip():
+                        OPBItem.objects.create(
+                            request=opb_request,
+                            kra_no=kra_nos[i] if i < len(kra_nos) else '',
+                            objective_no=objective_nos[i] if i < len(objective_nos) else '',
+                            indicators=indicators_list[i] if i < len(indicators_list) else '',
+                            annual_target=annual_targets[i] if i < len(annual_targets) else '',
+                            activities=activities_list[i] if i < len(activities_list) else '',
+                            timeframe=timeframes[i] if i < len(timeframes) else '',
+                            budget_amount=float(budget_amounts[i]) if i < len(budget_amounts) and budget_amounts[i] else 0,
+                            source_of_fund=source_of_funds[i] if i < len(source_of_funds) else '',
+                            responsible_units=responsible_units_list[i] if i < len(responsible_units_list) else '',
+                        )
+                        created_count += 1
+                
+                # Count against the unit's budget ceilings (rolls back if over)
+                if created_count:
+                    commit_request(opb_request)
+                    record_transition(opb_request, '', by=request.user)
+                    record_version(opb_request, by=request.user)
+                    add_to_cube(opb_request)
+                    index_request(opb_request)
+                    sign_request(opb_request)
+                    invalidate_unit(opb_request.department_id)
             
             if created_count == 0:
-                opb_request.delete()  # Delete the empty request
+                with serialized_atomic():
+                    opb_request.delete()  # Delete the empty request
                 return JsonResponse({
                     'success': False,
                     'message': 'Please fill in at least one row with data'
@@ -931,6 +1203,37 @@ def ajax_submit_opb_request(request):
 
 
 @login_required
+def ajax_budget_balance(request):
+    """AJAX endpoint with the remaining budget ceilings of the user's unit"""
+    if request.method == 'GET':
+        try:
+            fiscal_year = request.GET.get('fiscal_year') or current_fiscal_year()
+            balances = remaining_balances(request.user.department_id, fiscal_year)
+            
+            # When editing, the request's current items are already committed
+            request_id = request.GET.get('request_id')
+            if request_id:
+                opb_request = get_object_or_404(OPBRequest, id=request_id, department_head=request.user)
+                _, _, own = snapshot(opb_request)
+                for balance in balances:
+                    source = balance['source_of_fund']
+                    balance['remaining'] += sum(own.values()) if not source else own.get(source, 0)
+            
+            return JsonResponse({
+                'success': True,
+                'fiscal_year': fiscal_year,
+                'balances': balances,
+            }, json_dumps_params={'default': decimal_default})
+        except Exception as e:
+            return JsonResponse({
+                'success': False,
+                'message': str(e)
+            })
+    return JsonResponse({'success': False, 'message': 'Invalid request'})
+
+
+@login_required
+@serialized_write
 def ajax_delete_opb_request(request):
     """AJAX endpoint to delete OPB request"""
     if request.method == 'POST':
@@ -943,7 +1246,11 @@ def ajax_delete_opb_request(request):
             request_id = data['request_id']
             
             opb_request = get_object_or_404(OPBRequest, id=request_id, department_head=request.user)
-            opb_request.delete()
+            with serialized_atomic():
+                release_request(opb_request)
+                remove_from_cube(opb_request)
+                opb_request.delete()
+                invalidate_unit(opb_request.department_id)
             
             return JsonResponse({
                 'success': True,
@@ -959,6 +1266,7 @@ def ajax_delete_opb_request(request):
 
 @login_required
 @staff_member_required
+@serialized_write
 def ajax_approve_request(request):
     """AJAX endpoint to approve budget request"""
     if request.method == 'POST':
@@ -987,23 +1295,30 @@ def ajax_approve_request(request):
                     'message': 'Request has already been processed'
                 })
             
-            # Approve the request
-            req.status = 'for-approval'
-            req.admin_notes = data.get('notes', '')
-            req.save()
-            
-            # Create notification
-            if request_type == 'opb':
-                request_description = f"OPB for {req.unit or 'your unit'}"
-            else:
-                request_description = f"{request_type.upper()} request for {req.program_title}"
-            
-            Notification.objects.create(
-                user=req.department_head,
-                title=f'OPB for {req.unit} For Approval',
-                message=f'Your {request_description} has been set for approval.',
-                notification_type='success'
-            )
+            with serialized_atomic():
+                # Approve the request
+                previous_status = req.status
+                remove_from_cube(req)
+                req.status = 'for-approval'
+                req.admin_notes = data.get('notes', '')
+                req.save()
+                record_transition(req, previous_status, by=request.user, note=req.admin_notes)
+                add_to_cube(req)
+                invalidate_unit(req.department_id)
+                
+                # Create notification
+                if request_type == 'opb':
+                    request_description = f"OPB for {req.unit or 'your unit'}"
+                else:
+                    request_description = f"{request_type.upper()} request for {req.program_title}"
+                
+                Notification.objects.create(
+                    user=req.department_head,
+                    request_id=req.pk,
+                    title=f'OPB for {req.unit} For Approval',
+                    message=f'Your {request_description} has been set for approval.',
+                    notification_type='success'
+                )
             
             return JsonResponse({
                 'success': True,
@@ -1019,6 +1334,7 @@ def ajax_approve_request(request):
 
 @login_required
 @staff_member_required
+@serialized_write
 def ajax_reject_request(request):
     """AJAX endpoint to reject budget request"""
     if request.method == 'POST':
@@ -1040,22 +1356,29 @@ def ajax_reject_request(request):
                     'message': 'Invalid request type'
                 })
             
-            req.status = 'enhancement'
-            req.admin_notes = data.get('notes', data.get('reason', ''))
-            req.save()
-            
-            # Create notification
-            if request_type == 'opb':
-                request_description = f"OPB for {req.unit or 'your unit'}"
-            else:
-                request_description = f"{request_type.upper()} request for {req.program_title}"
-            
-            Notification.objects.create(
-                user=req.department_head,
-                title=f'OPB for {req.unit} For enhancement',
-                message=f'Your {request_description} has been set for enhancement.',
-                notification_type='warning'
-            )
+            with serialized_atomic():
+                previous_status = req.status
+                remove_from_cube(req)
+                req.status = 'enhancement'
+                req.admin_notes = data.get('notes', data.get('reason', ''))
+                req.save()
+                record_transition(req, previous_status, by=request.user, note=req.admin_notes)
+                add_to_cube(req)
+                invalidate_unit(req.department_id)
+                
+                # Create notification
+                if request_type == 'opb':
+                    request_description = f"OPB for {req.unit or 'your unit'}"
+                else:
+                    request_description = f"{request_type.upper()} request for {req.program_title}"
+                
+                Notification.objects.create(
+                    user=req.department_head,
+                    request_id=req.pk,
+                    title=f'OPB for {req.unit} For enhancement',
+                    message=f'Your {request_description} has been set for enhancement.',
+                    notification_type='warning'
+                )
             
             return JsonResponse({
                 'success': True,
@@ -1069,6 +1392,43 @@ def ajax_reject_request(request):
     return JsonResponse({'success': False, 'message': 'Invalid request'})
 
 
+@login_required
+@staff_member_required
+def ajax_bulk_import_users(request):
+    """
+    AJAX endpoint to create users from an uploaded CSV file.
+
+    Not behind ``serialized_write``: hashing the passwords takes a while and
+    must not hold the write slot. ``import_users`` takes it for the insert.
+    """
+    if request.method == 'POST':
+        try:
+            upload = request.FILES.get('file')
+            if upload is None:
+                return JsonResponse({
+                    'success': False,
+                    'message': 'Please choose a CSV file'
+                })
+            rows = read_csv(upload.read())
+            result = import_users(rows, dry_run=request.POST.get('dry_run') == 'true')
+
+            if result['dry_run']:
+                message = f"{result['valid']} row(s) valid, {result['failed']} with errors"
+            else:
+                message = f"{result['created']} user(s) created, {result['failed']} row(s) with errors"
+            return JsonResponse({
+                'success': True,
+                'message': message,
+                **result
+            })
+        except Exception as e:
+            return JsonResponse({
+                'success': False,
+                'message': str(e)
+            })
+    return JsonResponse({'success': False, 'message': 'Invalid request'})
+
+
 @login_required
 @staff_member_required
 def ajax_get_user(request, user_id):
@@ -1085,7 +1445,7 @@ def ajax_get_user(request, user_id):
                     'last_name': user.last_name,
                     'username': user.username,
                     'email': user.email,
-                    'department': user.department,
+                    'department': unit_code(user.department_id),
                     'role': user.role,
                 }
             })
@@ -1100,49 +1460,21 @@ def ajax_get_user(request, user_id):
 @login_required
 @staff_member_required
 def ajax_create_backup(request):
-    """AJAX endpoint to create database backup"""
+    """AJAX endpoint to start a database backup in the background"""
     if request.method == 'POST':
         try:
-            # Create backups directory if it doesn't exist
-            backup_dir = os.path.join(settings.BASE_DIR, 'backups')
-            os.makedirs(backup_dir, exist_ok=True)
-            
-            # Generate backup filename with timestamp
-            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-            backup_filename = f'caobp_backup_{timestamp}.sqlite3'
-            backup_path = os.path.join(backup_dir, backup_filename)
-            
-            # Get current database path
-            db_path = settings.DATABASES['default']['NAME']
-            
-            if not os.path.exists(db_path):
-                return JsonResponse({
-                    'success': False,
-                    'message': 'Database file not found'
-                })
-            
-            # Copy database file to backup location
-            shutil.copy2(db_path, backup_path)
-            
-            # Create metadata file
-            metadata = {
-                'created_at': datetime.now().isoformat(),
-                'created_by': request.user.username,
-                'database_size': os.path.getsize(db_path),
-                'total_users': User.objects.count(),
-                'total_opb_requests': OPBRequest.objects.count(),
-            }
-            
-            # Save metadata as JSON file
-            metadata_filename = f'caobp_backup_{timestamp}_metadata.json'
-            metadata_path = os.path.join(backup_dir, metadata_filename)
-            with open(metadata_path, 'w') as f:
-                json.dump(metadata, f, indent=2)
+            job_id = start_job(
+                'backup',
+                lambda job, created_by: create_backup(created_by, progress=job.progress),
+                request.user.username,
+                created_by=request.user.username,
+            )
             
             return JsonResponse({
                 'success': True,
-                'message': f'Database backup created successfully: {backup_filename}',
-                'backup_filename': backup_filename
+                'message': 'Database backup started',
+                'job_id': job_id,
+                'status_url': reverse('ajax_job_status', args=[job_id]),
             })
         except Exception as e:
             return JsonResponse({
@@ -1152,32 +1484,68 @@ def ajax_create_backup(request):
     return JsonResponse({'success': False, 'message': 'Invalid request'})
 
 
+@login_required
+@staff_member_required
+def ajax_export_data(request):
+    """AJAX endpoint to stream all system data as gzip-compressed NDJSON"""
+    if request.method == 'GET':
+        filename = f"caobp_export_{datetime.now().strftime('%Y%m%d_%H%M%S')}.ndjson.gz"
+        response = StreamingHttpResponse(gzip_stream(export_lines()), content_type='application/gzip')
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+        return response
+    return JsonResponse({'success': False, 'message': 'Invalid request'})
+
+
+@login_required
+@staff_member_required
+def ajax_job_status(request, job_id):
+    """AJAX endpoint to poll the status of a background job"""
+    job = get_job(job_id)
+    if job is None:
+        return JsonResponse({
+            'success': False,
+            'message': 'Job not found'
+        }, status=404)
+    return JsonResponse({
+        'success': True,
+        'job': job
+    })
+
+
 @login_required
 @staff_member_required
 def ajax_download_backup(request):
     """AJAX endpoint to download backup file"""
-    if request.method == 'POST':
+    if request.method in ('GET', 'POST'):
         try:
-            # Handle both FormData and JSON
-            if request.content_type == 'application/json':
+            # GET lets the browser stream straight to disk and resume with Range
+            if request.method == 'GET':
+                data = request.GET
+            elif request.content_type == 'application/json':
                 data = json.loads(request.body)
             else:
                 data = request.POST
-            backup_filename = data['filename']
+            backup_filename = os.path.basename(data['filename'])
+            compression = data.get('compress') or None
             
-            backup_dir = os.path.join(settings.BASE_DIR, 'backups')
-            backup_path = os.path.join(backup_dir, backup_filename)
+            backup_path = os.path.join(get_backup_dir(), backup_filename)
+            backup = open_backup(backup_filename)
             
-            if not os.path.exists(backup_path):
+            if backup is None:
                 return JsonResponse({
                     'success': False,
                     'message': 'Backup file not found'
                 })
             
-            with open(backup_path, 'rb') as f:
-                response = HttpResponse(f.read(), content_type='application/octet-stream')
-                response['Content-Disposition'] = f'attachment; filename="{backup_filename}"'
-                return response
+            if compression and compression not in available_compressions():
+                return JsonResponse({
+                    'success': False,
+                    'message': f'Unsupported compression: {compression}'
+                })
+            
+            checksum = read_backup_metadata(backup_path).get('checksum_sha256')
+            return file_download_response(request, backup, backup_filename,
+                                          checksum=checksum, compression=compression)
                 
         except Exception as e:
             return JsonResponse({
@@ -1199,26 +1567,9 @@ def ajax_delete_backup(request):
             else:
                 data = request.POST
             backup_filename = data['filename']
-            base, _ = os.path.splitext(backup_filename)
-            metadata_filename = f'{base}_metadata.json'
-            
-            backup_dir = os.path.join(settings.BASE_DIR, 'backups')
-            backup_path = os.path.join(backup_dir, backup_filename)
-            metadata_path = os.path.join(backup_dir, metadata_filename)
             
-            deleted_any = False
-
-            # Delete main backup
-            if os.path.exists(backup_path):
-                os.remove(backup_path)
-                deleted_any = True
-
-            # Delete metadata
-            if os.path.exists(metadata_path):
-                os.remove(metadata_path)
-                deleted_any = True
-
-            if deleted_any:
+            # Deletes the backup, its metadata and any chunks only it used
+            if delete_backup(backup_filename):
                 return JsonResponse({
                     'success': True,
                     'message': 'Backup deleted successfully'
@@ -1237,6 +1588,7 @@ def ajax_delete_backup(request):
     return JsonResponse({'success': False, 'message': 'Invalid request'})
 
 
+@maintenance_exempt
 @login_required
 @staff_member_required
 def ajax_restore_backup(request):
@@ -1250,29 +1602,22 @@ def ajax_restore_backup(request):
                 data = request.POST
             backup_filename = data['filename']
             
-            backup_dir = os.path.join(settings.BASE_DIR, 'backups')
-            backup_path = os.path.join(backup_dir, backup_filename)
-            
-            if not os.path.exists(backup_path):
+            # Writes are blocked only while the backup is swapped in
+            try:
+                timings = restore_backup(backup_filename, request.user.username)
+            except BackupError as e:
                 return JsonResponse({
                     'success': False,
-                    'message': 'Backup file not found'
+                    'message': f'Failed to restore backup: {str(e)}'
                 })
             
-            # Get current database path
-            db_path = settings.DATABASES['default']['NAME']
-            
-            # Create a backup of current database before restoring
-            current_backup = f"{db_path}.backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
-            if os.path.exists(db_path):
-                shutil.copy2(db_path, current_backup)
-            
-            # Replace current database with backup
-            shutil.copy2(backup_path, db_path)
-            
             return JsonResponse({
                 'success': True,
-                'message': 'Database restored successfully. The system is now using the backup database.'
+                'message': (
+                    'Database restored successfully in '
+                    f"{timings['total_seconds']:.1f}s (writes paused for {timings['writes_blocked_seconds']:.1f}s)."
+                ),
+                'timings': timings,
             })
                 
         except Exception as e:
@@ -1284,7 +1629,7 @@ def ajax_restore_backup(request):
 
 
 # Export Functions
-def export_reports_csv(opb_requests, dept_ranking):
+def export_reports_csv(opb_requests, dept_ranking, analytics=None):
     """Export reports as CSV"""
     response = HttpResponse(content_type='text/csv')
     response['Content-Disposition'] = 'attachment; filename="caobp_report.csv"'
@@ -1309,8 +1654,8 @@ def export_reports_csv(opb_requests, dept_ranking):
     rejected_budget_amount = sum(r.total_budget_amount for r in opb_requests.filter(status='enhancement'))
     
     # Get all departments and calculate submission statistics
-    all_departments = User.objects.filter(role='unit_head').values_list('department', flat=True).distinct()
-    submitted_departments = set(opb_requests.values_list('department', flat=True))
+    all_departments = unit_head_unit_ids()
+    submitted_departments = set(opb_requests.values_list('department_id', flat=True))
     not_submitted_departments = set(all_departments) - submitted_departments
     
     submission_percentage = (len(submitted_departments) / len(all_departments) * 100) if all_departments else 0
@@ -1352,18 +1697,18 @@ def export_reports_csv(opb_requests, dept_ranking):
     writer.writerow(['Unit', 'Display Name', 'Submissions', 'Total Budget', 'Status Distribution'])
     
     for dept in submitted_departments:
-        dept_requests = opb_requests.filter(department=dept)
+        dept_requests = opb_requests.filter(department_id=dept)
         dept_count = dept_requests.count()
         dept_total = sum(r.total_budget_amount for r in dept_requests)
         dept_approved = dept_requests.filter(status='for-approval').count()
         dept_pending = dept_requests.filter(status='pending').count()
         dept_rejected = dept_requests.filter(status='enhancement').count()
         
-        dept_display = dict(User.UNIT_CHOICES).get(dept, dept)
+        dept_display = unit_name(dept)
         status_dist = f"A:{dept_approved} P:{dept_pending} R:{dept_rejected}"
         
         writer.writerow([
-            dept,
+            unit_code(dept),
             dept_display,
             dept_count,
             f"₱{dept_total:,.2f}",
@@ -1375,8 +1720,8 @@ def export_reports_csv(opb_requests, dept_ranking):
     writer.writerow(['Units without Submissions'])
     writer.writerow(['Unit', 'Display Name', 'Status'])
     for dept in not_submitted_departments:
-        dept_display = dict(User.UNIT_CHOICES).get(dept, dept)
-        writer.writerow([dept, dept_display, 'No Submission'])
+        dept_display = unit_name(dept)
+        writer.writerow([unit_code(dept), dept_display, 'No Submission'])
     
     writer.writerow([])
     
@@ -1388,8 +1733,8 @@ def export_reports_csv(opb_requests, dept_ranking):
     
     writer.writerow(['Rank', 'Unit', 'Display Name', 'Total Budget', 'Submissions', 'Average per Submission'])
     for i, dept in enumerate(dept_ranking, 1):
-        dept_display = dict(User.UNIT_CHOICES).get(dept['department'], dept['department'])
-        dept_requests_count = opb_requests.filter(department=dept['department']).count()
+        dept_display = unit_name(dept['unit_id'])
+        dept_requests_count = opb_requests.filter(department_id=dept['unit_id']).count()
         avg_per_request = dept['total'] / dept_requests_count if dept_requests_count > 0 else 0
         
         writer.writerow([
@@ -1403,6 +1748,16 @@ def export_reports_csv(opb_requests, dept_ranking):
     
     writer.writerow([])
     
+    # DISTRIBUTION ANALYTICS
+    for title, header, rows in export_tables(analytics):
+        writer.writerow(['=' * 80])
+        writer.writerow([title.upper()])
+        writer.writerow(['=' * 80])
+        writer.writerow([])
+        writer.writerow(header)
+        writer.writerows(rows)
+        writer.writerow([])
+    
     # DETAILED REQUEST BREAKDOWN
     writer.writerow(['=' * 80])
     writer.writerow(['DETAILED OPB SUBMISSION BREAKDOWN'])
@@ -1468,7 +1823,7 @@ def export_reports_csv(opb_requests, dept_ranking):
     return response
 
 
-def export_reports_pdf(opb_requests, dept_ranking):
+def export_reports_pdf(opb_requests, dept_ranking, analytics=None):
     """Export reports as PDF"""
     try:
         from reportlab.lib.pagesizes import letter, A4
@@ -1528,8 +1883,8 @@ def export_reports_pdf(opb_requests, dept_ranking):
         rejected_budget_amount = sum(r.total_budget_amount for r in opb_requests.filter(status='enhancement'))
         
         # Get all departments and calculate submission statistics
-        all_departments = User.objects.filter(role='unit_head').values_list('department', flat=True).distinct()
-        submitted_departments = set(opb_requests.values_list('department', flat=True))
+        all_departments = unit_head_unit_ids()
+        submitted_departments = set(opb_requests.values_list('department_id', flat=True))
         not_submitted_departments = set(all_departments) - submitted_departments
         submission_percentage = (len(submitted_departments) / len(all_departments) * 100) if all_departments else 0
         
@@ -1593,18 +1948,18 @@ def export_reports_pdf(opb_requests, dept_ranking):
         dept_submission_data = [['Unit', 'Display Name', 'Submissions', 'Total Budget', 'Status Distribution']]
         
         for dept in submitted_departments:
-            dept_requests = opb_requests.filter(department=dept)
+            dept_requests = opb_requests.filter(department_id=dept)
             dept_count = dept_requests.count()
             dept_total = sum(r.total_budget_amount for r in dept_requests)
             dept_approved = dept_requests.filter(status='for-approval').count()
             dept_pending = dept_requests.filter(status='pending').count()
             dept_rejected = dept_requests.filter(status='enhancement').count()
             
-            dept_display = dict(User.UNIT_CHOICES).get(dept, dept)
+            dept_display = unit_name(dept)
             status_dist = f"A:{dept_approved} P:{dept_pending} R:{dept_rejected}"
             
             dept_submission_data.append([
-                dept,
+                unit_code(dept),
                 dept_display,
                 str(dept_count),
                 f"₱{dept_total:,.2f}",
@@ -1632,8 +1987,8 @@ def export_reports_pdf(opb_requests, dept_ranking):
             no_submission_data = [['Unit', 'Display Name', 'Status']]
             
             for dept in not_submitted_departments:
-                dept_display = dict(User.UNIT_CHOICES).get(dept, dept)
-                no_submission_data.append([dept, dept_display, 'No Submission'])
+                dept_display = unit_name(dept)
+                no_submission_data.append([unit_code(dept), dept_display, 'No Submission'])
             
             no_submission_table = Table(no_submission_data, colWidths=[2*inch, 2*inch, 2*inch])
             no_submission_table.setStyle(TableStyle([
@@ -1657,8 +2012,8 @@ def export_reports_pdf(opb_requests, dept_ranking):
         ranking_data = [['Rank', 'Unit', 'Display Name', 'Total Budget', 'Submissions', 'Average per Submission']]
         
         for i, dept in enumerate(dept_ranking, 1):
-            dept_display = dict(User.UNIT_CHOICES).get(dept['department'], dept['department'])
-            dept_requests_count = opb_requests.filter(department=dept['department']).count()
+            dept_display = unit_name(dept['unit_id'])
+            dept_requests_count = opb_requests.filter(department_id=dept['unit_id']).count()
             avg_per_request = dept['total'] / dept_requests_count if dept_requests_count > 0 else 0
             
             ranking_data.append([
@@ -1685,6 +2040,27 @@ def export_reports_pdf(opb_requests, dept_ranking):
         story.append(ranking_table)
         story.append(PageBreak())
         
+        # DISTRIBUTION ANALYTICS
+        for title, header, rows in export_tables(analytics):
+            story.append(Paragraph(title, section_style))
+            if not rows:
+                story.append(Paragraph("None", styles['Normal']))
+                story.append(Spacer(1, 20))
+                continue
+            analytics_table = Table([header] + rows, repeatRows=1)
+            analytics_table.setStyle(TableStyle([
+                ('BACKGROUND', (0, 0), (-1, 0), colors.darkblue),
+                ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+                ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+                ('FONTSIZE', (0, 0), (-1, -1), 8),
+                ('GRID', (0, 0), (-1, -1), 1, colors.black),
+                ('ROWBACKGROUNDS', (0, 1), (-1, -1), [colors.white, colors.lightgrey])
+            ]))
+            story.append(analytics_table)
+            story.append(Spacer(1, 20))
+        if analytics:
+            story.append(PageBreak())
+        
         # DETAILED REQUEST BREAKDOWN
         story.append(Paragraph("DETAILED OPB SUBMISSION BREAKDOWN", section_style))
         
@@ -1736,7 +2112,7 @@ def export_reports_pdf(opb_requests, dept_ranking):
         return HttpResponse(f"Error generating PDF: {str(e)}", content_type='text/plain')
 
 
-def export_reports_docx(opb_requests, dept_ranking):
+def export_reports_docx(opb_requests, dept_ranking, analytics=None):
     """Export reports as DOCX"""
     try:
         from docx import Document
@@ -1784,8 +2160,8 @@ def export_reports_docx(opb_requests, dept_ranking):
         rejected_budget_amount = sum(r.total_budget_amount for r in opb_requests.filter(status='enhancement'))
         
         # Get all departments and calculate submission statistics
-        all_departments = User.objects.filter(role='unit_head').values_list('department', flat=True).distinct()
-        submitted_departments = set(opb_requests.values_list('department', flat=True))
+        all_departments = unit_head_unit_ids()
+        submitted_departments = set(opb_requests.values_list('department_id', flat=True))
         not_submitted_departments = set(all_departments) - submitted_departments
         submission_percentage = (len(submitted_departments) / len(all_departments) * 100) if all_departments else 0
         
@@ -1855,18 +2231,18 @@ def export_reports_docx(opb_requests, dept_ranking):
         dept_submission_data = [['Unit', 'Display Name', 'Requests', 'Total Budget', 'Status Distribution']]
         
         for dept in submitted_departments:
-            dept_requests = opb_requests.filter(department=dept)
+            dept_requests = opb_requests.filter(department_id=dept)
             dept_count = dept_requests.count()
             dept_total = sum(r.total_budget_amount for r in dept_requests)
             dept_approved = dept_requests.filter(status='for-approval').count()
             dept_pending = dept_requests.filter(status='pending').count()
             dept_rejected = dept_requests.filter(status='enhancement').count()
             
-            dept_display = dict(User.UNIT_CHOICES).get(dept, dept)
+            dept_display = unit_name(dept)
             status_dist = f"A:{dept_approved} P:{dept_pending} R:{dept_rejected}"
             
             dept_submission_data.append([
-                dept,
+                unit_code(dept),
                 dept_display,
                 str(dept_count),
                 f"₱{dept_total:,.2f}",
@@ -1898,8 +2274,8 @@ def export_reports_docx(opb_requests, dept_ranking):
             no_submission_data = [['Unit', 'Display Name', 'Status']]
             
             for dept in not_submitted_departments:
-                dept_display = dict(User.UNIT_CHOICES).get(dept, dept)
-                no_submission_data.append([dept, dept_display, 'No Submission'])
+                dept_display = unit_name(dept)
+                no_submission_data.append([unit_code(dept), dept_display, 'No Submission'])
             
             no_submission_table = doc.add_table(rows=len(no_submission_data), cols=3)
             no_submission_table.style = 'Table Grid'
@@ -1926,8 +2302,8 @@ def export_reports_docx(opb_requests, dept_ranking):
         ranking_data = [['Rank', 'Unit', 'Display Name', 'Total Budget', 'Submissions', 'Average per Submission']]
         
         for i, dept in enumerate(dept_ranking, 1):
-            dept_display = dict(User.UNIT_CHOICES).get(dept['department'], dept['department'])
-            dept_requests_count = opb_requests.filter(department=dept['department']).count()
+            dept_display = unit_name(dept['unit_id'])
+            dept_requests_count = opb_requests.filter(department_id=dept['unit_id']).count()
             avg_per_request = dept['total'] / dept_requests_count if dept_requests_count > 0 else 0
             
             ranking_data.append([
@@ -1958,6 +2334,22 @@ def export_reports_docx(opb_requests, dept_ranking):
         
         doc.add_page_break()
         
+        # DISTRIBUTION ANALYTICS
+        for title, header, rows in export_tables(analytics):
+            doc.add_heading(title, level=1)
+            if not rows:
+                doc.add_paragraph('None')
+                continue
+            analytics_table = doc.add_table(rows=len(rows) + 1, cols=len(header))
+            analytics_table.style = 'Table Grid'
+            for i, row_data in enumerate([header] + rows):
+                for j, cell_data in enumerate(row_data):
+                    analytics_table.rows[i].cells[j].text = cell_data
+                    if i == 0:
+                        analytics_table.rows[i].cells[j].paragraphs[0].runs[0].bold = True
+        if analytics:
+            doc.add_page_break()
+        
         # DETAILED REQUEST BREAKDOWN
         doc.add_heading('DETAILED OPB SUBMISSION BREAKDOWN', level=1)
         
@@ -0,0 +1,180 @@
+"""
+Database connection helpers for the CAOBP system.
+
+SQLite is tuned when each connection is opened, through Django's
+``init_command`` option, so every worker talks to the database in WAL mode
+with the same pragmas. Each pragma can be overridden from ``settings.py`` or
+from the environment.
+"""
+import os
+
+
+# PRAGMA name -> (environment variable, default value)
+SQLITE_PRAGMA_DEFAULTS = {
+    'journal_mode': ('SQLITE_JOURNAL_MODE', 'WAL'),
+    'synchronous': ('SQLITE_SYNCHRONOUS', 'NORMAL'),
+    'busy_timeout': ('SQLITE_BUSY_TIMEOUT_MS', '5000'),
+    'mmap_size': ('SQLITE_MMAP_SIZE', str(256 * 1024 * 1024)),
+    # Negative values are KiB, so this is a 64 MiB page cache per connection
+    'cache_size': ('SQLITE_CACHE_SIZE', '-65536'),
+    'temp_store': ('SQLITE_TEMP_STORE', 'MEMORY'),
+}
+
+# Start write transactions with BEGIN IMMEDIATE so a transaction that reads
+# first and writes later cannot fail half-way with "database is locked".
+SQLITE_TRANSACTION_MODE = ('SQLITE_TRANSACTION_MODE', 'IMMEDIATE')
+
+
+def env_flag(name, default=False, environ=None):
+    """Read a boolean flag such as ``1``/``true``/``yes`` from the environment"""
+    environ = os.environ if environ is None else environ
+    value = environ.get(name)
+    if value is None or value == '':
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+def sqlite_pragmas(overrides=None, environ=None):
+    """
+    Resolve the pragmas applied to every SQLite connection.
+
+    Environment variables win over the defaults and ``overrides`` (usually
+    ``settings.SQLITE_PRAGMAS``) win over both. A pragma set to ``None`` or
+    an empty string is skipped. ``SQLITE_TUNING=0`` turns the whole layer
+    off, which is what the concurrency benchmark uses as its baseline.
+    """
+    environ = os.environ if environ is None else environ
+    if not env_flag('SQLITE_TUNING', default=True, environ=environ):
+        return {}
+
+    pragmas = {
+        name: environ.get(env_var, default)
+        for name, (env_var, default) in SQLITE_PRAGMA_DEFAULTS.items()
+    }
+    if overrides:
+        pragmas.update(overrides)
+    return {name: value for name, value in pragmas.items() if value not in (None, '')}
+
+
+def sqlite_init_command(pragmas):
+    """Render pragmas as a ``;``-separated ``init_command`` string"""
+    return ';'.join(f'PRAGMA {name}={value}' for name, value in pragmas.items())
+
+
+def sqlite_options(overrides=None, environ=None):
+    """Build ``DATABASES['default']['OPTIONS']`` for the SQLite backend"""
+    environ = os.environ if environ is None else environ
+    pragmas = sqlite_pragmas(overrides, environ)
+    options = {}
+    if env_flag('SQLITE_TUNING', default=True, environ=environ):
+        env_var, default = SQLITE_TRANSACTION_MODE
+        transaction_mode = environ.get(env_var, default)
+        if transaction_mode:
+            options['transaction_mode'] = transaction_mode
+    if pragmas:
+        options['init_command'] = sqlite_init_command(pragmas)
+    if 'busy_timeout' in pragmas:
+        # Python's sqlite3 module installs its own busy handler from
+        # ``timeout``; keep it in step with the pragma.
+        options['timeout'] = int(pragmas['busy_timeout']) / 1000
+    return options
+
+
+def env_int(name, default, environ=None):
+    environ = os.environ if environ is None else environ
+    value = environ.get(name)
+    return int(value) if value not in (None, '') else default
+
+
+# Short names accepted in DB_ENGINE
+DB_ENGINES = {
+    'sqlite': 'django.db.backends.sqlite3',
+    'sqlite3': 'django.db.backends.sqlite3',
+    'postgres': 'django.db.backends.postgresql',
+    'postgresql': 'django.db.backends.postgresql',
+}
+
+
+def database_config(base_dir, sqlite_pragma_overrides=None, environ=None):
+    """
+    Build ``DATABASES['default']`` from the environment.
+
+    ``DB_ENGINE`` selects the backend (``sqlite`` by default, or
+    ``postgresql``). For PostgreSQL the connection comes from ``DB_NAME``,
+    ``DB_USER``, ``DB_PASSWORD``, ``DB_HOST`` and ``DB_PORT``, and is kept
+    open between requests for ``DB_CONN_MAX_AGE`` seconds with health checks
+    on reuse. ``DB_POOL=1`` switches to psycopg's connection pool instead
+    (sized by ``DB_POOL_MIN_SIZE``/``DB_POOL_MAX_SIZE``); Django requires
+    ``CONN_MAX_AGE=0`` in that case. ``DB_TEST_NAME`` names the test database.
+    """
+    environ = os.environ if environ is None else environ
+    engine_name = (environ.get('DB_ENGINE') or 'sqlite').strip().lower()
+    engine = DB_ENGINES.get(engine_name, engine_name)
+
+    if engine == 'django.db.backends.sqlite3':
+        config = {
+            'ENGINE': engine,
+            'NAME': environ.get('DB_NAME') or os.path.join(base_dir, 'db.sqlite3'),
+            'OPTIONS': sqlite_options(sqlite_pragma_overrides, environ),
+        }
+    else:
+        config = {
+            'ENGINE': engine,
+            'NAME': environ.get('DB_NAME', 'caobp'),
+            'USER': environ.get('DB_USER', 'caobp'),
+            'PASSWORD': environ.get('DB_PASSWORD', ''),
+            'HOST': environ.get('DB_HOST', 'localhost'),
+            'PORT': environ.get('DB_PORT', '5432'),
+            'CONN_MAX_AGE': env_int('DB_CONN_MAX_AGE', 60, environ),
+            'CONN_HEALTH_CHECKS': env_flag('DB_CONN_HEALTH_CHECKS', default=True, environ=environ),
+            'OPTIONS': {
+                'connect_timeout': env_int('DB_CONNECT_TIMEOUT', 5, environ),
+            },
+        }
+        if env_flag('DB_POOL', environ=environ):
+            config['CONN_MAX_AGE'] = 0
+            config['OPTIONS']['pool'] = {
+                'min_size': env_int('DB_POOL_MIN_SIZE', 2, environ),
+                'max_size': env_int('DB_POOL_MAX_SIZE', 10, environ),
+                'timeout': env_int('DB_POOL_TIMEOUT', 10, environ),
+            }
+
+    if environ.get('DB_TEST_NAME'):
+        config['TEST'] = {'NAME': environ['DB_TEST_NAME']}
+    return config
+
+
+def is_sqlite(config):
+    return config['ENGINE'] == 'django.db.backends.sqlite3'
+
+
+def replica_config(primary, base_dir, environ=None):
+    """
+    Build ``DATABASES['replica']`` or return ``None`` when replicas are off.
+
+    ``DB_REPLICA=1`` turns read replicas on. With SQLite the replica is a
+    snapshot file (``DB_REPLICA_NAME``, default ``db.replica.sqlite3``)
+    refreshed from the primary with the backup API. With a server database
+    it is a streaming follower reached through ``DB_REPLICA_HOST``/
+    ``DB_REPLICA_PORT``, using the primary's credentials.
+    """
+    environ = os.environ if environ is None else environ
+    if not env_flag('DB_REPLICA', environ=environ):
+        return None
+
+    config = dict(primary)
+    config['OPTIONS'] = dict(primary.get('OPTIONS', {}))
+    if is_sqlite(primary):
+        config['NAME'] = environ.get('DB_REPLICA_NAME') or os.path.join(base_dir, 'db.replica.sqlite3')
+        # The snapshot is only ever read, and keeps its own journal mode
+        config['OPTIONS'].pop('transaction_mode', None)
+        init_command = config['OPTIONS'].get('init_command', '')
+        config['OPTIONS']['init_command'] = ';'.join(
+            statement for statement in init_command.split(';')
+            if not statement.startswith('PRAGMA journal_mode')
+        )
+    else:
+        config['HOST'] = environ.get('DB_REPLICA_HOST', primary.get('HOST'))
+        config['PORT'] = environ.get('DB_REPLICA_PORT', primary.get('PORT'))
+    config['TEST'] = {'MIRROR': 'default'}
+    return config
@@ -0,0 +1,91 @@
+"""
+Cross-process file locks.
+
+Workers started by the WSGI server do not share memory, so anything that must
+happen one at a time across the whole deployment (SQLite writes, backups,
+restores) coordinates through an advisory lock on a file next to the database.
+"""
+import os
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+
+class LockTimeout(Exception):
+    """Raised when a file lock could not be acquired in time"""
+
+
+class FileLock:
+    """
+    Exclusive advisory lock on ``path``.
+
+    Usable as a context manager. ``timeout=None`` blocks until the lock is
+    free, ``timeout=0`` fails immediately if another process holds it.
+    ``shared=True`` takes a shared lock, which any number of holders can
+    have at once but which excludes an exclusive holder (on Windows shared
+    locks are exclusive).
+    """
+
+    poll_interval = 0.005
+
+    def __init__(self, path, timeout=None, shared=False):
+        self.path = str(path)
+        self.timeout = timeout
+        self.shared = shared
+        self._fd = None
+
+    @property
+    def locked(self):
+        return self._fd is not None
+
+    def acquire(self, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            try:
+                self._lock(fd, blocking=deadline is None, shared=self.shared)
+                self._fd = fd
+                return self
+            except OSError:
+                if deadline is not None and time.monotonic() >= deadline:
+                    os.close(fd)
+                    raise LockTimeout(f'Timed out waiting for {self.path}')
+                time.sleep(self.poll_interval)
+
+    def release(self):
+        if self._fd is None:
+            return
+        try:
+            self._unlock(self._fd)
+        finally:
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+
+    @staticmethod
+    def _lock(fd, blocking, shared=False):
+        if fcntl is not None:
+            mode = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+            fcntl.flock(fd, mode if blocking else mode | fcntl.LOCK_NB)
+        else:
+            os.lseek(fd, 0, os.SEEK_SET)
+            msvcrt.locking(fd, msvcrt.LK_LOCK if blocking else msvcrt.LK_NBLCK, 1)
+
+    @staticmethod
+    def _unlock(fd):
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        else:
+            os.lseek(fd, 0, os.SEEK_SET)
+            msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
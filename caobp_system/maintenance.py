@@ -0,0 +1,230 @@
+"""
+Maintenance mode for restores.
+
+While the maintenance flag file exists, unsafe (POST/PUT/PATCH/DELETE)
+requests get a 503 with ``Retry-After``; reads carry on as normal. Every
+unsafe request that was admitted holds a shared lock on the drain file for
+as long as it runs, so ``maintenance()`` can wait for all of them, in every
+worker process, by taking that lock exclusively. Work that writes outside a
+request (background jobs) does the same through ``hold_writes()``.
+
+After the database has been replaced the connection generation is bumped.
+``MaintenanceMiddleware`` compares it on every request and, when it has
+changed, closes the worker's persistent connections and clears its cache,
+so no worker keeps using a connection or cached data from before the
+restore.
+"""
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+from django.http import JsonResponse
+
+from .locks import FileLock, LockTimeout
+
+logger = logging.getLogger(__name__)
+
+UNSAFE_METHODS = ('POST', 'PUT', 'PATCH', 'DELETE')
+
+
+class DrainTimeout(Exception):
+    """Raised when in-flight requests did not finish in time"""
+
+
+class MaintenanceActive(Exception):
+    """Raised by ``hold_writes()`` while the system is in maintenance"""
+
+
+def maintenance_config():
+    config = getattr(settings, 'MAINTENANCE', {})
+    base = os.path.join(str(settings.BASE_DIR), 'maintenance')
+    return {
+        'FLAG_FILE': str(config.get('FLAG_FILE', f'{base}.json')),
+        'DRAIN_FILE': str(config.get('DRAIN_FILE', f'{base}.drain')),
+        'GENERATION_FILE': str(config.get('GENERATION_FILE', f'{base}.generation')),
+        'DRAIN_TIMEOUT': config.get('DRAIN_TIMEOUT', 30.0),
+        'RETRY_AFTER': config.get('RETRY_AFTER', 10),
+    }
+
+
+# Flag -----------------------------------------------------------------------
+
+def maintenance_status():
+    """Contents of the flag file, or ``None`` when not in maintenance"""
+    try:
+        with open(maintenance_config()['FLAG_FILE']) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError):
+        # Present but unreadable (being written): still in maintenance
+        return {}
+
+
+def maintenance_active():
+    return os.path.exists(maintenance_config()['FLAG_FILE'])
+
+
+def enter_maintenance(reason):
+    path = maintenance_config()['FLAG_FILE']
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'reason': reason, 'started_at': datetime.now().isoformat(), 'pid': os.getpid()}, f)
+    os.replace(tmp_path, path)
+
+
+def exit_maintenance():
+    try:
+        os.remove(maintenance_config()['FLAG_FILE'])
+    except FileNotFoundError:
+        pass
+
+
+# Connection generation --------------------------------------------------
+
+def read_generation():
+    try:
+        with open(maintenance_config()['GENERATION_FILE']) as f:
+            return int(f.read().strip() or 0)
+    except (OSError, ValueError):
+        return 0
+
+
+def bump_generation():
+    """Tell every worker to reopen its database connections"""
+    path = maintenance_config()['GENERATION_FILE']
+    generation = read_generation() + 1
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(str(generation))
+    os.replace(tmp_path, path)
+    return generation
+
+
+_seen_generation = None
+
+
+def _close_stale_connections():
+    global _seen_generation
+    generation = read_generation()
+    if _seen_generation is None:
+        _seen_generation = generation
+    elif generation != _seen_generation:
+        logger.info('Database generation changed to %d; reopening connections', generation)
+        _seen_generation = generation
+        connections.close_all()
+        # Cached from the old database, e.g. the head dashboard statistics
+        cache.clear()
+
+
+# Draining ---------------------------------------------------------------
+
+@contextmanager
+def maintenance(reason, drain_timeout=None):
+    """
+    Block new writes, wait for in-flight writes to finish, then run the
+    block. On the way out, every worker is told to reopen its connections
+    and writes are accepted again.
+
+    Yields a dict with ``drain_seconds``. Raises ``DrainTimeout`` (after
+    leaving maintenance) if in-flight requests do not finish in time.
+    """
+    config = maintenance_config()
+    timeout = config['DRAIN_TIMEOUT'] if drain_timeout is None else drain_timeout
+    enter_maintenance(reason)
+    try:
+        started = time.monotonic()
+        drain = FileLock(config['DRAIN_FILE'])
+        try:
+            drain.acquire(timeout=timeout)
+        except LockTimeout:
+            raise DrainTimeout(f'In-flight requests did not finish within {timeout:g}s')
+        try:
+            timings = {'drain_seconds': round(time.monotonic() - started, 3)}
+            connections.close_all()
+            yield timings
+            bump_generation()
+        finally:
+            drain.release()
+    finally:
+        exit_maintenance()
+
+
+def _hold_drain(config):
+    """The drain lock taken shared, or ``None`` during maintenance"""
+    if maintenance_active():
+        return None
+    drain = FileLock(config['DRAIN_FILE'], shared=True)
+    try:
+        drain.acquire(timeout=0)
+    except LockTimeout:
+        # A restore is draining writes right now
+        return None
+    if maintenance_active():
+        # Maintenance started between the check and the lock
+        drain.release()
+        return None
+    return drain
+
+
+@contextmanager
+def hold_writes():
+    """
+    Hold the drain lock for the duration of the block, as an admitted
+    request does, so a restore waits for the writes in it. Raises
+    ``MaintenanceActive`` during maintenance.
+    """
+    drain = _hold_drain(maintenance_config())
+    if drain is None:
+        raise MaintenanceActive('The system is being restored from a backup')
+    try:
+        yield
+    finally:
+        drain.release()
+
+
+def maintenance_exempt(view_func):
+    """Let a view run during maintenance and without holding the drain lock"""
+    view_func.maintenance_exempt = True
+    return view_func
+
+
+def _maintenance_response(retry_after):
+    response = JsonResponse({
+        'success': False,
+        'message': 'The system is being restored from a backup. Please try again in a moment.'
+    }, status=503)
+    response['Retry-After'] = str(retry_after)
+    return response
+
+
+class MaintenanceMiddleware:
+    """Reject writes during maintenance and track in-flight writes"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        _close_stale_connections()
+        try:
+            return self.get_response(request)
+        finally:
+            drain = getattr(request, '_maintenance_drain', None)
+            if drain is not None:
+                drain.release()
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if request.method not in UNSAFE_METHODS or getattr(view_func, 'maintenance_exempt', False):
+            return None
+        config = maintenance_config()
+        drain = _hold_drain(config)
+        if drain is None:
+            return _maintenance_response(config['RETRY_AFTER'])
+        request._maintenance_drain = drain
+        return None
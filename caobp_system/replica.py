@@ -0,0 +1,221 @@
+"""
+Read replica for the heavy admin read paths.
+
+Views decorated with ``read_from_replica`` send their queries to the
+``replica`` connection through ``caobp_system.routers.ReplicaRouter``:
+
+* With SQLite the replica is a snapshot copy of the primary taken with the
+  online backup API and swapped in atomically. A refresh is started in the
+  background whenever a replica read finds the snapshot older than
+  ``REFRESH_INTERVAL``; ``manage.py refresh_replica`` does the same from cron.
+* With PostgreSQL the replica is a streaming follower and its lag is read
+  from ``pg_last_xact_replay_timestamp()``.
+
+If the replica is missing or staler than ``MAX_STALENESS`` the primary is
+used. Sessions that wrote recently are pinned to the primary so users always
+read their own writes.
+"""
+import contextvars
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.db import connections
+
+from .locks import FileLock, LockTimeout
+
+logger = logging.getLogger(__name__)
+
+REPLICA_ALIAS = 'replica'
+LAST_WRITE_SESSION_KEY = 'last_write_at'
+
+_use_replica = contextvars.ContextVar('use_replica', default=False)
+
+# (checked_at, lag) for server replicas, so lag is not queried on every read
+_lag_cache = {}
+_lag_cache_ttl = 5.0
+_refresh_thread = None
+_refresh_thread_lock = threading.Lock()
+# Snapshot version each thread's replica connection was opened against
+_local = threading.local()
+
+
+def replica_config():
+    return getattr(settings, 'READ_REPLICA', {})
+
+
+def replica_enabled():
+    return replica_config().get('ENABLED', False) and REPLICA_ALIAS in settings.DATABASES
+
+
+def replica_is_sqlite():
+    return settings.DATABASES[REPLICA_ALIAS]['ENGINE'] == 'django.db.backends.sqlite3'
+
+
+# SQLite snapshots -----------------------------------------------------------
+
+def _snapshot_path():
+    return str(settings.DATABASES[REPLICA_ALIAS]['NAME'])
+
+
+def _snapshot_meta_path():
+    return _snapshot_path() + '.json'
+
+
+def snapshot_refreshed_at():
+    try:
+        with open(_snapshot_meta_path()) as f:
+            return json.load(f)['refreshed_at']
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def refresh_sqlite_snapshot(pages=1024, sleep=0.005):
+    """
+    Copy the primary into the snapshot file with the online backup API.
+
+    The copy is written next to the snapshot and renamed over it, so readers
+    never see a half-written file. Returns ``False`` when another process is
+    already refreshing.
+    """
+    primary = str(settings.DATABASES['default']['NAME'])
+    target = _snapshot_path()
+    lock = FileLock(target + '.lock')
+    try:
+        lock.acquire(timeout=0)
+    except LockTimeout:
+        return False
+
+    try:
+        started = time.time()
+        tmp_path = f'{target}.tmp'
+        source = sqlite3.connect(primary)
+        dest = sqlite3.connect(tmp_path)
+        try:
+            # In WAL mode a single pass reads one consistent snapshot without
+            # blocking writers. Otherwise copy in small steps so writers can
+            # interleave (a step that sees a change restarts the copy).
+            wal = source.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+            source.backup(dest, pages=-1 if wal else pages, sleep=sleep)
+            # A snapshot does not need its own WAL
+            dest.execute('PRAGMA journal_mode=DELETE')
+        finally:
+            dest.close()
+            source.close()
+        os.replace(tmp_path, target)
+
+        meta_tmp = _snapshot_meta_path() + '.tmp'
+        with open(meta_tmp, 'w') as f:
+            json.dump({'refreshed_at': started, 'duration': time.time() - started}, f)
+        os.replace(meta_tmp, _snapshot_meta_path())
+        logger.info('Replica snapshot refreshed in %.2fs', time.time() - started)
+        return True
+    finally:
+        lock.release()
+
+
+def _refresh_in_background():
+    global _refresh_thread
+    with _refresh_thread_lock:
+        if _refresh_thread is not None and _refresh_thread.is_alive():
+            return
+
+        def run():
+            try:
+                refresh_sqlite_snapshot()
+            except Exception:
+                logger.exception('Replica snapshot refresh failed')
+
+        _refresh_thread = threading.Thread(target=run, name='replica-refresh', daemon=True)
+        _refresh_thread.start()
+
+
+# Lag --------------------------------------------------------------------
+
+def replica_lag():
+    """Seconds the replica is behind the primary, or ``None`` if unusable"""
+    if not replica_enabled():
+        return None
+
+    if replica_is_sqlite():
+        refreshed_at = snapshot_refreshed_at()
+        if refreshed_at is None or not os.path.exists(_snapshot_path()):
+            return None
+        return max(0.0, time.time() - refreshed_at)
+
+    cached = _lag_cache.get(REPLICA_ALIAS)
+    if cached and time.monotonic() - cached[0] < _lag_cache_ttl:
+        return cached[1]
+    try:
+        with connections[REPLICA_ALIAS].cursor() as cursor:
+            cursor.execute(
+                'SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 '
+                'ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END'
+            )
+            row = cursor.fetchone()
+        lag = float(row[0]) if row and row[0] is not None else None
+    except Exception:
+        logger.warning('Replica lag check failed', exc_info=True)
+        lag = None
+    _lag_cache[REPLICA_ALIAS] = (time.monotonic(), lag)
+    return lag
+
+
+def replica_usable():
+    lag = replica_lag()
+    if replica_is_sqlite():
+        if lag is None or lag > replica_config().get('REFRESH_INTERVAL', 60):
+            _refresh_in_background()
+    return lag is not None and lag <= replica_config().get('MAX_STALENESS', 120)
+
+
+def _reopen_if_snapshot_changed():
+    # An open SQLite connection keeps reading the file it opened; after a
+    # refresh has renamed a new snapshot into place, reconnect.
+    refreshed_at = snapshot_refreshed_at()
+    if getattr(_local, 'snapshot', None) != refreshed_at:
+        connections[REPLICA_ALIAS].close()
+        _local.snapshot = refreshed_at
+
+
+# Routing ----------------------------------------------------------------
+
+def reading_from_replica():
+    return _use_replica.get()
+
+
+def note_write(request):
+    """Pin this session to the primary for ``PIN_AFTER_WRITE`` seconds"""
+    session = getattr(request, 'session', None)
+    if session is not None and replica_enabled():
+        session[LAST_WRITE_SESSION_KEY] = time.time()
+
+
+def _wrote_recently(request):
+    session = getattr(request, 'session', None)
+    if session is None:
+        return False
+    last_write = session.get(LAST_WRITE_SESSION_KEY)
+    return last_write is not None and time.time() - last_write < replica_config().get('PIN_AFTER_WRITE', 30)
+
+
+def read_from_replica(view_func):
+    """Serve a read-only view from the replica when it is fresh enough"""
+    @wraps(view_func)
+    def wrapper(request, *args, **kwargs):
+        if (request.method not in ('GET', 'HEAD') or not replica_enabled()
+                or _wrote_recently(request) or not replica_usable()):
+            return view_func(request, *args, **kwargs)
+        if replica_is_sqlite():
+            _reopen_if_snapshot_changed()
+        token = _use_replica.set(True)
+        try:
+            return view_func(request, *args, **kwargs)
+        finally:
+            _use_replica.reset(token)
+    return wrapper
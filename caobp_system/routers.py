@@ -0,0 +1,25 @@
+from .replica import REPLICA_ALIAS, reading_from_replica
+
+
+class ReplicaRouter:
+    """
+    Send reads made inside ``read_from_replica`` views to the replica.
+
+    Everything else, and every write, goes to the primary. Migrations only
+    run on the primary; the replica is a copy of it.
+    """
+
+    def db_for_read(self, model, **hints):
+        if reading_from_replica():
+            return REPLICA_ALIAS
+        return None
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Both connections hold the same data
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db != REPLICA_ALIAS
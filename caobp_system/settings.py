@@ -10,8 +10,12 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 
+import os
+from datetime import date
 from pathlib import Path
 
+from .database import database_config, env_flag, env_int, is_sqlite, replica_config
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -45,6 +49,7 @@ MIDDLEWARE = [
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
+    "caobp_system.maintenance.MaintenanceMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
     "django.contrib.auth.middleware.AuthenticationMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
@@ -75,11 +80,46 @@ WSGI_APPLICATION = "caobp_system.wsgi.application"
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
+# The database is chosen from the environment: SQLite (the default) or
+# PostgreSQL with persistent or pooled connections. See
+# caobp_system/database.py for the DB_* variables.
+#
+# Per-connection SQLite pragmas (WAL, synchronous, busy_timeout, mmap_size,
+# cache_size, temp_store). Values here override the defaults and the
+# SQLITE_* environment variables.
+SQLITE_PRAGMAS = {}
+
 DATABASES = {
-    "default": {
-        "ENGINE": "django.db.backends.sqlite3",
-        "NAME": BASE_DIR / "db.sqlite3",
-    }
+    "default": database_config(BASE_DIR, SQLITE_PRAGMAS),
+}
+
+# Optional read replica for the heavy read-only admin pages (reports,
+# exports, dashboard). Writes and sessions that have just written always use
+# the primary, and so does every read once the replica is staler than
+# MAX_STALENESS seconds. See caobp_system/replica.py.
+_replica = replica_config(DATABASES["default"], BASE_DIR)
+if _replica:
+    DATABASES["replica"] = _replica
+
+DATABASE_ROUTERS = ['caobp_system.routers.ReplicaRouter']
+
+READ_REPLICA = {
+    'ENABLED': _replica is not None,
+    'MAX_STALENESS': env_int('DB_REPLICA_MAX_STALENESS', 120),    # seconds
+    'REFRESH_INTERVAL': env_int('DB_REPLICA_REFRESH', 60),        # seconds, SQLite snapshots
+    'PIN_AFTER_WRITE': env_int('DB_REPLICA_PIN_AFTER_WRITE', 30),  # seconds on the primary after a write
+}
+
+# Write admission: write transactions on SQLite queue up per worker and take
+# a cross-process file lock before opening a BEGIN IMMEDIATE transaction;
+# views hold it only around their writes. See caobp_system/write_gate.py. Server databases handle
+# concurrent writers themselves, so the gate is only used with SQLite.
+WRITE_GATE = {
+    'ENABLED': is_sqlite(DATABASES['default']),
+    'LOCK_FILE': BASE_DIR / 'db.write.lock',
+    'MAX_QUEUE': 64,      # writes allowed to wait in one worker
+    'TIMEOUT': 10.0,      # seconds before a queued write gets a 503
+    'SLOW_WAIT': 1.0,     # log admissions that waited longer than this
 }
 
 
@@ -126,6 +166,102 @@ STATICFILES_DIRS = [
 MEDIA_URL = "/media/"
 MEDIA_ROOT = BASE_DIR / "media"
 
+# Database backups (see budget/backup.py). SQLite backups copy
+# BACKUP_STEP_PAGES pages per step of the online backup API and pause
+# BACKUP_STEP_SLEEP seconds between steps.
+BACKUP_DIR = BASE_DIR / 'backups'
+BACKUP_STEP_PAGES = 256
+BACKUP_STEP_SLEEP = 0.01
+# SQLite backups are stored as BACKUP_CHUNK_SIZE chunks (a multiple of the
+# page size) in a deduplicating store under BACKUP_DIR/store, so each backup
+# only adds the chunks that changed. Set BACKUP_INCREMENTAL = False to keep
+# every backup as a full file.
+BACKUP_INCREMENTAL = True
+BACKUP_CHUNK_SIZE = 256 * 1024
+
+# Scheduled backups (see budget/backup_schedule.py). Run
+# `manage.py run_backup_scheduler`, or set BACKUP_SCHEDULE=1 and
+# BACKUP_SCHEDULE_IN_PROCESS=1 to run the scheduler on a thread in the web
+# workers (one worker is elected to take the backups). RETENTION keeps the
+# newest scheduled backup of each of the last N hours, days, weeks and months.
+BACKUP_SCHEDULE = {
+    'ENABLED': env_flag('BACKUP_SCHEDULE', False),
+    'CRON': os.environ.get('BACKUP_SCHEDULE_CRON', '0 * * * *'),
+    'IN_PROCESS': env_flag('BACKUP_SCHEDULE_IN_PROCESS', False),
+    'RETENTION': {
+        'hourly': env_int('BACKUP_KEEP_HOURLY', 24),
+        'daily': env_int('BACKUP_KEEP_DAILY', 7),
+        'weekly': env_int('BACKUP_KEEP_WEEKLY', 4),
+        'monthly': env_int('BACKUP_KEEP_MONTHLY', 12),
+    },
+}
+
+# Maintenance mode used while a backup is restored (see
+# caobp_system/maintenance.py). Writes get a 503 with Retry-After; a restore
+# waits up to DRAIN_TIMEOUT seconds for in-flight writes to finish.
+MAINTENANCE = {
+    'FLAG_FILE': BASE_DIR / 'maintenance.json',
+    'DRAIN_FILE': BASE_DIR / 'maintenance.drain',
+    'GENERATION_FILE': BASE_DIR / 'maintenance.generation',
+    'DRAIN_TIMEOUT': 30.0,
+    'RETRY_AFTER': 10,
+}
+
+# Warm standby copy of an SQLite primary, kept at most STANDBY['LAG'] seconds
+# behind by `manage.py run_standby` (see caobp_system/standby.py). Put
+# DB_STANDBY_PATH on a different disk from the database.
+STANDBY = {
+    'ENABLED': env_flag('DB_STANDBY', False),
+    'PATH': os.environ.get('DB_STANDBY_PATH') or BASE_DIR / 'standby' / 'db.standby.sqlite3',
+    'LAG': env_int('DB_STANDBY_LAG', 5),  # seconds
+}
+
+# Status files for background jobs (see budget/jobs.py). A running job
+# refreshes its heartbeat every JOB_HEARTBEAT seconds and is reported as
+# failed when it is JOB_STALE_AFTER seconds old; status files are removed
+# JOB_RETENTION seconds after the job finished.
+JOB_DIR = BASE_DIR / 'jobs'
+JOB_HEARTBEAT = 10
+JOB_STALE_AFTER = 60
+JOB_RETENTION = 7 * 24 * 3600
+
+# Deleting a user runs as a background job that removes their rows
+# USER_DELETE_BATCH_SIZE at a time, pausing between batches (see
+# budget/user_deletion.py)
+USER_DELETE_BATCH_SIZE = 500
+USER_DELETE_BATCH_PAUSE = 0.05
+
+# Processes used to hash passwords during a bulk user import (see
+# accounts/bulk_import.py); None uses one per CPU core
+BULK_IMPORT_WORKERS = env_int('BULK_IMPORT_WORKERS', 0) or None
+
+# Fiscal year new OPB requests are for. Earlier years can be closed with
+# `manage.py close_fiscal_year`, which moves their rows to the read-only
+# archive tables (see budget/archive.py)
+CURRENT_FISCAL_YEAR = os.environ.get('CURRENT_FISCAL_YEAR') or str(date.today().year)
+
+# Days an OPB request may wait in 'pending' for a decision; the reports show
+# the share decided within it (see budget/status_history.py)
+APPROVAL_SLA_DAYS = env_int('APPROVAL_SLA_DAYS', 14)
+
+# Every Nth saved version of an OPB request stores its whole content; the
+# versions in between store only what changed (see budget/versions.py)
+OPB_VERSION_CHECKPOINT_EVERY = env_int('OPB_VERSION_CHECKPOINT_EVERY', 10)
+
+# Seconds the unit head dashboard statistics stay cached per user; they are
+# also invalidated whenever the unit's requests change (see
+# budget/head_stats.py)
+HEAD_STATS_CACHE_TTL = env_int('HEAD_STATS_CACHE_TTL', 300)
+
+# Items whose log amount is this many robust z-scores above the median are
+# listed as unusually large in the reports (see budget/analytics.py)
+ANALYTICS_OUTLIER_Z = float(os.environ.get('ANALYTICS_OUTLIER_Z') or 3.5)
+
+# Estimated share of common text (Jaccard similarity of their activities and
+# indicators) from which two OPB items are reported as likely duplicates
+# (see budget/similarity.py)
+SIMILARITY_THRESHOLD = float(os.environ.get('SIMILARITY_THRESHOLD') or 0.6)
+
 # Login/Logout URLs
 LOGIN_URL = '/accounts/login/'
 LOGIN_REDIRECT_URL = '/'
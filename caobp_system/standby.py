@@ -0,0 +1,239 @@
+"""
+Warm standby for SQLite.
+
+``manage.py run_standby`` keeps a copy of the primary database at
+``STANDBY['PATH']``, ideally on another disk, never more than
+``STANDBY['LAG']`` seconds behind. Each sync copies the primary into the
+standby with the online backup API:
+
+* the primary is only read, inside one WAL read transaction, so writers are
+  never blocked and pay nothing extra per write;
+* the copy is a single transaction on the standby, so a crash part way
+  through leaves the previous standby intact;
+* nothing is copied while ``PRAGMA data_version`` shows no new commits.
+
+If the primary is lost, ``manage.py promote_standby`` verifies the standby
+and copies it into place as the new primary.
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+from django.conf import settings
+
+from .locks import FileLock, LockTimeout
+
+logger = logging.getLogger(__name__)
+
+
+class StandbyError(Exception):
+    """Raised when the standby cannot be synced or promoted"""
+
+
+def standby_config():
+    config = getattr(settings, 'STANDBY', {})
+    path = str(config.get('PATH') or os.path.join(str(settings.BASE_DIR), 'standby', 'db.standby.sqlite3'))
+    return {
+        'ENABLED': config.get('ENABLED', False),
+        'PATH': path,
+        'LAG': config.get('LAG', 5),
+    }
+
+
+def primary_path():
+    return str(settings.DATABASES['default']['NAME'])
+
+
+def _status_path():
+    return standby_config()['PATH'] + '.json'
+
+
+def standby_status():
+    """Status written by the last sync, or ``{}`` if there has been none"""
+    try:
+        with open(_status_path()) as f:
+            status = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    # Changes the standby has not seen yet are at most this old
+    if status.get('pending_since'):
+        status['lag_seconds'] = round(time.time() - status['pending_since'], 1)
+    else:
+        status['lag_seconds'] = 0.0
+    return status
+
+
+def _write_status(status):
+    tmp_path = f'{_status_path()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(status, f, indent=2)
+    os.replace(tmp_path, _status_path())
+
+
+def verify_database(path):
+    """Raise ``StandbyError`` unless ``path`` passes ``PRAGMA integrity_check``"""
+    if not os.path.exists(path):
+        raise StandbyError(f'{path} does not exist')
+    conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    try:
+        result = [row[0] for row in conn.execute('PRAGMA integrity_check').fetchall()]
+    except sqlite3.DatabaseError as e:
+        raise StandbyError(f'{path} is not a valid SQLite database: {e}')
+    finally:
+        conn.close()
+    if result != ['ok']:
+        raise StandbyError(f'{path} failed integrity check: {"; ".join(result[:5])}')
+
+
+class StandbySync:
+    """
+    Copies the primary into the standby whenever it has changed.
+
+    Holds one connection to the primary so ``PRAGMA data_version`` can tell
+    whether another connection has committed since the last sync.
+    """
+
+    def __init__(self, source_path=None, standby_path=None):
+        self.source_path = source_path or primary_path()
+        self.standby_path = standby_path or standby_config()['PATH']
+        os.makedirs(os.path.dirname(self.standby_path) or '.', exist_ok=True)
+        self.lock = FileLock(f'{self.standby_path}.lock')
+        self._source = None
+        self._synced_version = None
+        self._pending_since = None
+
+    def _connection(self):
+        if self._source is None:
+            self._source = sqlite3.connect(self.source_path, isolation_level=None, check_same_thread=False)
+        return self._source
+
+    def close(self):
+        if self._source is not None:
+            self._source.close()
+            self._source = None
+
+    def changed(self):
+        version = self._connection().execute('PRAGMA data_version').fetchone()[0]
+        changed = version != self._synced_version or not os.path.exists(self.standby_path)
+        if changed and self._pending_since is None:
+            self._pending_since = time.time()
+        return changed
+
+    def sync(self, force=False):
+        """Copy the primary if it changed; returns the new status or ``None``"""
+        if not force and not self.changed():
+            return None
+        try:
+            self.lock.acquire(timeout=0)
+        except LockTimeout:
+            raise StandbyError('Another standby sync is running')
+        try:
+            source = self._connection()
+            started = time.monotonic()
+            synced_at = time.time()
+            dest = sqlite3.connect(self.standby_path)
+            try:
+                # One read snapshot of the primary for the whole copy
+                source.execute('BEGIN')
+                version = source.execute('PRAGMA data_version').fetchone()[0]
+                source.execute('SELECT count(*) FROM sqlite_master').fetchone()
+                source.backup(dest)
+                source.execute('COMMIT')
+                page_count = dest.execute('PRAGMA page_count').fetchone()[0]
+            finally:
+                dest.close()
+                if source.in_transaction:
+                    source.execute('ROLLBACK')
+        finally:
+            self.lock.release()
+
+        self._synced_version = version
+        pending_since, self._pending_since = self._pending_since, None
+        status = {
+            'standby_path': self.standby_path,
+            'synced_at': synced_at,
+            'duration_seconds': round(time.monotonic() - started, 3),
+            'page_count': page_count,
+            # Recovery point: how far behind the primary the standby was
+            'recovery_point_seconds': round(synced_at - pending_since, 3) if pending_since else 0.0,
+            'pending_since': None,
+        }
+        _write_status(status)
+        return status
+
+    def note_pending(self):
+        """Record in the status file that the primary has unsynced changes"""
+        status = standby_status()
+        if status and self._pending_since and not status.get('pending_since'):
+            status['pending_since'] = self._pending_since
+            status.pop('lag_seconds', None)
+            _write_status(status)
+
+    def run(self, stop_event=None, poll_interval=0.5):
+        """
+        Sync until ``stop_event`` is set.
+
+        Changes are noticed within ``poll_interval`` seconds and copied once
+        they are ``LAG`` seconds old, so a burst of writes costs one copy.
+        """
+        stop_event = stop_event or threading.Event()
+        lag = standby_config()['LAG']
+        try:
+            while not stop_event.is_set():
+                try:
+                    if self.changed():
+                        self.note_pending()
+                        if time.time() - self._pending_since >= lag:
+                            self.sync(force=True)
+                except (sqlite3.Error, StandbyError):
+                    logger.exception('Standby sync failed')
+                    self.close()
+                stop_event.wait(poll_interval)
+        finally:
+            self.close()
+
+
+def promote_standby(force=False):
+    """
+    Make the standby the primary database.
+
+    The current primary file, if any, is moved aside (never deleted). Unless
+    ``force`` is set, refuses when the primary still passes its integrity
+    check. Stop the web workers before promoting. Returns the path the old
+    primary was moved to, or ``None``.
+    """
+    config = standby_config()
+    standby_path = config['PATH']
+    target = primary_path()
+    verify_database(standby_path)
+
+    if os.path.exists(target) and not force:
+        try:
+            verify_database(target)
+        except StandbyError:
+            pass
+        else:
+            raise StandbyError('The primary database is healthy; use --force to replace it anyway')
+
+    moved_to = None
+    if os.path.exists(target):
+        moved_to = f'{target}.pre-promote-{datetime.now():%Y%m%d_%H%M%S}'
+        os.replace(target, moved_to)
+        for suffix in ('-wal', '-shm'):
+            if os.path.exists(target + suffix):
+                os.replace(target + suffix, moved_to + suffix)
+
+    source = sqlite3.connect(f'file:{standby_path}?mode=ro', uri=True)
+    dest = sqlite3.connect(target)
+    try:
+        source.backup(dest)
+        dest.execute('PRAGMA journal_mode=WAL')
+    finally:
+        dest.close()
+        source.close()
+    verify_database(target)
+    return moved_to
@@ -0,0 +1,232 @@
+"""
+Tests for the database configuration and the SQLite write gate.
+
+They run against whichever backend the environment selects, so run them
+once per backend::
+
+    python manage.py test caobp_system
+    DB_ENGINE=postgres DB_NAME=caobp DB_USER=caobp DB_PASSWORD=... python manage.py test caobp_system
+    DB_ENGINE=postgres DB_POOL=1 ... python manage.py test caobp_system
+"""
+import os
+import tempfile
+import threading
+import time
+from unittest import mock
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.http import JsonResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+
+from . import write_gate
+from .database import database_config, env_flag
+from .write_gate import WriteGate, WriteQueueFull, WriteQueueTimeout, serialized_atomic, serialized_write
+
+
+class DatabaseConfigTests(SimpleTestCase):
+    def test_sqlite_is_the_default(self):
+        config = database_config('/srv/caobp', environ={})
+        self.assertEqual(config['ENGINE'], 'django.db.backends.sqlite3')
+        self.assertEqual(config['NAME'], '/srv/caobp/db.sqlite3')
+        self.assertEqual(config['OPTIONS']['transaction_mode'], 'IMMEDIATE')
+        self.assertIn('PRAGMA journal_mode=WAL', config['OPTIONS']['init_command'])
+
+    def test_sqlite_tuning_can_be_turned_off(self):
+        config = database_config('/srv/caobp', environ={'SQLITE_TUNING': '0'})
+        self.assertEqual(config['OPTIONS'], {})
+
+    def test_postgres_keeps_connections_open(self):
+        config = database_config('/srv/caobp', environ={
+            'DB_ENGINE': 'postgres', 'DB_NAME': 'opb', 'DB_HOST': 'db', 'DB_CONN_MAX_AGE': '120',
+        })
+        self.assertEqual(config['ENGINE'], 'django.db.backends.postgresql')
+        self.assertEqual((config['NAME'], config['HOST'], config['PORT']), ('opb', 'db', '5432'))
+        self.assertEqual(config['CONN_MAX_AGE'], 120)
+        self.assertTrue(config['CONN_HEALTH_CHECKS'])
+        self.assertNotIn('pool', config['OPTIONS'])
+
+    def test_postgres_pool(self):
+        config = database_config('/srv/caobp', environ={
+            'DB_ENGINE': 'postgresql', 'DB_POOL': '1', 'DB_POOL_MAX_SIZE': '20',
+        })
+        # Django refuses persistent connections together with a pool
+        self.assertEqual(config['CONN_MAX_AGE'], 0)
+        self.assertEqual(config['OPTIONS']['pool'], {'min_size': 2, 'max_size': 20, 'timeout': 10})
+
+
+class ConnectionTests(TransactionTestCase):
+    """Talks to the configured database through Django's connection"""
+
+    def test_backend_matches_settings(self):
+        self.assertEqual(connection.settings_dict['ENGINE'], settings.DATABASES['default']['ENGINE'])
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT 1')
+            self.assertEqual(cursor.fetchone()[0], 1)
+
+    def test_write_transaction_commits_and_rolls_back(self):
+        with connection.cursor() as cursor:
+            cursor.execute('CREATE TABLE caobp_smoke (id INTEGER PRIMARY KEY, note VARCHAR(20))')
+        try:
+            with transaction.atomic():
+                with connection.cursor() as cursor:
+                    cursor.execute('INSERT INTO caobp_smoke (id, note) VALUES (%s, %s)', [1, 'kept'])
+            with self.assertRaises(ValueError):
+                with transaction.atomic():
+                    with connection.cursor() as cursor:
+                        cursor.execute('INSERT INTO caobp_smoke (id, note) VALUES (%s, %s)', [2, 'rolled back'])
+                    raise ValueError
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT note FROM caobp_smoke ORDER BY id')
+                self.assertEqual(cursor.fetchall(), [('kept',)])
+        finally:
+            with connection.cursor() as cursor:
+                cursor.execute('DROP TABLE caobp_smoke')
+
+    def test_connection_options(self):
+        if connection.vendor == 'sqlite':
+            with connection.cursor() as cursor:
+                cursor.execute('PRAGMA synchronous')
+                # NORMAL, from the init_command
+                self.assertEqual(cursor.fetchone()[0], 1)
+        else:
+            self.assertEqual(connection.vendor, 'postgresql')
+            connection.ensure_connection()
+            if env_flag('DB_POOL'):
+                self.assertIsNotNone(connection.pool)
+            else:
+                self.assertEqual(connection.settings_dict['CONN_MAX_AGE'],
+                                 settings.DATABASES['default']['CONN_MAX_AGE'])
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError('condition not met in time')
+        time.sleep(0.005)
+
+
+class HoldGate(threading.Thread):
+    """Holds ``gate``'s write slot from another thread until ``release()``"""
+
+    def __init__(self, gate):
+        super().__init__(daemon=True)
+        self.gate = gate
+        self.admitted = threading.Event()
+        self.done = threading.Event()
+
+    def run(self):
+        with self.gate.admit():
+            self.admitted.set()
+            self.done.wait(5)
+
+    def __enter__(self):
+        self.start()
+        self.admitted.wait(5)
+        return self
+
+    def __exit__(self, *exc):
+        self.done.set()
+        self.join(5)
+
+
+class WriteGateTests(SimpleTestCase):
+    def test_writers_are_admitted_in_arrival_order(self):
+        gate = WriteGate(timeout=5)
+        order = []
+
+        def write(n):
+            with gate.admit():
+                order.append(n)
+
+        writers = []
+        with HoldGate(gate):
+            for n in range(5):
+                writer = threading.Thread(target=write, args=(n,))
+                writer.start()
+                writers.append(writer)
+                # Queue them one at a time so arrival order is known
+                wait_for(lambda: gate.queue_depth == n + 1)
+        for writer in writers:
+            writer.join(5)
+        self.assertEqual(order, [0, 1, 2, 3, 4])
+        self.assertEqual(gate.stats()['admitted'], 6)
+        self.assertFalse(gate.stats()['in_progress'])
+
+    def test_nested_admission_joins_the_outer_one(self):
+        gate = WriteGate(timeout=0.05)
+        with gate.admit():
+            with gate.admit() as waited:
+                self.assertEqual(waited, 0.0)
+            # Leaving the inner block must not give the slot away
+            errors = []
+
+            def write():
+                try:
+                    with gate.admit():
+                        pass
+                except WriteQueueTimeout as e:
+                    errors.append(e)
+
+            writer = threading.Thread(target=write)
+            writer.start()
+            writer.join(5)
+            self.assertEqual(len(errors), 1)
+        self.assertEqual(gate.stats()['admitted'], 1)
+        with gate.admit():
+            pass
+        self.assertEqual(gate.stats()['admitted'], 2)
+
+    def test_full_queue_is_rejected(self):
+        gate = WriteGate(max_queue=0, timeout=5)
+        with HoldGate(gate):
+            with self.assertRaises(WriteQueueFull):
+                with gate.admit():
+                    pass
+        self.assertEqual(gate.stats()['rejected'], 1)
+
+    def test_file_lock_serializes_gates_in_different_processes(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            lock_path = os.path.join(tmp, 'write.lock')
+            first, second = WriteGate(lock_path=lock_path), WriteGate(lock_path=lock_path, timeout=0.05)
+            with HoldGate(first):
+                with self.assertRaises(WriteQueueTimeout):
+                    with second.admit():
+                        pass
+            with second.admit():
+                pass
+
+
+@override_settings(WRITE_GATE={'ENABLED': True, 'TIMEOUT': 0.05})
+class SerializedWriteTests(TestCase):
+    def setUp(self):
+        self.gate = WriteGate(timeout=0.05)
+        patcher = mock.patch.object(write_gate, '_gate', self.gate)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @staticmethod
+    @serialized_write
+    def save_view(request):
+        try:
+            with serialized_atomic():
+                pass
+        except Exception:
+            # Views that swallow the error still answer 503
+            return JsonResponse({'success': False, 'message': 'Could not save'})
+        return JsonResponse({'success': True, 'message': 'Saved'})
+
+    def test_write_goes_through(self):
+        response = self.save_view(RequestFactory().post('/save/'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.gate.stats()['admitted'], 1)
+
+    def test_timed_out_write_gets_503_with_retry_after(self):
+        with HoldGate(self.gate):
+            response = self.save_view(RequestFactory().post('/save/'))
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '2')
+        self.assertEqual(self.gate.stats()['rejected'], 1)
+        # The rejection does not leak into the next request
+        self.assertEqual(self.save_view(RequestFactory().post('/save/')).status_code, 200)
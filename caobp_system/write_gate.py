@@ -0,0 +1,268 @@
+"""
+Write admission for SQLite.
+
+SQLite allows a single writer at a time. Instead of letting every request
+race for the database lock and spin in the busy handler, write transactions
+queue up here first:
+
+1. a bounded, first-come-first-served queue inside each worker process,
+2. a file lock shared by all worker processes,
+3. a short ``BEGIN IMMEDIATE`` transaction (see ``transaction_mode`` in
+   ``caobp_system/database.py``).
+
+Only one thread per process ever waits on the file lock, so the database
+sees at most one writer per process and lock hand-off stays fair. Views
+take the gate only around their write transactions, with
+``serialized_atomic()``, so parsing the request and rendering the response
+never hold it. The gate is re-entrant within a thread: a nested
+``serialized_atomic()`` joins the outer admission instead of queueing
+behind it.
+"""
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+
+from django.conf import settings
+from django.db import transaction
+from django.http import JsonResponse
+
+from .locks import FileLock, LockTimeout
+from .replica import note_write
+
+logger = logging.getLogger(__name__)
+
+
+class WriteRejected(Exception):
+    """Base class for writes the gate turned away"""
+
+
+class WriteQueueFull(WriteRejected):
+    """Raised when too many writes are already waiting in this worker"""
+
+
+class WriteQueueTimeout(WriteRejected):
+    """Raised when a write waited longer than the admission timeout"""
+
+
+class WriteGate:
+    """Bounded FIFO admission queue plus a cross-process file lock"""
+
+    def __init__(self, lock_path=None, max_queue=64, timeout=10.0, slow_wait=1.0, sample_size=1024):
+        self.lock_path = lock_path
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.slow_wait = slow_wait
+        self._mutex = threading.Lock()
+        self._waiters = deque()
+        self._busy = False
+        self._wait_samples = deque(maxlen=sample_size)
+        self._admitted = 0
+        self._rejected = 0
+        self._max_depth = 0
+        # Admissions the current thread holds (nested blocks share the first)
+        self._held = threading.local()
+
+    # Queue ------------------------------------------------------------
+
+    def _enter_queue(self, deadline):
+        with self._mutex:
+            if not self._busy and not self._waiters:
+                self._busy = True
+                return
+            if len(self._waiters) >= self.max_queue:
+                self._rejected += 1
+                raise WriteQueueFull(f'{len(self._waiters)} writes already queued')
+            turn = threading.Event()
+            self._waiters.append(turn)
+            self._max_depth = max(self._max_depth, len(self._waiters))
+
+        if turn.wait(max(0.0, deadline - time.monotonic())):
+            return
+
+        with self._mutex:
+            if turn.is_set():
+                # Granted just as we timed out; hand the slot on
+                self._hand_off()
+            else:
+                self._waiters.remove(turn)
+            self._rejected += 1
+        raise WriteQueueTimeout('Timed out waiting for the write queue')
+
+    def _hand_off(self):
+        # Caller holds self._mutex
+        if self._waiters:
+            self._waiters.popleft().set()
+        else:
+            self._busy = False
+
+    def _leave_queue(self):
+        with self._mutex:
+            self._hand_off()
+
+    # Public API -------------------------------------------------------
+
+    @contextmanager
+    def admit(self):
+        """Hold the single write slot for the duration of the block"""
+        depth = getattr(self._held, 'depth', 0)
+        if depth:
+            # Already admitted further up this thread's stack
+            self._held.depth = depth + 1
+            try:
+                yield 0.0
+            finally:
+                self._held.depth = depth
+            return
+
+        started = time.monotonic()
+        deadline = started + self.timeout
+        self._enter_queue(deadline)
+        file_lock = None
+        try:
+            if self.lock_path:
+                file_lock = FileLock(self.lock_path)
+                try:
+                    file_lock.acquire(timeout=max(0.0, deadline - time.monotonic()))
+                except LockTimeout:
+                    with self._mutex:
+                        self._rejected += 1
+                    raise WriteQueueTimeout('Timed out waiting for another worker to finish writing')
+
+            waited = time.monotonic() - started
+            with self._mutex:
+                self._admitted += 1
+                self._wait_samples.append(waited)
+            if waited >= self.slow_wait:
+                logger.warning('Write admission waited %.3fs (queue depth %d)', waited, self.queue_depth)
+            self._held.depth = 1
+            try:
+                yield waited
+            finally:
+                self._held.depth = 0
+        finally:
+            if file_lock is not None:
+                file_lock.release()
+            self._leave_queue()
+
+    @contextmanager
+    def atomic(self, using=None):
+        """Admission followed by a (``BEGIN IMMEDIATE``) transaction"""
+        with self.admit():
+            with transaction.atomic(using=using):
+                yield
+
+    @property
+    def queue_depth(self):
+        return len(self._waiters)
+
+    def stats(self):
+        """Queue depth and wait-time percentiles for this worker"""
+        with self._mutex:
+            samples = sorted(self._wait_samples)
+            stats = {
+                'queue_depth': len(self._waiters),
+                'max_queue_depth': self._max_depth,
+                'in_progress': self._busy,
+                'admitted': self._admitted,
+                'rejected': self._rejected,
+            }
+
+        def pct(p):
+            if not samples:
+                return 0.0
+            return samples[min(len(samples) - 1, int(round(p / 100 * (len(samples) - 1))))] * 1000
+
+        stats.update({
+            'wait_p50_ms': round(pct(50), 2),
+            'wait_p95_ms': round(pct(95), 2),
+            'wait_p99_ms': round(pct(99), 2),
+            'wait_max_ms': round(samples[-1] * 1000, 2) if samples else 0.0,
+        })
+        return stats
+
+
+_gate = None
+_gate_lock = threading.Lock()
+
+
+def get_write_gate():
+    """The process-wide gate configured from ``settings.WRITE_GATE``"""
+    global _gate
+    if _gate is None:
+        with _gate_lock:
+            if _gate is None:
+                config = getattr(settings, 'WRITE_GATE', {})
+                _gate = WriteGate(
+                    lock_path=config.get('LOCK_FILE'),
+                    max_queue=config.get('MAX_QUEUE', 64),
+                    timeout=config.get('TIMEOUT', 10.0),
+                    slow_wait=config.get('SLOW_WAIT', 1.0),
+                )
+    return _gate
+
+
+def write_gate_enabled():
+    return getattr(settings, 'WRITE_GATE', {}).get('ENABLED', False)
+
+
+# Rejections met during the current request, for ``serialized_write``
+_request = threading.local()
+
+
+@contextmanager
+def serialized_atomic(using=None):
+    """``transaction.atomic`` that goes through the write gate when enabled"""
+    if not write_gate_enabled():
+        with transaction.atomic(using=using):
+            yield
+        return
+    try:
+        with get_write_gate().atomic(using=using):
+            yield
+    except WriteRejected as e:
+        if getattr(_request, 'active', False):
+            _request.rejection = e
+        raise
+
+
+def _busy_response():
+    response = JsonResponse({
+        'success': False,
+        'message': 'The system is busy saving other changes. Please try again in a moment.'
+    }, status=503)
+    response['Retry-After'] = '2'
+    return response
+
+
+def serialized_write(view_func):
+    """
+    Mark a view that writes.
+
+    The view itself takes the write gate around its writes with
+    ``serialized_atomic()``. Unsafe (POST/PUT/DELETE) requests pin the
+    session to the primary database (see ``caobp_system.replica``), and
+    when the gate turns one of their writes away (queue full or wait timed
+    out) the client gets a 503 with ``Retry-After`` instead of a "database
+    is locked" error, even if the view caught the exception.
+    """
+    @wraps(view_func)
+    def wrapper(request, *args, **kwargs):
+        if request.method in ('GET', 'HEAD', 'OPTIONS'):
+            return view_func(request, *args, **kwargs)
+        # Keep this session's reads on the primary for a while
+        note_write(request)
+        _request.active, _request.rejection = True, None
+        try:
+            response = view_func(request, *args, **kwargs)
+        except WriteRejected as e:
+            _request.rejection, response = e, None
+        finally:
+            rejection, _request.active, _request.rejection = _request.rejection, False, None
+        if rejection is not None:
+            logger.warning('Write rejected for %s: %s', request.path, rejection)
+            return _busy_response()
+        return response
+    return wrapper
@@ -14,3 +14,10 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "caobp_system.settings")
 
 application = get_wsgi_application()
+
+# Scheduled backups on a thread in this worker, if BACKUP_SCHEDULE and
+# BACKUP_SCHEDULE_IN_PROCESS are set; only one elected worker takes them
+# (see budget/backup_schedule.py)
+from budget.backup_schedule import start_scheduler_thread  # noqa: E402
+
+start_scheduler_thread()